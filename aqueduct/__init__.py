@@ -10,6 +10,7 @@ import sys
 import RWAPIMicroservicePython
 from flask import Flask
 from simplejson import JSONEncoder
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from aqueduct.config import SETTINGS
 from aqueduct.routes.api import error
@@ -39,6 +40,8 @@ logging.getLogger("pandas").propagate = False
 
 # Flask App
 app = Flask(__name__)
+# The client address is the one the trusted proxies saw, the X-Forwarded-For entries before are the client's
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv("TRUSTED_PROXIES", 0)))
 
 # Routing
 app.register_blueprint(aqueduct_analysis_endpoints_v1, url_prefix='/api/v1/aqueduct/analysis')
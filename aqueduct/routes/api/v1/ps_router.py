@@ -9,10 +9,9 @@ import logging
 import geojson as geoj
 import pandas as pd
 import re
-import os
 import traceback
-import base64
-from flask import jsonify, request, Blueprint, json
+import itertools
+from flask import jsonify, request, Blueprint, json, Response
 from werkzeug.utils import secure_filename
 
 from aqueduct.errors import CartoError, DBError, Error
@@ -29,10 +28,13 @@ from aqueduct.serializers import (
     serialize_response_risk,
 )
 from aqueduct.services.carto_service import CartoService
-from aqueduct.services.cba_defaults_service import CBADefaultService
+from aqueduct.services.cba_defaults_service import CBADefaultService, CBADefaultsTable
 from aqueduct.services.cba_service import CBAEndService, CBAICache
-from aqueduct.services.food_supply_chain_service import FoodSupplyChainService
+from aqueduct.services.food_supply_chain_service import SEGMENTS_LIMIT, FoodSupplyChainService
 from aqueduct.services.risk_service import RiskService
+from aqueduct.services.supply_chain_ingest import sample
+from aqueduct.services.supply_chain_results import gunzip_stream
+from aqueduct.services.supply_chain_uploads import UploadStore, decode_base64, read_stream
 from aqueduct.validators import (
     validate_params_cba,
     validate_params_cba_def,
@@ -40,7 +42,6 @@ from aqueduct.validators import (
     validate_wra_params,
 )
 
-UPLOAD_FOLDER = "./tmp"
 ALLOWED_EXTENSIONS = {"xlsx", "b64"}
 
 
@@ -48,6 +49,22 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def request_tenant():
+    """
+    Who submits a job: the logged user added by the gateway, or the client address. ProxyFix sets it from
+    the X-Forwarded-For entries of the TRUSTED_PROXIES, the ones before are the client's own
+    """
+    logged_user = request.args.get("loggedUser") or request.form.get("loggedUser")
+    if logged_user:
+        try:
+            user = json.loads(logged_user)
+            if isinstance(user, dict) and user.get("id"):
+                return "user:{}".format(user["id"])
+        except ValueError:
+            pass
+    return "address:{}".format(request.remote_addr)
+
+
 aqueduct_analysis_endpoints_v1 = Blueprint("aqueduct_analysis_endpoints_v1", __name__)
 
 """
@@ -251,6 +268,21 @@ def expire_cache():
         return error(status=500, detail=e.message)
 
 
+@aqueduct_analysis_endpoints_v1.route(
+    "/cba/default/refresh", strict_slashes=False, methods=["POST"]
+)
+@is_microservice_or_admin
+def refresh_cba_defaults():
+    """Regenerate the precomputed cba defaults after a data refresh"""
+    try:
+        logging.info("[ROUTER]: Regenerating cba defaults")
+        CBADefaultsTable.generate()
+        return jsonify({"status": "generated"}), 200
+    except Exception as e:
+        logging.error("[ROUTER]: Unknown error: " + str(e))
+        return error(status=500, detail=str(e))
+
+
 @aqueduct_analysis_endpoints_v1.route("/cba", strict_slashes=False, methods=["GET"])
 @sanitize_parameters
 @validate_params_cba
@@ -327,6 +359,43 @@ def get_cba_widget(widget_id, **kwargs):
         return error(status=500, detail=str(e))
 
 
+@aqueduct_analysis_endpoints_v1.route("/cba/widgets", strict_slashes=False, methods=["GET"])
+@sanitize_parameters
+@validate_params_cba
+def get_cba_widgets(**kwargs):
+    """Gets several CBA widgets from a single cba computation
+    widgets: comma separated list of widget ids, all of them if not set
+    """
+    # not a cba parameter, it must not end up in the cache key
+    widgets = kwargs["sanitized_params"].pop("widgets", None)
+    widget_ids = widgets.split(",") if widgets else CBAEndService.widgets
+    unknown = [widget_id for widget_id in widget_ids if widget_id not in CBAEndService.widgets]
+    if unknown:
+        return error(status=400, detail="Unknown widgets: {}".format(", ".join(unknown)))
+    logging.info(f"[ROUTER]: Getting cba widgets: {widget_ids}")
+    try:
+        output = CBAEndService(kwargs["sanitized_params"])
+        return (
+            jsonify(
+                {
+                    "data": [
+                        serialize_response_cba(widget)
+                        for widget in json.loads(
+                            json.dumps(output.get_widgets(widget_ids), ignore_nan=True)
+                        )
+                    ]
+                }
+            ),
+            200,
+        )
+    except Error as e:
+        logging.error("[ROUTER]: " + str(e))
+        return error(status=e.status, detail=str(e))
+    except Exception as e:
+        logging.error("[ROUTER]: Unknown error: " + str(e))
+        return error(status=500, detail=str(e))
+
+
 @aqueduct_analysis_endpoints_v1.route(
     "/cba/default", strict_slashes=False, methods=["GET"]
 )
@@ -335,9 +404,12 @@ def get_cba_widget(widget_id, **kwargs):
 def get_cba_default(**kwargs):
     logging.info("[ROUTER, get_cba_default]: Getting cba default")
     try:
-        output = CBADefaultService(kwargs["sanitized_params"])
+        data = CBADefaultsTable.lookup(kwargs["sanitized_params"])
+        if data is None:
+            output = CBADefaultService(kwargs["sanitized_params"])
+            data = output.execute()
         logging.debug("[ROUTER, get_cba_default]: output generated")
-        return jsonify(serialize_response_default(output.execute())), 200
+        return jsonify(serialize_response_default(data)), 200
     except AttributeError as e:
         logging.error("[ROUTER]: " + str(e))
         return error(status=500, detail=str(e))
@@ -408,6 +480,7 @@ def get_risk_widget(widget_id, **kwargs):
 # job_token=$(curl -F 'data=@./aqueduct/services/supply_chain_data/test.xlsx.b64' $uri/bwd/0.94 | jq -r '.job_token')
 # job_token=$(curl -F 'data=@./aqueduct/services/supply_chain_data/test.xlsx.b64' $uri/gtd/0.92 | jq -r '.job_token')
 # job_token=$(curl -F 'data=@./aqueduct/services/supply_chain_data/just.countries.xlsx.b64' $uri/gtd/0.92 | jq -r '.job_token')
+# job_token=$(curl -F 'data=@./aqueduct/services/supply_chain_data/test.xlsx.b64' "$uri?indicators=bws,bwd,gtd&thresholds=0.53,0.94,0.92" | jq -r '.job_token')
 # echo $job_token
 # curl $uri/$job_token | jq
 @aqueduct_analysis_endpoints_v1.route(
@@ -415,9 +488,12 @@ def get_risk_widget(widget_id, **kwargs):
     strict_slashes=False,
     methods=["POST"],
 )
+@aqueduct_analysis_endpoints_v1.route(
+    "/food-supply-chain", strict_slashes=False, methods=["POST"]
+)
 @sanitize_parameters
 # @validate_params_cba_def
-def get_supply_chain_analysis(user_indicator, threshold, **kwargs):
+def get_supply_chain_analysis(user_indicator=None, threshold=None, **kwargs):
     try:
         # check if the post request has the file part
         if "data" not in request.files:
@@ -426,26 +502,57 @@ def get_supply_chain_analysis(user_indicator, threshold, **kwargs):
 
         file = request.files["data"]
 
+        # records: list of {key: value} rows, columnar: one array per key
+        results_format = kwargs["params"].get("format", "records")
+        if results_format not in FoodSupplyChainService.results_formats:
+            return error(
+                status=400,
+                detail="format must be one of {}".format(
+                    ", ".join(FoodSupplyChainService.results_formats)
+                ),
+            )
+
+        # Without an indicator in the path, several indicators are run in a single job:
+        # ?indicators=bws,bwd,gtd&thresholds=0.5,0.25,0.75
+        indicators = None
+        if user_indicator is None:
+            names = kwargs["params"].get("indicators", "").split(",")
+            thresholds = kwargs["params"].get("thresholds", "").split(",")
+            if (
+                len(names) != len(thresholds)
+                or len(set(names)) != len(names)
+                or not set(names) <= set(FoodSupplyChainService.indicators_list)
+            ):
+                return error(
+                    status=400,
+                    detail="indicators must be distinct values of {}, with one threshold each".format(
+                        ", ".join(FoodSupplyChainService.indicators_list)
+                    ),
+                )
+            try:
+                indicators = dict(zip(names, [float(x) for x in thresholds]))
+            except ValueError:
+                return error(status=400, detail="thresholds must be numbers")
+
         if file.filename == "":
             logging.error("[ROUTER]: No input file provided")
             return error(status=500, detail="No input file name provided")
 
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            destination = os.path.join(UPLOAD_FOLDER, filename)
-
-            file.save(destination, 1024 * 1024 * 5)
 
             # Something is corrupting excel files. I cannot figure out what's
             # doing it. Large csv and text files do not get corrupted. The file
             # extension isn't the problem either.
-            if destination.endswith("b64"):
-                logging.error("[ROUTER]: base64 decoding uploaded file")
-                fin = open(destination, "r")
-                xlsx = base64.b64decode(fin.read())
-                fin.close()
-                fout = open(destination, "wb")
-                fout.write(xlsx)
+            if filename.endswith("b64"):
+                logging.info("[ROUTER]: base64 decoding uploaded file")
+                # decoded as it is read and stored once, by md5
+                store = UploadStore()
+                # the first rows are sampled for the estimated cost before the stored file is closed
+                upload = store.put(
+                    decode_base64(read_stream(file.stream)),
+                    inspect=lambda stored: sample(stored, store.size, store.lines),
+                )
             else:
                 return (
                     jsonify(
@@ -461,7 +568,7 @@ def get_supply_chain_analysis(user_indicator, threshold, **kwargs):
                 return (
                     jsonify(
                         {
-                            "saved": destination,
+                            "saved": upload,
                             "content-type": file.content_type,
                             "content-length": file.content_length,
                         }
@@ -472,22 +579,27 @@ def get_supply_chain_analysis(user_indicator, threshold, **kwargs):
 
             logging.info(
                 '[ROUTER]: Analyzing supply chain. user_indicator="{}" threshold="{}" '.format(
-                    user_indicator, threshold
+                    user_indicator or ",".join(indicators),
+                    threshold or ",".join(str(x) for x in indicators.values()),
                 )
             )
 
-            logging.info("[ROUTER]: file path is {}".format(destination))
+            logging.info("[ROUTER]: upload is {}".format(upload))
 
             analyzer = FoodSupplyChainService(
                 user_indicator=user_indicator,
-                user_threshold=float(threshold),
-                user_input=destination,
+                user_threshold=None if threshold is None else float(threshold),
+                upload=upload,
+                results_format=results_format,
+                indicators=indicators,
+                tenant=request_tenant(),
+                upload_sample=store.inspected,
             )
             analyzer.enqueue()
 
-            os.remove(destination)
-
-            return jsonify(analyzer.results()), 200, {}
+            # The job may be done already (identical submission): its results are
+            # fetched with the job token
+            return jsonify(analyzer.status()), 200, {}
         else:
             return error(
                 status=500,
@@ -507,6 +619,105 @@ def get_supply_chain_analysis(user_indicator, threshold, **kwargs):
         # return error(status=500, detail=str(e))
 
 
+@aqueduct_analysis_endpoints_v1.route(
+    "/food-supply-chain/<job_token>/events", strict_slashes=False, methods=["GET"]
+)
+@sanitize_parameters
+def get_supply_chain_analysis_events(job_token, **kwargs):
+    """Server-Sent Events with the progress of the job, until it is over"""
+    try:
+        logging.info('[ROUTER]: Following job. job_token="{}"'.format(job_token))
+
+        analyzer = FoodSupplyChainService(job_token=job_token)
+        if not analyzer.redis.exists(job_token):
+            return error(status=404, detail="Unknown job {}".format(job_token))
+        events = analyzer.events()
+        first = next(events)  # errors (e.g. unknown job) before the response starts
+
+        def stream():
+            for event in itertools.chain([first], events):
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "event: status\ndata: {}\n\n".format(json.dumps(event))
+
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return Response(stream(), 200, headers, mimetype="text/event-stream")
+    except Exception as e:
+        logging.error("[ROUTER]: " + str(e))
+        tb = "".join(traceback.format_tb(e.__traceback__))
+        message = str(e)
+        payload = {"tb": tb, "message": message}
+        return jsonify(payload), 500, {}
+
+
+# Partial results of a running job, from a cursor (0, then the "cursor" of the previous response)
+# curl --compressed "$uri/$job_token/segments?cursor=0" | jq
+@aqueduct_analysis_endpoints_v1.route(
+    "/food-supply-chain/<job_token>/segments", strict_slashes=False, methods=["GET"]
+)
+@sanitize_parameters
+def get_supply_chain_analysis_segments(job_token, **kwargs):
+    try:
+        try:
+            cursor = int(kwargs["params"].get("cursor", 0))
+            limit = int(kwargs["params"].get("limit", SEGMENTS_LIMIT))
+        except ValueError:
+            return error(status=400, detail="cursor and limit must be integers")
+        if cursor < 0 or not 0 < limit <= SEGMENTS_LIMIT:
+            return error(
+                status=400,
+                detail="cursor must not be negative, limit between 1 and {}".format(
+                    SEGMENTS_LIMIT
+                ),
+            )
+
+        analyzer = FoodSupplyChainService(job_token=job_token)
+        if not analyzer.redis.exists(job_token):
+            return error(status=404, detail="Unknown job {}".format(job_token))
+
+        # Segments are stored gzipped, they are streamed without being decoded
+        stream = analyzer.stream_segments(cursor, limit)
+        first = next(stream)  # errors (e.g. unknown job) before the response starts
+        body = itertools.chain([first], stream)
+        headers = {"Content-Type": "application/json", "Cache-Control": "no-cache"}
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+        else:
+            body = gunzip_stream(body)
+        return Response(body, 200, headers)
+    except Exception as e:
+        logging.error("[ROUTER]: " + str(e))
+        tb = "".join(traceback.format_tb(e.__traceback__))
+        message = str(e)
+        payload = {"tb": tb, "message": message}
+        return jsonify(payload), 500, {}
+
+
+# curl -X DELETE $uri/$job_token | jq
+@aqueduct_analysis_endpoints_v1.route(
+    "/food-supply-chain/<job_token>", strict_slashes=False, methods=["DELETE"]
+)
+@sanitize_parameters
+def cancel_supply_chain_analysis(job_token, **kwargs):
+    """Cancels a waiting or running job. 409 if the job is already over"""
+    try:
+        logging.info('[ROUTER]: Cancelling job. job_token="{}"'.format(job_token))
+
+        analyzer = FoodSupplyChainService(job_token=job_token)
+        if not analyzer.redis.exists(job_token):
+            return error(status=404, detail="Unknown job {}".format(job_token))
+        if not analyzer.cancel():
+            return error(status=409, detail="The job is already over")
+        return jsonify(analyzer.status()), 200, {}
+    except Exception as e:
+        logging.error("[ROUTER]: " + str(e))
+        tb = "".join(traceback.format_tb(e.__traceback__))
+        message = str(e)
+        payload = {"tb": tb, "message": message}
+        return jsonify(payload), 500, {}
+
+
 @aqueduct_analysis_endpoints_v1.route(
     "/food-supply-chain/<job_token>", strict_slashes=False, methods=["GET"]
 )
@@ -519,8 +730,19 @@ def get_supply_chain_analysis_result(job_token, **kwargs):
         )
 
         analyzer = FoodSupplyChainService(job_token=job_token)
-
-        return jsonify(analyzer.results()), 200, {}
+        if not analyzer.redis.exists(job_token):
+            return error(status=404, detail="Unknown job {}".format(job_token))
+
+        # Results are stored gzipped, they are streamed without being decoded
+        stream = analyzer.stream_results()
+        first = next(stream)  # errors (e.g. unknown job) before the response starts
+        body = itertools.chain([first], stream)
+        headers = {"Content-Type": "application/json"}
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+        else:
+            body = gunzip_stream(body)
+        return Response(body, 200, headers)
     except AttributeError as e:
         logging.error("[ROUTER]: " + str(e))
         tb = "".join(traceback.format_tb(e.__traceback__))
@@ -1,6 +1,7 @@
 import datetime
 import logging
 import os
+import time
 
 import numpy as np
 import pandas as pd
@@ -13,18 +14,19 @@ from aqueduct.errors import Error
 
 
 class CBADef(object):
+    ### BACKGROUND INTO
+    # self.flood = "Riverine"
+    scenarios = {"business as usual": ['rcp8p5', 'ssp2', "bau"],
+                 "pessimistic": ['rcp8p5', 'ssp3', "pes"],
+                 "optimistic": ['rcp4p5', 'ssp2', "opt"],
+                 "rcp8p5": ['rcp8p5', 'ssp3', "pes"],
+                 "rcp4p5": ['rcp8p5', 'ssp2', "bau"]}
+
     def __init__(self, user_selections):
         ### DBConexion
         self.engine = sqlalchemy.create_engine(os.getenv('POSTGRES_URL'))
         self.metadata = sqlalchemy.MetaData(bind=self.engine)
         self.metadata.reflect(self.engine)
-        ### BACKGROUND INTO 
-        # self.flood = "Riverine"
-        self.scenarios = {"business as usual": ['rcp8p5', 'ssp2', "bau"],
-                          "pessimistic": ['rcp8p5', 'ssp3', "pes"],
-                          "optimistic": ['rcp4p5', 'ssp2', "opt"],
-                          "rcp8p5": ['rcp8p5', 'ssp3', "pes"],
-                          "rcp4p5": ['rcp8p5', 'ssp2', "bau"]}
         ###  USER INPUTS 
         self.geogunit_unique_name = user_selections.get("geogunit_unique_name")
         self.scenario = self.scenarios.get(user_selections.get("scenario"))
@@ -71,6 +73,184 @@ class CBADef(object):
         }]
 
 
+class CBADefaultsTable(object):
+    """
+    Precomputed CBA defaults for every lookup_master unit:
+        * generate() computes the default protection and construction costs of every unit with set-based queries
+          and stores them in the precalc_cba_defaults table. It has to be rerun whenever the source data is refreshed
+        * load() reads that table into a compact in-memory map (one row per unit, numpy arrays for the values)
+        * lookup() answers a /cba/default request from the map, without touching the database
+    """
+    table_name = "precalc_cba_defaults"
+    rps = np.array([2, 5, 10, 25, 50, 100, 250, 500, 1000])
+    scen_abbs = ["bau", "pes", "opt"]
+    floods = ["riverine", "coastal"]
+    sub_abbs = ["nosub", "wtsub"]
+    netherlands = ['Noord-Brabant, Netherlands', 'Zeeland, Netherlands', 'Zeeuwse meren, Netherlands',
+                   'Zuid-Holland, Netherlands', 'Drenthe, Netherlands', 'Flevoland, Netherlands',
+                   'Friesland, Netherlands', 'Gelderland, Netherlands', 'Groningen, Netherlands',
+                   'IJsselmeer, Netherlands', 'Limburg, Netherlands', 'Noord-Holland, Netherlands',
+                   'Overijssel, Netherlands', 'Utrecht, Netherlands', 'Netherlands']
+    # seconds between checks for a newer generation of the table
+    check_interval = int(os.getenv('CBA_DEFAULTS_CHECK_INTERVAL', 300))
+
+    # In-memory map, shared by every request served by this worker
+    _units = None  # uniqueName -> row
+    _prot = None  # [unit, scenario, flood, subsidence] -> existing protection
+    _costs = None  # [unit] -> estimated costs
+    _generated_at = None
+    _checked_at = 0
+
+    @classmethod
+    def _engine(cls):
+        return sqlalchemy.create_engine(os.getenv('POSTGRES_URL'))
+
+    @classmethod
+    def _prot_query(cls, metadata, flood, geogunit_type, sub_abb):
+        """One row per unit and scenario with the protection standard of a precalc_agg table"""
+        precalc = 'precalc_agg_{0}_{1}_{2}'.format(flood, geogunit_type, sub_abb)
+        if precalc not in metadata.tables:
+            return None
+        columns = metadata.tables[precalc].columns.keys()
+        values = []
+        for scen_abb in cls.scen_abbs:
+            col_prot = 'urban_damage_v2_2010_{0}_prot_avg'.format(scen_abb)
+            values.append("('{0}', {1})".format(scen_abb, 'p.' + col_prot if col_prot in columns else 'NULL'))
+        return ("SELECT m.uniquename AS unit, '{0}' AS flood, '{1}' AS sub_abb, v.scen_abb, "
+                "trunc(v.prot)::integer AS existing_prot "
+                "FROM lookup_master m JOIN {2} p ON p.id = m.name "
+                "CROSS JOIN LATERAL (VALUES {3}) v(scen_abb, prot) "
+                "WHERE lower(m.type) = '{4}'").format(flood, sub_abb, precalc, ', '.join(values), geogunit_type)
+
+    @classmethod
+    def generate(cls):
+        """Computes the defaults of every unit, for every scenario, flood and subsidence option"""
+        engine = cls._engine()
+        try:
+            metadata = sqlalchemy.MetaData(bind=engine)
+            metadata.reflect(engine)
+            start = time.time()
+            geogunit_types = pd.read_sql_query("SELECT DISTINCT lower(type) AS type FROM lookup_master",
+                                               engine)['type'].tolist()
+            prot_queries = [cls._prot_query(metadata, flood, geogunit_type, sub_abb)
+                            for flood in cls.floods for geogunit_type in geogunit_types for sub_abb in cls.sub_abbs]
+            prot_queries = [query for query in prot_queries if query]
+            if not prot_queries:
+                raise Error('no precalc_agg tables found')
+
+            def values(options):
+                return ', '.join("('{0}')".format(option) for option in options)
+
+            # Every combination gets a row; units without precalculated protection default to 0
+            tmp_name = cls.table_name + '_tmp'
+            create = """
+                CREATE TABLE {0} AS
+                WITH costs AS (
+                    SELECT m.uniquename AS unit, m.name, avg(c.construction_cost_index*7) AS estimated_costs
+                    FROM lookup_master m
+                    LEFT JOIN lookup_construction_factors_geogunit_108 c ON c.fid_aque = ANY(m.fids)
+                    GROUP BY m.uniquename, m.name
+                ), prots AS (
+                    {1}
+                ), combos AS (
+                    SELECT * FROM (VALUES {2}) s(scen_abb)
+                    CROSS JOIN (VALUES {3}) f(flood)
+                    CROSS JOIN (VALUES {4}) b(sub_abb)
+                )
+                SELECT costs.unit, combos.scen_abb, combos.flood, combos.sub_abb,
+                       CASE WHEN costs.name IN ({5}) THEN 1000
+                            ELSE coalesce(prots.existing_prot, 0) END AS existing_prot,
+                       costs.estimated_costs, now() AS generated_at
+                FROM costs
+                CROSS JOIN combos
+                LEFT JOIN prots ON prots.unit = costs.unit AND prots.scen_abb = combos.scen_abb
+                                   AND prots.flood = combos.flood AND prots.sub_abb = combos.sub_abb
+            """.format(tmp_name, ' UNION ALL '.join(prot_queries), values(cls.scen_abbs), values(cls.floods),
+                       values(cls.sub_abbs), ', '.join("'{0}'".format(name) for name in cls.netherlands))
+
+            # Swap the new generation in, so readers never see a half written table
+            with engine.begin() as conn:
+                conn.execute('DROP TABLE IF EXISTS {0}'.format(tmp_name))
+                conn.execute(create)
+                conn.execute('DROP TABLE IF EXISTS {0}'.format(cls.table_name))
+                conn.execute('ALTER TABLE {0} RENAME TO {1}'.format(tmp_name, cls.table_name))
+            logging.info(f'[CBADefaultsTable, generate]: done in {time.time() - start} seconds')
+        finally:
+            engine.dispose()
+        cls.load()
+
+    @classmethod
+    def load(cls):
+        """Loads the generated table into the in-memory map. Leaves the map empty if the table does not exist"""
+        cls._checked_at = time.time()
+        engine = cls._engine()
+        try:
+            if cls.table_name not in sqlalchemy.inspect(engine).get_table_names():
+                logging.info('[CBADefaultsTable, load]: defaults table not generated yet')
+                return
+            df = pd.read_sql_query("SELECT * FROM {0}".format(cls.table_name), engine)
+        finally:
+            engine.dispose()
+
+        units = pd.Index(df['unit'].unique())
+        scen_idx = pd.Index(cls.scen_abbs).get_indexer(df['scen_abb'])
+        flood_idx = pd.Index(cls.floods).get_indexer(df['flood'])
+        sub_idx = pd.Index(cls.sub_abbs).get_indexer(df['sub_abb'])
+        unit_idx = units.get_indexer(df['unit'])
+
+        prot = np.zeros((len(units), len(cls.scen_abbs), len(cls.floods), len(cls.sub_abbs)), dtype=np.int16)
+        prot[unit_idx, scen_idx, flood_idx, sub_idx] = df['existing_prot'].values
+        costs = np.full(len(units), np.nan)
+        costs[unit_idx] = df['estimated_costs'].astype(float).values
+
+        cls._units = dict(zip(units, range(len(units))))
+        cls._prot, cls._costs = prot, costs
+        cls._generated_at = df['generated_at'].max() if len(df) else None
+        logging.info(f'[CBADefaultsTable, load]: {len(units)} units loaded')
+
+    @classmethod
+    def _refresh_if_stale(cls):
+        if time.time() - cls._checked_at < cls.check_interval:
+            return
+        cls._checked_at = time.time()
+        try:
+            if cls._units is not None:
+                engine = cls._engine()
+                try:
+                    generated_at = pd.read_sql_query(
+                        "SELECT max(generated_at) FROM {0}".format(cls.table_name), engine).values[0][0]
+                finally:
+                    engine.dispose()
+                if pd.Timestamp(generated_at) == pd.Timestamp(cls._generated_at):
+                    return
+            cls.load()
+        except Exception as e:
+            logging.error('[CBADefaultsTable, _refresh_if_stale]: ' + str(e))
+
+    @classmethod
+    def lookup(cls, params):
+        """Returns the /cba/default data for the params, or None if the unit is not in the map"""
+        cls._refresh_if_stale()
+        if not cls._units:
+            return None
+        unit = cls._units.get(params.get("geogunit_unique_name"))
+        scenario = CBADef.scenarios.get(params.get("scenario"))
+        if unit is None or scenario is None:
+            return None
+        prot_val = int(cls._prot[unit,
+                                 cls.scen_abbs.index(scenario[2]),
+                                 cls.floods.index(params.get("flood", "riverine")),
+                                 1 if params.get("sub_scenario") else 0])
+        prot_round = int(cls.rps[np.where(cls.rps >= prot_val)][0])
+        costs = cls._costs[unit]
+        return [{
+            "existing_prot": prot_val,
+            "existing_prot_r": prot_round,
+            "prot_fut": prot_round,
+            "estimated_costs": None if np.isnan(costs) else float(costs)
+        }]
+
+
 class CBADefaultService(object):
     """
     this will have the next methods:
@@ -186,3 +366,9 @@ class CBADefaultService(object):
         except Exception as e:
             logging.error('[CBADCache, _createTable]: ' + str(e))
             raise Error(str(e))
+
+
+# Regenerate the precomputed defaults after a data refresh:
+# python -m aqueduct.services.cba_defaults_service
+if __name__ == '__main__':
+    CBADefaultsTable.generate()
@@ -2,6 +2,7 @@ import datetime
 import logging
 import os
 import sys, traceback
+from functools import cached_property
 
 
 import numpy as np
@@ -9,10 +10,12 @@ import pandas as pd
 import sqlalchemy
 from flask import json
 from scipy.interpolate import interp1d
-from sqlalchemy import Column, Integer, Text, DateTime
+from sqlalchemy import Column, Integer, Text, DateTime, LargeBinary
 from sqlalchemy.dialects.postgresql import JSON
 
 from aqueduct.errors import Error
+from aqueduct.utils.frame_codec import decode_frame, encode_frame
+from aqueduct.utils.interpolation import interp_extrap1d
 
 
 class CBAService(object):
@@ -196,8 +199,7 @@ class CBAService(object):
         diff_pop = np.where(annual_pop_pres - annual_pop_fut < 0, 0, annual_pop_pres - annual_pop_fut) # difference is the potential yearly benefit
         diff_gdp = np.where(annual_gdp_pres - annual_gdp_fut < 0, 0, annual_gdp_pres - annual_gdp_fut) # difference is the potential yearly benefit
 
-        relative_benefit = np.maximum(
-            np.minimum(self.extrap1d(interp1d(list(self.benefit_increase), [0., 1.]))(self.time_series), 1.), 0.)
+        relative_benefit = np.clip(interp_extrap1d(list(self.benefit_increase), [0., 1.], self.time_series), 0., 1.)
         urb_benefits = relative_benefit * diff_urb
         pop_benefits = relative_benefit * diff_pop
         gdp_benefits = relative_benefit * diff_gdp
@@ -267,31 +269,6 @@ class CBAService(object):
         f = interp1d(x, y, fill_value=(y.min(), y.max()), bounds_error=False)
         return f(x_i)
 
-    @staticmethod
-    def extrap1d(interpolator):
-        """
-        Purpose: Make an extrapolation function
-        """
-        #logging.debug('[CBA, extrap1d]: start')
-        xs = interpolator.x
-        ys = interpolator.y
-
-        def pointwise(x):
-            # If new prob is smaller than smallest prob in function
-            if x < xs[0]:
-                return ys[0] + (x - xs[0]) * (ys[1] - ys[0]) / (xs[1] - xs[0])
-            # If new prob is larger than largest prob in function
-            elif x > xs[-1]:
-                return ys[-1] + (x - xs[-1]) * (ys[-1] - ys[-2]) / (xs[-1] - xs[-2])
-            # If prob falls within set range of prob in function
-            else:
-                return interpolator(x)
-
-        def ufunclike(xs):
-            return np.fromiter(map(pointwise, np.array(xs)), dtype=np.float)
-
-        return ufunclike
-
     def compute_rp_change(self, rps, ref_impact, target_impact, rp, min_rp=2, max_rp=1000):
         """
         Purpose: Compute how return period protection changes from one impact
@@ -460,19 +437,10 @@ class CBAService(object):
             # prot_levels.append(prot_trans[0])
         # Interpolate annual expected risk to get estimate for every year in time series
         # print prot_levels
-        risk_func = interp1d(self.years, risk_prot, kind='linear', bounds_error=False,
-                             fill_value='extrapolate')  # define interpolation function/relationship
-        pop_func = interp1d(self.years, pop_impact, kind='linear', bounds_error=False,
-                            fill_value='extrapolate')  # define interpolation function/relationship
-        gdp_func = interp1d(self.years, gdp_impact, kind='linear', bounds_error=False,
-                            fill_value='extrapolate')  # define interpolation function/relationship
-        # prot_func = extrap1d(interp1d(years, prot_levels))
-
-        annual_risk = risk_func(self.time_series)  # Run timeseries through interpolation function
-        annual_pop = pop_func(self.time_series)  # Run timeseries through interpolation function
-        annual_gdp = gdp_func(self.time_series)  # Run timeseries through interpolation function
-        # annual_prot = prot_func(time_series)
-        return annual_risk, annual_pop, annual_gdp  # , annual_prot
+        # Run timeseries through the interpolation of the three curves at once
+        annual_risk, annual_pop, annual_gdp = interp_extrap1d(self.years, [risk_prot, pop_impact, gdp_impact],
+                                                              self.time_series)
+        return annual_risk, annual_pop, annual_gdp
 
     def calc_impact(self, m, pt, ptid):
         """this can be improved with threads and is where the leak happens, a more ammount of fids, the runtime increases"""
@@ -527,19 +495,9 @@ class CBAService(object):
                                                         ("urban_damage" in col) and (self.scen_abb.lower() in col)
                                                         and ("prot_avg" in col)]]
 
-        risk_func = interp1d(self.years, urb_imp, kind='linear', bounds_error=False,
-                             fill_value='extrapolate')  # define interpolation function/relationship
-        pop_func = interp1d(self.years, pop_imp, kind='linear', bounds_error=False,
-                            fill_value='extrapolate')  # define interpolation function/relationship
-        gdp_func = interp1d(self.years, gdp_imp, kind='linear', bounds_error=False,
-                            fill_value='extrapolate')  # define interpolation function/relationship
-        prot_func = interp1d(self.years, prot_imp, kind='linear', bounds_error=False,
-                             fill_value='extrapolate')  # define interpolation function/relationship
-
-        annual_risk = risk_func(self.time_series)  # Run timeseries through interpolation function
-        annual_pop = pop_func(self.time_series)  # Run timeseries through interpolation function
-        annual_gdp = gdp_func(self.time_series)  # Run timeseries through interpolation function
-        annual_prot = prot_func(self.time_series)  # Run timeseries through interpolation function
+        # Run timeseries through the interpolation of the four curves at once
+        annual_risk, annual_pop, annual_gdp, annual_prot = interp_extrap1d(
+            self.years, [urb_imp.values, pop_imp.values, gdp_imp.values, prot_imp.values], self.time_series)
 
         return annual_risk, annual_pop, annual_gdp, annual_prot
 
@@ -602,8 +560,8 @@ class CBAService(object):
                     prot_pres_list = []
                     for y in self.ys:
                         prot_pres_list.append(self.average_prot(m, y, annual_risk_pres))
-                    prot_func_pres = self.extrap1d(interp1d(self.years, prot_pres_list))
-                    annual_prot_pres = prot_func_pres(self.time_series)  # Run timeseries through interpolation function
+                    # Run timeseries through interpolation function
+                    annual_prot_pres = interp_extrap1d(self.years, prot_pres_list, self.time_series)
                 # logging.debug( m, "present done", time.time() - start_time)
 
                 # start_time = time.time()
@@ -616,9 +574,8 @@ class CBAService(object):
                 logging.debug(f'[CBA, {annual_risk_fut}]')
                 prot_fut_list = [self.average_prot(m, y, annual_risk_fut) for y in self.ys]
                 logging.debug( "------------------   CALC4  ---------------" )
-                prot_func_fut = self.extrap1d(interp1d(self.years, prot_fut_list))
                 logging.debug( "------------------   CALC5  ---------------" )
-                annual_prot_fut = prot_func_fut(self.time_series)  # Run timeseries through interpolation function
+                annual_prot_fut = interp_extrap1d(self.years, prot_fut_list, self.time_series)  # Run timeseries through interpolation function
 
                 # logging.debug( m, "future  done", time.time() - start_time)
 
@@ -711,6 +668,7 @@ class CBAICache(object):
                                        Column('id', Integer, primary_key=True, unique=True),
                                        Column('key', Text, unique=True, index=True),
                                        Column('value', JSON),
+                                       Column('frame', LargeBinary),
                                        Column('last_updated', DateTime, default=datetime.datetime.now,
                                               onupdate=datetime.datetime.now)
                                        )
@@ -720,6 +678,19 @@ class CBAICache(object):
             raise Error(message='cache table creation failed'+ str(e))
         return myCache
 
+    def _addFrameColumn(self):
+        """Tables created before the binary frames were introduced only have the json value"""
+        if 'frame' in self.metadata.tables['cache_cba'].columns:
+            return
+        try:
+            conn = self.engine.connect()
+            conn.execute('ALTER TABLE cache_cba ADD COLUMN IF NOT EXISTS frame bytea')
+            self.metadata.remove(self.metadata.tables['cache_cba'])
+            self.metadata.reflect(self.engine, only=['cache_cba'])
+        except Exception as e:
+            logging.error('[CBAICache, _addFrameColumn]: ' + str(e))
+            raise Error(message='cache table migration failed' + str(e))
+
     def checkParams(self):
         try:
             table = self.metadata.tables['cache_cba']
@@ -734,13 +705,14 @@ class CBAICache(object):
             logging.error('[CBAICache, checkParams]: ' + str(e))
             raise Error(message='Checked params failed' + str(e))
 
-    def insertRecord(self, key, data):
+    def insertRecord(self, key, data, frame=None):
         # insert data via insert() construct
         try:
             table = self.metadata.tables['cache_cba']
             ins = table.insert().values(
                 key=key,
-                value=data)
+                value=data,
+                frame=frame)
             conn = self.engine.connect()
             conn.execute(ins)
 
@@ -769,26 +741,27 @@ class CBAICache(object):
             logging.info('[CBAICache]: Getting cba default...')
             if 'cache_cba' in inspector.get_table_names():
                 # It means we have the cache table, we will need to check the params
+                self._addFrameColumn()
                 checks = self.checkParams()
                 if checks != None:
                     logging.info('[CBAICache]: table available; extracting data')
-                    data = json.loads(checks[2])
-                    logging.info(data.keys())
+                    data = json.loads(checks['value'])
+                    if checks['frame'] is not None:
+                        return {'meta': data['meta'], 'df': decode_frame(checks['frame'])}
+                    # rows cached before the binary frames
                     return {'meta': data['meta'], 'df': pd.DataFrame(data['data']).set_index(
                         'year')}  # we will give back the data in a way CBAEndService can use it
 
                 else:  # we will execute the whole process and we will generate the output in a way  CBAEndService can use it
                     logging.info('[CBAICache]: data not available; generating data')
                     data_output = CBAService(self.params).analyze()
-                    data = json.dumps(
-                        {'meta': data_output['meta'], 'data': data_output['df'].reset_index().to_dict('records')},
-                        ignore_nan=True)
+                    data = json.dumps({'meta': data_output['meta']}, ignore_nan=True)
                     key = self._generateKey
-                    self.insertRecord(key, data)
+                    self.insertRecord(key, data, encode_frame(data_output['df']))
                     return data_output  # we will give back the data in a way CBAEndService can use it
             else:
                 self._createTable()
-                self.execute()
+                return self.execute()
                 # executes the cba code to get the table, inserts it into the database and we should be ready to go
         except Exception as e:
             logging.error('[CBAICache, execute]: ')
@@ -800,6 +773,8 @@ class CBAICache(object):
 
 
 class CBAEndService(object):
+    widgets = ['table', 'annual_costs', 'net_benefits', 'impl_cost', 'mainteinance', 'flood_prot', 'export']
+
     def __init__(self, user_selections):
         # self.data = CBAService(user_selections).analyze()
         self.data = CBAICache(user_selections).execute()
@@ -809,90 +784,92 @@ class CBAEndService(object):
         method = getattr(self, method_name, lambda: "Widget not found")
         return method()
 
-    # @cached_property
+    def get_widgets(self, arguments):
+        """Several widgets from the same cached result; intermediates are computed once"""
+        return [self.get_widget(argument) for argument in arguments]
+
+    def _meta(self, yAxisTitle):
+        # every widget gets its own copy, so several widgets can be built from the same data
+        return dict(self.data['meta'], yAxisTitle=yAxisTitle)
+
+    @cached_property
+    def _years(self):
+        return self.data['df'].index.values
+
+    @cached_property
+    def _benefits_costs(self):
+        return self.data['df'][['urb_benefits_avg', 'gdp_costs_avg']]
+
+    @cached_property
+    def _cumulative(self):
+        return self._benefits_costs.cumsum()
+
     def widget_table(self):
         fOutput = self.data['df'][['urb_benefits_avg', 'gdp_costs_avg', 'pop_benefits_avg', 'gdp_benefits_avg']]
-        cumOut = fOutput.sum()
+        cumOut = self._benefits_costs.sum()
 
         # npv = None
-        avoidedGdp = round(fOutput.loc[self.data['meta']['implementionEnd']:].gdp_benefits_avg.sum())
-        avoidedPop = round(fOutput.loc[self.data['meta']['implementionEnd']:].pop_benefits_avg.sum())
-        bcr = round((cumOut['gdp_costs_avg'] / cumOut['urb_benefits_avg']), 5   )
+        after = fOutput.loc[self.data['meta']['implementionEnd']:]
+        avoidedGdp = round(after.gdp_benefits_avg.sum())
+        avoidedPop = round(after.pop_benefits_avg.sum())
+        bcr = round((cumOut['gdp_costs_avg'] / cumOut['urb_benefits_avg']), 5)
 
-        return {'widgetId': 'table', 'chart_type': 'table', 'meta': self.data['meta'],
+        return {'widgetId': 'table', 'chart_type': 'table', 'meta': dict(self.data['meta']),
                 'data': [{'bcr': bcr, 'avoidedPop': avoidedPop, 'avoidedGdp': avoidedGdp}]}
 
-    # @cached_property
     def widget_annual_costs(self):
         """Urb_Benefits_avg / GDP_Costs_avg"""
-        self.data['meta']["yAxisTitle"] = 'Cost and Benefits ($)'
-        return {'widgetId': 'annual_costs', 'chart_type': 'multi-line', 'meta': self.data['meta'], 'data': pd.melt(
-            self.data['df'].reset_index()[['year', 'urb_benefits_avg', 'gdp_costs_avg']].rename(index=str, columns={
-                "urb_benefits_avg": "Benefits", "gdp_costs_avg": "Costs"}), id_vars=['year'],
-            value_vars=['Benefits', 'Costs'], var_name='c', value_name='value').to_dict('records')}
+        fOutput = self._benefits_costs
+        n = len(self._years)
+        data = pd.DataFrame({'year': np.tile(self._years, 2),
+                             'c': np.repeat(['Benefits', 'Costs'], n),
+                             'value': np.concatenate((fOutput['urb_benefits_avg'].values,
+                                                      fOutput['gdp_costs_avg'].values))})
+        return {'widgetId': 'annual_costs', 'chart_type': 'multi-line', 'meta': self._meta('Cost and Benefits ($)'),
+                'data': data.to_dict('records')}
 
-    # @cached_property
     def widget_net_benefits(self):
         """Urb_Benefits_avg / GDP_Costs_avg --> net cummulative costs"""
-        self.data['meta']["yAxisTitle"] = 'Cumulative Net Benefits ($)'
-        fOutput = self.data['df'][['urb_benefits_avg', 'gdp_costs_avg']].cumsum()
-        fOutput['value'] = fOutput['urb_benefits_avg'] - fOutput['gdp_costs_avg']
+        value = self._cumulative['urb_benefits_avg'].values - self._cumulative['gdp_costs_avg'].values
 
-        return {'widgetId': 'net_benefits', 'chart_type': 'bar', 'meta': self.data['meta'],
-                'data': fOutput.reset_index()[['year', 'value']].to_dict('records')}
+        return {'widgetId': 'net_benefits', 'chart_type': 'bar', 'meta': self._meta('Cumulative Net Benefits ($)'),
+                'data': pd.DataFrame({'year': self._years, 'value': value}).to_dict('records')}
 
-    # @cached_property
     def widget_impl_cost(self):
         """GDP_Costs_avg"""
-        self.data['meta']["yAxisTitle"] = 'Implementation Cost ($)'
-        fOutput = self.data['df'].reset_index()[['year','gdp_costs_avg']]
-        minY = fOutput['year'].min() - 1
-        fOutput['value'] = (fOutput['gdp_costs_avg'] * (1 + self.data['meta']['discount']) ** (
-                fOutput['year'] - minY)) / 10.1
-        fOutput.loc[fOutput['year'] >= self.data['meta']['implementionEnd'], 'value'] = 0
+        meta = self.data['meta']
+        minY = self._years.min() - 1
+        value = (self.data['df']['gdp_costs_avg'].values * (1 + meta['discount']) ** (self._years - minY)) / 10.1
+        value = np.where(self._years >= meta['implementionEnd'], 0, value)
 
-        return {'widgetId': 'impl_cost', 'chart_type': 'bar', 'meta': self.data['meta'],
-                'data': fOutput[['year', 'value']].to_dict('records')}
+        return {'widgetId': 'impl_cost', 'chart_type': 'bar', 'meta': self._meta('Implementation Cost ($)'),
+                'data': pd.DataFrame({'year': self._years, 'value': value}).to_dict('records')}
 
-    # @cached_property
     def widget_mainteinance(self):
-        self.data['meta']["yAxisTitle"] = 'Operation & Mainteinance Cost($)'
-
-        fOutput = self.data['df'][['gdp_costs_avg']]
-
-        impE = self.data['meta']['implementionEnd']
-        impS = self.data['meta']['implementionStart']
-        life = self.data['meta']['infrastructureLifespan']
+        meta = self.data['meta']
+        impE = meta['implementionEnd']
+        impS = meta['implementionStart']
+        life = meta['infrastructureLifespan']
         ## Review this to make it work
-        cost = fOutput.loc[self.data['meta']['implementionEnd']]['gdp_costs_avg'] * ((1 + self.data['meta']['discount']) ** (impE - impS))
-        om_costs = self.data['meta']['om']
+        cost = self.data['df'].loc[impE, 'gdp_costs_avg'] * ((1 + meta['discount']) ** (impE - impS))
         build_years = impE - impS
-        years = list(range(impS, impS + life +1))
-        mp = [1.0 / build_years * cost for i in range(build_years)]
-        cum_costs_present = np.cumsum(mp)
-        mains = cum_costs_present * om_costs
-
-        maintenance = pd.Series(np.concatenate((mains, [mains[-1]] * (impS + life - impE + 1))), index=years)
-        fOutput.insert(1,'costs', maintenance)
-
-        result = fOutput.reset_index()
-        result['value'] = result['costs'] / ((1 + self.data['meta']['discount']) ** (result['year'] - impS + 1))
+        # O&M costs grow with the built share during the implementation and stay flat
+        # until the end of the infrastructure life; no costs outside of it
+        built = np.minimum(self._years - impS + 1, build_years) * (1.0 / build_years * cost)
+        costs = np.where((self._years >= impS) & (self._years <= impS + life), built * meta['om'], np.nan)
+        value = costs / ((1 + meta['discount']) ** (self._years - impS + 1))
 
-        return {'widgetId': 'mainteinance', 'chart_type': 'bar', 'meta': self.data['meta'],
-                'data': result[['year', 'value']].to_dict('records')}
+        return {'widgetId': 'mainteinance', 'chart_type': 'bar', 'meta': self._meta('Operation & Mainteinance Cost($)'),
+                'data': pd.DataFrame({'year': self._years, 'value': value}).to_dict('records')}
 
-    # @cached_property
     def widget_flood_prot(self):
-        self.data['meta']["yAxisTitle"] = 'Protection level (Return period)'
-
-        fOutput = self.data['df'].reset_index()[['year', 'gdp_costs_avg', 'prot_present_avg', 'prot_future_avg']]
-        fn = lambda row: row.prot_present_avg if row.year <= self.data['meta'][
-            "benefitsStart"] else row.prot_future_avg if row.year >= self.data['meta']["implementionEnd"] else None
-        fOutput['value'] = fOutput.apply(fn, axis=1)
+        meta = self.data['meta']
+        df = self.data['df']
+        value = np.where(self._years <= meta["benefitsStart"], df['prot_present_avg'].values,
+                         np.where(self._years >= meta["implementionEnd"], df['prot_future_avg'].values, np.nan))
 
-        return {'widgetId': 'flood_prot', 'chart_type': 'line', 'meta': self.data['meta'],
-                'data': fOutput[['year', 'value']].to_dict('records')}
+        return {'widgetId': 'flood_prot', 'chart_type': 'line', 'meta': self._meta('Protection level (Return period)'),
+                'data': pd.DataFrame({'year': self._years, 'value': value}).to_dict('records')}
 
-    # @cached_property
     def widget_export(self):
-        return {'widgetId': '', 'meta': self.data['meta'], 'data': self.data['df'].reset_index().to_dict('records')}
+        return {'widgetId': '', 'meta': dict(self.data['meta']), 'data': self.data['df'].reset_index().to_dict('records')}
@@ -15,24 +15,64 @@ Test With: curl -v -F 'data=@./aqueduct/services/supply_chain_data/template_supp
 
 import pandas as pd
 import numpy as np
-import geopandas as gpd
-from shapely.geometry import Point
-from thefuzz import process
 import warnings
-import ast
-from itertools import chain
 import time
 import logging
-from os.path import exists
 import os
 import redis
 import json
-import hashlib
+import tempfile
 from urllib.parse import urlparse
 import boto3
 
+try:
+    from aqueduct.services.supply_chain_ingest import read_chunks, sample
+    from aqueduct.services.supply_chain_location_cache import LocationCache
+    from aqueduct.services.supply_chain_metrics import StageSpans, estimate_seconds, throughput
+    from aqueduct.services.supply_chain_queue import JobQueue
+    from aqueduct.services.supply_chain_reference import SupplyChainReference
+    from aqueduct.services.supply_chain_results import (
+        BATCH_SIZE,
+        GzipChunkWriter,
+        columnar,
+        gunzip_stream,
+        gzip_member,
+        records,
+        write_document,
+    )
+    from aqueduct.services.supply_chain_uploads import UploadStore, read_stream, s3_client
+except ImportError:  # supply-chain-worker.py runs with the services folder on the path
+    from supply_chain_ingest import read_chunks, sample
+    from supply_chain_location_cache import LocationCache
+    from supply_chain_metrics import StageSpans, estimate_seconds, throughput
+    from supply_chain_queue import JobQueue
+    from supply_chain_reference import SupplyChainReference
+    from supply_chain_results import (
+        BATCH_SIZE,
+        GzipChunkWriter,
+        columnar,
+        gunzip_stream,
+        gzip_member,
+        records,
+        write_document,
+    )
+    from supply_chain_uploads import UploadStore, read_stream, s3_client
+
 warnings.filterwarnings("ignore")
 
+# Seconds between two writes of the progress of a running job
+PROGRESS_INTERVAL = float(os.environ.get("SUPPLY_CHAIN_PROGRESS_INTERVAL", 0.5))
+# Seconds the results of a job are kept once it is ready. Unfinished jobs expire after an hour
+RESULTS_TTL = int(os.environ.get("SUPPLY_CHAIN_RESULTS_TTL", 24 * 60 * 60))
+# Seconds the result segments are kept once the job is ready, for the clients still reading them
+SEGMENTS_TTL = int(os.environ.get("SUPPLY_CHAIN_SEGMENTS_TTL", 15 * 60))
+# Result segments returned at once
+SEGMENTS_LIMIT = 20
+
+
+class JobCancelled(Exception):
+    pass
+
 
 class FoodSupplyChainService(object):
     # -----------------------
@@ -101,55 +141,92 @@ class FoodSupplyChainService(object):
         "Aquifer ID": "aid",
     }
 
-    def prepare_payload(self, payload):
-        new_payload = {}
-
-        for key in payload:
-            new_key = self.output_lookup.get(key)
-            value = payload[key]
-            if pd.isna(value):
-                value = None
-            if new_key is None:
-                if key.endswith("% Change Required"):
-                    new_key = "pcr"
-                elif key.endswith("Desired Condition"):
-                    new_key = "dc"
-                elif key.endswith("Raw Value"):
-                    new_key = "rv"
-                elif key.endswith("Score"):
-                    new_key = "s"
-                else:
-                    new_key = key
-                new_payload[new_key] = value
-            else:
-                new_payload[new_key] = value
-        return new_payload
+    # label columns integer-coded in the columnar results format
+    coded_keys = {"cn", "cy", "e", "mt", "ru", "s", "st"}
+
+    results_formats = ("records", "columnar")
+
+    # columns of every indicator, "<indicator> <column>"
+    indicator_keys = {
+        "% Change Required": "pcr",
+        "Desired Condition": "dc",
+        "Raw Value": "rv",
+        "Score": "s",
+    }
+
+    indicators_list = ("bws", "bwd", "cep", "udw", "usa", "gtd")
+
+    # water unit: (column of the results, section of the multi-indicator results)
+    water_unit_names = {
+        "PFAF_ID": ("Watershed ID", "watersheds"),
+        "AQID": ("Aquifer ID", "aquifers"),
+    }
+
+    def payload_key(self, column, prefixed=False):
+        """
+        :param prefixed: keep the indicator of the indicator columns, e.g. bws_rv instead of rv
+        """
+        key = self.output_lookup.get(column)
+        if key is None:
+            for suffix, short in self.indicator_keys.items():
+                if column.endswith(suffix):
+                    indicator = column[: -len(suffix)].strip()
+                    return "{}_{}".format(indicator, short) if prefixed else short
+            key = column
+        return key
+
+    def payload_frame(self, df, prefixed=False):
+        """df with the abbreviated payload keys as column names"""
+        frame = df.rename(columns=lambda column: self.payload_key(column, prefixed))
+        return frame.loc[:, ~frame.columns.duplicated(keep="last")]
+
+    def payload_coded_keys(self):
+        """coded_keys, with the scores of every indicator of a multi-indicator job"""
+        if not self.indicators:
+            return self.coded_keys
+        return self.coded_keys | {"{}_s".format(indicator) for indicator in self.indicators}
+
+    @staticmethod
+    def water_unit(indicator):
+        if indicator == "gtd":  # Groundwater Table Decline
+            return "AQID"
+        return "PFAF_ID"
 
     def __init__(
-        self, user_input=None, user_indicator=None, user_threshold=None, job_token=None
+        self,
+        user_input=None,
+        user_indicator=None,
+        user_threshold=None,
+        job_token=None,
+        results_format="records",
+        indicators=None,
+        upload=None,
+        tenant=None,
+        upload_sample=None,
     ):
         self.analysis_time = time.time()
         # Inputs from User
         self.user_input = user_input  # Uploaded file
+        self.upload = upload  # md5 of the upload, in the UploadStore
+        # (first rows, estimated rows) of the upload, see supply_chain_ingest.sample
+        self.upload_sample = upload_sample
         self.user_indicator = (
             user_indicator  # Indicator Selection (from blue panel on tool)
         )
         self.user_threshold = (
             user_threshold  # Desired State thresholds (from blue panel on tool)
         )
+        # {indicator: threshold} of a multi-indicator job, instead of user_indicator and user_threshold
+        self.indicators = indicators
         self.job_token = job_token
-
-        # -----------
-        # INPUT FILES
-        # ----------
-        self.croplist_path = "aqueduct/services/supply_chain_data/inputs_ifpri_croplist.csv"  # Full crop names and SPAM_code ID
-        self.adm_path = "aqueduct/services/supply_chain_data/inputs_admin_names.csv"  # GADM v3.6 Administative names for levels 1 & 0
-
-        # Aqueduct geospatial data. Replace with Carto
-        self.aq_path = "aqueduct/services/supply_chain_data/inputs_aqueduct30.csv"
-
-        # INDICATOR SPECIFIC GEOMETRY (WATERSHEDS OR AQUIFERS)
-        self.hybas_path = "aqueduct/services/supply_chain_data/Aqueduct30_{}.shp".format
+        self.tenant = tenant  # who submits the job, queued jobs are shared fairly between tenants
+        self.results_format = results_format  # see results_formats
+        self.chunk_progress = None
+        # job fields waiting to be written with the next update_job
+        self.pending = {}
+        self.last_update = 0
+        self.results_chunks = 0
+        self.spans = StageSpans()  # timings of the stages of the job
 
         self.bucket = os.environ.get("S3_BUCKET_NAME")
 
@@ -167,32 +244,107 @@ class FoodSupplyChainService(object):
             raise Exception("You must specify a redis url in the environment")
 
     def enqueue(self):
-        content = open(
-            self.user_input, mode="rb"
-        ).read()  # ', encoding='ascii-8bit').read()
-        md5sum = hashlib.md5(content).hexdigest()
-        self.job_token = "-".join(
-            [md5sum, self.user_indicator, str(self.user_threshold)]
-        )
-        logging.info("redis key is {}".format(self.job_token))
-
-        self.redis.hmset(
-            self.job_token,
-            {
+        if self.upload is None:
+            store = UploadStore()
+            with open(self.user_input, mode="rb") as f:
+                self.upload = store.put(
+                    read_stream(f),
+                    inspect=lambda upload: sample(upload, store.size, store.lines),
+                )
+            self.upload_sample = store.inspected
+        md5sum = self.upload
+        if self.indicators:
+            selection = {"indicators": json.dumps(self.indicators)}
+            parts = [md5sum] + [
+                "{}-{}".format(indicator, threshold)
+                for indicator, threshold in self.indicators.items()
+            ]
+        else:
+            selection = {
                 "user_indicator": self.user_indicator,
                 "user_threshold": self.user_threshold,
-                "content": content,
-                "status": "enqueued",
-                "percent_complete": 5,
-                "results": json.dumps({}),
-            },
+            }
+            parts = [md5sum, self.user_indicator, str(self.user_threshold)]
+        self.job_token = "-".join(parts)
+        if self.results_format != "records":
+            self.job_token += "-" + self.results_format
+        logging.info("redis key is {}".format(self.job_token))
+        cost = self.estimate_cost()
+
+        def submit(pipe):
+            # The same upload and selection are already queued, running or done: attach to it
+            status = pipe.hget(self.job_token, "status")
+            if status in self.attached_statuses:
+                logging.info("Attaching to {} job".format(status.decode("utf-8")))
+                return False
+            queued = pipe.sismember(JobQueue.queued, self.job_token)
+            tag = JobQueue.finish_tag(pipe, self.tenant, cost)
+            pipe.multi()
+            pipe.hset(
+                self.job_token,
+                mapping={
+                    **selection,
+                    "upload": self.upload,
+                    "results_format": self.results_format,
+                    "status": "enqueued",
+                    "percent_complete": 5,
+                    "estimated_seconds": round(cost, 1),
+                    "results": json.dumps({}),
+                },
+            )
+            # results of a previous run of the same job
+            pipe.hdel(
+                self.job_token,
+                "results_chunks",
+                "rows_processed",
+                "attempts",
+                "error",
+                "segments",
+                "cancelled",
+            )
+            pipe.delete(self.results_key(), self.segments_key())
+            pipe.expire(self.job_token, 60 * 60)
+            if not queued:
+                JobQueue.push(pipe, self.job_token, cost, tag, self.tenant)
+            return True
+
+        # retried if the job, the queue or the tenant's jobs change while submitting
+        self.redis.transaction(
+            submit,
+            self.job_token,
+            JobQueue.queued,
+            JobQueue.tenants,
+            value_from_callable=True,
         )
-        self.redis.expire(self.job_token, 60 * 60)
-        self.redis.rpush("job_queue", self.job_token)
-        # https://github.com/redis/redis-py
-        # https://redis.io/commands/hmset
         return self.job_token
 
+    def estimate_cost(self):
+        """
+        Estimated seconds of the job, from the rows and the share of point rows of the upload sample, and
+        the throughput of the finished jobs (see supply_chain_metrics.py). Without a sample, the share of
+        point rows of the finished jobs
+        """
+        rates = throughput(self.redis)
+        df, rows = self.upload_sample if self.upload_sample is not None else (pd.DataFrame(), 0)
+        try:
+            point_share = (self.find_selection_type(df) == "point").mean() if len(df) else rates["point_share"]
+        except KeyError as e:
+            # the worker reports the missing columns
+            logging.warning("[FoodSupplyChainService]: no point share: {}".format(e))
+            point_share = rates["point_share"]
+        # locations are resolved once per water unit
+        water_units = len(
+            {
+                self.water_unit(indicator)
+                for indicator in (self.indicators or [self.user_indicator])
+            }
+        )
+        rows *= water_units
+        return estimate_seconds(rates, rows, rows * point_share)
+
+    # statuses of a job an identical submission attaches to. Failed jobs are run again
+    attached_statuses = (b"enqueued", b"running", b"ready")
+
     def done(self):
         return self.ready() or self.failed()
 
@@ -205,51 +357,229 @@ class FoodSupplyChainService(object):
     def current_status(self):
         return self.redis.hget(self.job_token, "status").decode("utf-8")
 
-    def results(self):
+    def results_key(self):
+        """Redis list holding the gzip chunks of the results document"""
+        token = self.job_token
+        if isinstance(token, bytes):
+            token = token.decode("utf-8")
+        return "job_results:{}".format(token)
+
+    def segments_key(self):
+        """Redis list of the result segments, one gzip member each (see append_segments)"""
+        token = self.job_token
+        if isinstance(token, bytes):
+            token = token.decode("utf-8")
+        return "job_segments:{}".format(token)
+
+    # job fields of the status payload, read at once
+    status_fields = [
+        "user_indicator",
+        "user_threshold",
+        "indicators",
+        "attempts",
+        "rows_processed",
+        "status",
+        "percent_complete",
+        "results_chunks",
+        "stages",
+        "segments",
+        "estimated_seconds",
+    ]
+
+    def status(self):
+        """The job fields of the results payload, without the results. One round trip to redis"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(self.job_token, self.status_fields)
+        pipe.hexists(self.job_token, "results")
+        JobQueue.read_schedule(pipe)
+        fields, exists, *schedule = pipe.execute()
+        job = dict(zip(self.status_fields, fields))
+        self.results_chunks = int(job["results_chunks"] or 0)
+
         payload = {}
         payload["job_token"] = self.job_token
-        payload["user_indicator"] = self.redis.hget(
-            self.job_token, "user_indicator"
-        ).decode("utf-8")
-        payload["user_threshold"] = float(
-            self.redis.hget(self.job_token, "user_threshold")
-        )
-        payload["queue_length"] = int(self.redis.llen("job_queue"))
+        if not exists:  # unknown or expired job
+            payload["status"] = "invalid-job-token"
+            payload["percent_complete"] = 0
+            return payload
+
+        if job["indicators"]:
+            payload["indicators"] = json.loads(job["indicators"])
+        else:
+            payload["user_indicator"] = job["user_indicator"].decode("utf-8")
+            payload["user_threshold"] = float(job["user_threshold"])
+        payload["queue_length"] = JobQueue.length(schedule)
+        # when a worker should take the job, None once it is not waiting
+        position, start = JobQueue.estimated_start(schedule, self.job_token)
+        payload["queue_position"] = position
+        payload["estimated_start"] = None if start is None else round(start, 1)
+        payload["estimated_seconds"] = float(job["estimated_seconds"] or 0)
+        payload["attempts"] = int(job["attempts"] or 0)
+        payload["rows_processed"] = int(job["rows_processed"] or 0)
+        payload["stages"] = json.loads(job["stages"]) if job["stages"] else {}
+        # partial results readable while the job runs, see stream_segments
+        payload["segments"] = int(job["segments"] or 0)
+        payload["status"] = job["status"].decode("utf-8")
+        payload["percent_complete"] = int(job["percent_complete"])
 
-        results = self.redis.hget(self.job_token, "results")
+        return payload
 
-        if results:
-            payload["results"] = json.loads(results)
-            payload["status"] = self.current_status()
-            # payload['base64_encoded_results'] = False
-            # payload['gzip_compressed_results'] = False
+    def result_chunks(self):
+        """The stored gzip chunks of the results document (see status), fetched one at a time"""
+        for index in range(self.results_chunks):
+            chunk = self.redis.lindex(self.results_key(), index)
+            if chunk is None:
+                raise Exception("Results of {} expired".format(self.job_token))
+            yield chunk
 
-            # if len(payload['results']) > 9500000:
-            #     payload['base64_encoded_results'] = True
-            #     payload['gzip_compressed_results'] = True
-            #     compressed = bz2.BZ2Compressor().compress(payload['results'])
-            #     encoded = base64.b64encode(compressed)
-            #     payload['results'] = encoded
+    def results(self):
+        payload = self.status()
 
-            payload["percent_complete"] = int(
-                self.redis.hget(self.job_token, "percent_complete")
-            )
+        if self.results_chunks:
+            payload["results"] = json.loads(b"".join(gunzip_stream(self.result_chunks())))
         else:
-            payload["results"] = {}
-            payload["status"] = "invalid-job-token"
-            payload["percent_complete"] = 0
+            results = self.redis.hget(self.job_token, "results")
+            payload["results"] = json.loads(results) if results else {}
 
         return payload
 
-    def set_percent_complete(self, pct):
-        self.redis.hset(self.job_token, "percent_complete", pct)
+    def stream_results(self):
+        """
+        The results payload as a gzip stream. The stored chunks are sent as they are, between a
+        gzip member with the job fields and one closing the document
+        """
+        payload = self.status()
+        if not self.results_chunks:
+            results = self.redis.hget(self.job_token, "results")
+            payload["results"] = json.loads(results) if results else {}
+            yield gzip_member(json.dumps(payload))
+            return
+
+        yield gzip_member(json.dumps(payload)[:-1] + ', "results": ')
+        yield from self.result_chunks()
+        yield gzip_member("}")
+
+    def stream_segments(self, cursor=0, limit=SEGMENTS_LIMIT):
+        """
+        The result segments from cursor on, as a gzip stream: the job fields, "cursor" to pass for the next
+        segments and "results", the partial results documents ({"<section>": records}) of the rows matched
+        so far. Their sections concatenated in order give the sections of the results
+        :param cursor: segments already read
+        :param limit: segments returned at most
+        """
+        payload = self.status()
+        segments = self.redis.lrange(self.segments_key(), cursor, cursor + limit - 1)
+        payload["cursor"] = cursor + len(segments)
+        yield gzip_member(json.dumps(payload)[:-1] + ', "results": [')
+        for position, segment in enumerate(segments):
+            if position:
+                yield gzip_member(", ")
+            yield segment
+        yield gzip_member("]}")
+
+    def cancel(self):
+        """
+        Stops the job. A waiting job is taken out of the queue, a running one stops after its current chunk
+        of rows (see check_cancelled)
+        :return: False if the job is already over
+        """
+
+        def stop(pipe):
+            status = pipe.hget(self.job_token, "status")
+            if status not in (b"enqueued", b"running"):
+                return False
+            pipe.multi()
+            # also seen by a worker popping the job meanwhile
+            pipe.hset(self.job_token, "cancelled", 1)
+            if status == b"enqueued":
+                JobQueue.remove(pipe, self.job_token)
+                pipe.hset(self.job_token, "status", "cancelled")
+                pipe.publish(
+                    JobQueue.events(self.job_token), json.dumps({"status": "cancelled"})
+                )
+            return True
+
+        return self.redis.transaction(stop, self.job_token, value_from_callable=True)
+
+    def check_cancelled(self):
+        if self.redis.hexists(self.job_token, "cancelled"):
+            raise JobCancelled()
+
+    def events(self, timeout=600, keepalive=15):
+        """
+        Progress of the job as it runs: the current status, then every update published by the
+        worker, until the job is over or timeout seconds passed. None every keepalive seconds
+        without updates
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # subscribed before reading the status, so no update is missed
+        pubsub.subscribe(JobQueue.events(self.job_token))
+        try:
+            status = self.status()
+            yield {key: status[key] for key in JobQueue.event_fields if key in status}
+            if status["status"] in JobQueue.final_statuses + ("invalid-job-token",):
+                return
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                message = pubsub.get_message(timeout=min(keepalive, max(deadline - time.time(), 0)))
+                if message is None:
+                    if not self.redis.exists(self.job_token):
+                        return
+                    yield None
+                    continue
+                event = json.loads(message["data"])
+                yield event
+                if event.get("status") in JobQueue.final_statuses:
+                    return
+        finally:
+            pubsub.close()
 
-    def pop_and_do_work():
+    def set_percent_complete(self, pct):
+        if self.chunk_progress is not None:
+            # steps of the location matching (10-75%), scaled to the chunk being read
+            start, end = self.chunk_progress
+            pct = int(start + (end - start) * (min(max(pct, 10), 75) - 10) / 65)
+        self.pending["percent_complete"] = pct
+        # progress is written at most every PROGRESS_INTERVAL seconds
+        if time.time() - self.last_update >= PROGRESS_INTERVAL:
+            self.update_job()
+
+    def update_job(self, ttl=None, **fields):
+        """
+        Writes the job fields, with the pending progress, and publishes them to the job's
+        events channel, in a single round trip
+        :param ttl: new expiry of the job and its results, in seconds
+        """
+        fields = dict(self.pending, **fields)
+        self.pending = {}
+        self.last_update = time.time()
+        if not fields:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.job_token, mapping=fields)
+        event = {key: fields[key] for key in JobQueue.event_fields if key in fields}
+        if event:
+            pipe.publish(JobQueue.events(self.job_token), json.dumps(event))
+        if ttl is not None:
+            pipe.expire(self.job_token, ttl)
+            pipe.expire(self.results_key(), ttl)
+        pipe.execute()
+
+    def pop_and_do_work(timeout=5):
+        """Waits up to timeout seconds for a job (0 blocks until there is one) and runs it"""
         service = FoodSupplyChainService()
-        service.job_token = service.redis.rpop("job_queue")
-        if service.job_token:
+        queue = JobQueue(service.redis)
+        queue.requeue_stale()
+        service.job_token = queue.pop(timeout)
+        if service.job_token and not service.redis.exists(service.job_token):
+            logging.info("Job {} expired while waiting".format(service.job_token))
+            queue.ack(service.job_token)
+        elif service.job_token:
             logging.info("Working on job {}".format(service.job_token))
-            service.run()
+            try:
+                service.run()
+            finally:
+                queue.ack(service.job_token)
 
     def run(self):
         try:
@@ -259,413 +589,529 @@ class FoodSupplyChainService(object):
             # message = "Excel file {} is {} bytes. First bytes are {}".format(self.user_input, b, first_bytes)
             # raise Exception(message)
 
-            self.user_indicator = self.redis.hget(
-                self.job_token, "user_indicator"
+            indicators = self.redis.hget(self.job_token, "indicators")
+            if indicators:  # multi-indicator job
+                self.indicators = json.loads(indicators)
+            else:
+                self.user_indicator = self.redis.hget(
+                    self.job_token, "user_indicator"
+                ).decode("utf-8")
+                self.user_threshold = float(
+                    self.redis.hget(self.job_token, "user_threshold")
+                )
+            self.results_format = (
+                self.redis.hget(self.job_token, "results_format") or b"records"
             ).decode("utf-8")
-            self.user_threshold = float(
-                self.redis.hget(self.job_token, "user_threshold")
-            )
 
-            content = self.redis.hget(self.job_token, "content")
-            # serialized. Only one at a time.
-            fout = open("data.xlsx", "wb")
-            fout.write(content)
-            fout.close()
+            md5sum = self.redis.hget(self.job_token, "upload").decode("utf-8")
+            content = UploadStore().get(md5sum)
 
-            self.redis.hset(self.job_token, "status", "running")
+            self.check_cancelled()
+            self.update_job(status="running")
             self.set_percent_complete(6)
 
-            df = pd.read_excel("data.xlsx", header=4, index_col=None)
-            self.set_percent_complete(10)
-
-            # Create a row index that matches excel files
-            df["row"] = range(6, len(df) + 6)
-            df.set_index("row", inplace=True)
-
-            # READ IN CARTO INPUTS
-            # Placeholder to read in CARTO AQUEDUCT DATABASE. This will need to update
-            # TDB: df_aq = gpd.read_file(self.aq_path, layer = "annual")
-            df_aq = gpd.read_file(self.aq_path)
-            self.set_percent_complete(15)
-
-            # READ IN STANDARD INPUTS
-            # IFPRI crop names and ID codes
-            self.df_crops = pd.read_csv(self.croplist_path, index_col=0, header=0)
-            self.set_percent_complete(20)
-
-            # Read in GADM Admin 1 and 0 place names (encoding, should retain
-            # non-english characters)
-            self.df_admnames = pd.read_csv(self.adm_path, encoding="utf-8-sig")
-            self.set_percent_complete(25)
-
-            # Make sure lists are lists, not strings
-            self.df_admnames["PFAF_ID"] = self.df_admnames["PFAF_ID"].apply(
-                lambda x: ast.literal_eval(x)
-            )
-            self.df_admnames["AQID"] = self.df_admnames["AQID"].apply(
-                lambda x: ast.literal_eval(x)
-            )
-            self.set_percent_complete(30)
+            # READ IN CARTO INPUTS AND STANDARD INPUTS
+            # Loaded once by the worker, see SupplyChainReference
+            self.reference = SupplyChainReference.current()
+            df_aq = self.reference.aq
+            self.df_crops = self.reference.crops
+            self.df_admnames = self.reference.admnames
 
-            # ----------
-            # CLEAN DATA
-            # ----------
             # TRANSLATE USER SELECTIONS INTO ANALYSIS-READY INPUTS
-            # Aqueduct Indicators
-            # indicator_selection = self.indicator_dict.get(self.user_indicator)
-            # indicator_abb = indicator_selection[0:3].upper()
-            indicator_selection = self.user_indicator + "_raw"
-            indicator_abb = self.user_indicator
+            # Aqueduct Indicators, grouped by water unit: locations are resolved
+            # once per water unit and shared by its indicators
+            water_units = {}
+            for indicator, threshold in (
+                self.indicators or {self.user_indicator: self.user_threshold}
+            ).items():
+                water_units.setdefault(self.water_unit(indicator), {})[
+                    indicator
+                ] = float(threshold)
 
             # Agriculture Irrigation Type (for now, always use all, but building in
             # ability to change in the future)
             self.irrigation_selection = "_a"
 
-            # Crops (for now, use all crops in import file. But leaving the ability
-            # to filter by crop in the future)
-            crop_selection = sorted(self.df_crops["short_name"].tolist())
-            self.set_percent_complete(35)
-
-            # INDICATOR SPECIFIC
-            if self.user_indicator == "gtd":  # Groundwater Table Decline
-                water_unit = "AQID"
-                water_name = "Aquifer ID"
-            else:
-                water_unit = "PFAF_ID"
-                water_name = "Watershed ID"
-
-            # REMOVE POTENTIAL WHITESPACE FROM TEXT FIELDS
-            clean_columns = [
-                "State/Province",
-                "Country",
-                "Radius Unit",
-                "Material Type",
-            ]
-            for c in clean_columns:
-                # import pdb
-                # pdb.set_trace()
-                if str(df[c].dtype) == "object":
-                    df[c] = df[c].str.strip()  # Remove extra whitespaces
-                df[c].replace("None", np.nan, inplace=True)  # Turn "None" into np.nan
-
-            self.set_percent_complete(40)
-
-            # CROP NAME LOOKUP TABLE
+            scored = {}
+            for position, (water_unit, thresholds) in enumerate(water_units.items()):
+                progress = (
+                    10 + 65 * position // len(water_units),
+                    10 + 65 * (position + 1) // len(water_units),
+                )
+
+                def partial(
+                    df_waterunits,
+                    df_errorlog,
+                    water_unit=water_unit,
+                    thresholds=thresholds,
+                    errors=not position,
+                ):
+                    # errors are the same for every water unit, they are sent once
+                    self.append_segments(
+                        water_unit, thresholds, df_waterunits, df_errorlog, errors
+                    )
+
+                df_waterunits, df_errorlog = self.locations(
+                    content, md5sum, water_unit, progress, partial
+                )
+                # Indicator values of the sourcing water units
+                with self.spans.span("score") as span:
+                    users_watersheds = self.indicator_values(
+                        df_aq, water_unit, df_waterunits[water_unit], thresholds
+                    )
+                    span.rows = len(users_watersheds)
+                scored[water_unit] = (df_waterunits, users_watersheds)
+            self.set_percent_complete(95)
 
-            # Create lookup dictionary of crop names to crop IDs using IFPRI
-            # definitions
-            crop_dict = self.df_crops.set_index("full_name")["short_name"].to_dict()
-            self.set_percent_complete(45)
+            # create list of priority watersheds (exceed threshold)
+            # priority_watersheds = list(set(df_successes[water_name][df_successes[change_req] > 0].tolist()))
 
-            # Add alternatives that might appear
-            crop_dict.update(self.crop_fixes)
+            # Errors do not depend on the water unit, they are the ones of the last resolution
+            sections, fields = self.result_sections(scored, df_errorlog)
+            if self.indicators:
+                fields["indicators"] = self.indicators
+            else:
+                fields["indicator"] = self.user_indicator
+            fields["format"] = self.results_format
+            # results['all_waterunits'] = sourcing_watersheds
+            # results['priority_waterunits'] = priority_watersheds
 
-            # Match user crops to IFPRI crops
-            # Create Crop ID using IFPRI crop name lookup dictionary
-            df["SPAM_code"] = df["Material Type"].apply(
-                lambda x: crop_dict.get(x.lower())
+            if self.bucket:
+                self.upload_results(sections, fields)
+            else:
+                self.store_results(sections, fields)
+
+            # Results outlive the job state, see RESULTS_TTL
+            self.update_job(
+                ttl=RESULTS_TTL,
+                status="ready",
+                percent_complete=100,
+                stages=json.dumps(self.spans.summary()),
             )
+            pipe = self.redis.pipeline(transaction=False)
+            # The results replace the segments
+            pipe.expire(self.segments_key(), SEGMENTS_TTL)
+            # Stage histograms across jobs, see supply_chain_metrics.py
+            self.spans.record(pipe, self.job_token, md5sum)
+            pipe.execute()
 
-            # Drop rows without crop IDs
-            self.df_2 = df[df["SPAM_code"].isin(crop_selection)]
-
-            # CREATE ERROR LOG
-            # List of crops that failed
-            self.df_cropfail = df[df["SPAM_code"].isna()]
-            self.df_cropfail["Error"] = "Invalid Material Type"
-            self.df_cropfail.drop(["SPAM_code"], axis=1, inplace=True)
-            self.df_cropfail["row"] = self.df_cropfail.index
-
-            # ----------------------------------
-            # FIND LOCATIONS BASED ON WATER UNIT
-            # ----------------------------------
-            # Categorize location type
-            self.df_2["Select_By"] = self.df_2.apply(
-                lambda x: self.find_selection_type(x), axis=1
+            logging.info(
+                "Analysis Time: {} seconds".format(time.time() - self.analysis_time)
+            )
+        except JobCancelled:
+            logging.info("Job {} cancelled".format(self.job_token))
+            self.update_job(
+                status="cancelled", stages=json.dumps(self.spans.summary())
+            )
+        except Exception as e:
+            # logging.fatal(e.back)
+            self.update_job(
+                status="error",
+                error=str(e),
+                results=json.dumps({"error": str(e)}),
+                stages=json.dumps(self.spans.summary()),
             )
-            self.set_percent_complete(50)
-
-            # CREATE ERROR LOG
-            self.df_locfail = self.df_2[self.df_2["Select_By"].isna()]
-            self.df_locfail["Error"] = "Missing Location"
-            self.df_locfail.drop(["SPAM_code", "Select_By"], axis=1, inplace=True)
-            self.df_locfail["row"] = self.df_locfail.index
-            self.set_percent_complete(55)
 
+    def locations(self, content, md5sum, water_unit, progress=(10, 75), partial=None):
+        """
+        :param progress: percent complete before and after matching the locations
+        :param partial: see resolve_locations. Not called for cached locations
+        :return: see find_locations
+        """
+        # Locations only depend on the file and the water unit, they are shared
+        # by every indicator and threshold run on the same upload
+        location_cache = LocationCache(
+            self.redis, md5sum, water_unit, self.reference.version
+        )
+        cached = location_cache.get()
+        if cached is None:
             loc_time = time.time()
-            df_waterunits, df_errorlog = self.find_locations(water_unit)
+            df_waterunits, df_errorlog = self.resolve_locations(
+                content, water_unit, progress, partial
+            )
             logging.info("Locations ready in {} seconds".format(time.time() - loc_time))
-            loc_time = time.time()
-            self.set_percent_complete(75)
-
-            # --------------
-            # FIND LOCATIONS
-            # --------------
-            # Create formated column names for output
-            raw = "{} Raw Value".format(indicator_abb)
-            score = "{} Score".format(indicator_abb)
-            desired_con = "{} Desired Condition".format(indicator_abb)
-            change_req = "{} % Change Required".format(indicator_abb)
-
-            # Filter Aqueduct data by sourcing watersheds and selected indicator
-            sourcing_watersheds = list(set(df_waterunits[water_unit].tolist()))
-            string_sourcing_watersheds = [str(int(x)) for x in sourcing_watersheds]
-            users_watersheds = df_aq[
-                df_aq[water_unit.lower()].isin(string_sourcing_watersheds)
-            ]
+            location_cache.set(df_waterunits, df_errorlog)
+        else:
+            logging.info("Locations found in cache")
+            df_waterunits, df_errorlog = cached
+        self.set_percent_complete(progress[1])
+        return df_waterunits, df_errorlog
 
-            self.set_percent_complete(78)
+    def indicator_values(self, df_aq, water_unit, basins, thresholds):
+        """
+        Scores every indicator of the water unit at once
+        :param df_aq: Aqueduct indicators
+        :param basins: water units of the matched locations
+        :param thresholds: {indicator: desired condition}
+        :return: raw value, score, desired condition and % change required of every indicator,
+                 one row per water unit
+        """
+        # Filter Aqueduct data by sourcing watersheds and selected indicators
+        string_sourcing_watersheds = [str(int(x)) for x in set(basins)]
+        users_watersheds = df_aq[
+            df_aq[water_unit.lower()].isin(string_sourcing_watersheds)
+        ]
 
-            # Pull raw value and label
-            users_watersheds = users_watersheds.filter(
-                [
-                    water_unit.lower(),
-                    indicator_selection,
-                    indicator_abb.lower() + "_label",
-                ]
-            )
-            self.set_percent_complete(79)
-
-            # rename raw and score columns
-            users_watersheds.rename(
-                columns={
-                    water_unit.lower(): water_unit,
-                    indicator_selection: raw,
-                    indicator_abb.lower() + "_label": score,
-                },
-                inplace=True,
-            )
-            self.set_percent_complete(80)
-
-            # Drop duplicates
-            users_watersheds.drop_duplicates(inplace=True)
-
-            # Create a column to hold threshold
-            users_watersheds[desired_con] = self.user_threshold
-
-            # interact
-            # Calculate change required
-            users_watersheds[raw] = users_watersheds[raw].astype(float)
-            users_watersheds[desired_con] = users_watersheds[desired_con].astype(float)
-            users_watersheds[change_req] = (
-                users_watersheds[raw] - users_watersheds[desired_con]
-            ) / users_watersheds[raw]
-            users_watersheds[change_req] = np.where(
-                users_watersheds[raw] < users_watersheds[desired_con],
-                0,
-                users_watersheds[change_req],
-            )
-            self.set_percent_complete(85)
-
-            # Format columns
-            users_watersheds[raw] = (users_watersheds[raw] * 100).astype(int)
-            users_watersheds[desired_con] = (
-                users_watersheds[desired_con] * 100
-            ).astype(int)
-            users_watersheds[change_req] = (users_watersheds[change_req] * 100).astype(
-                int
-            )
-            self.set_percent_complete(90)
+        # Pull raw values and labels, rename them
+        columns = {water_unit.lower(): water_unit}
+        for indicator in thresholds:
+            columns[indicator + "_raw"] = "{} Raw Value".format(indicator)
+            columns[indicator.lower() + "_label"] = "{} Score".format(indicator)
+        users_watersheds = users_watersheds.filter(list(columns)).rename(
+            columns=columns
+        )
 
-            # Tried this to get rid of NaN values.
-            # users_watersheds[change_req] = np.where(pd.isna(users_watersheds[change_req]), None, users_watersheds[change_req])
+        # Drop duplicates
+        users_watersheds = users_watersheds.drop_duplicates()
 
-            # Merge with user's OG data
-            df_waterunits[water_unit] = df_waterunits[water_unit].astype(int)
-            users_watersheds[water_unit] = users_watersheds[water_unit].astype(int)
-            df_successes = pd.merge(
-                df_waterunits,
-                users_watersheds,
-                how="left",
-                left_on=water_unit,
-                right_on=water_unit,
-            )
-            df_successes.rename(columns={water_unit: water_name}, inplace=True)
-            self.set_percent_complete(95)
+        # interact
+        # Calculate change required, for all indicators at once
+        raw = users_watersheds[
+            ["{} Raw Value".format(indicator) for indicator in thresholds]
+        ].astype(float)
+        raw.columns = list(thresholds)
+        desired = pd.DataFrame(thresholds, index=raw.index, dtype=float)
+        change = ((raw - desired) / raw).mask(raw < desired, 0)
 
-            df_successes["row"] = df_successes["row"].astype(int)
-            if "Watershed ID" in df_successes.columns:
-                df_successes["Watershed ID"] = df_successes["Watershed ID"].astype(int)
+        # Format columns
+        raw, desired, change = [(df * 100).astype(int) for df in [raw, desired, change]]
 
-            # create list of priority watersheds (exceed threshold)
-            # priority_watersheds = list(set(df_successes[water_name][df_successes[change_req] > 0].tolist()))
+        df = pd.DataFrame(
+            {water_unit: users_watersheds[water_unit].astype(int)},
+            index=users_watersheds.index,
+        )
+        for indicator in thresholds:
+            df["{} Raw Value".format(indicator)] = raw[indicator]
+            if "{} Score".format(indicator) in users_watersheds:
+                df["{} Score".format(indicator)] = users_watersheds[
+                    "{} Score".format(indicator)
+                ]
+            df["{} Desired Condition".format(indicator)] = desired[indicator]
+            df["{} % Change Required".format(indicator)] = change[indicator]
+        return df
 
-            results = {}
-            results["locations"] = list(
-                map(self.prepare_payload, df_successes.to_dict("records"))
-            )
-            results["errors"] = list(
-                map(self.prepare_payload, df_errorlog.to_dict("records"))
+    def result_sections(self, scored, df_errorlog):
+        """
+        :param scored: {water unit: (df_waterunits, users_watersheds)}
+        :return: (sections, fields) of the results document, see write_document
+        """
+        # a single indicator has its locations in "locations", with unprefixed keys
+        prefixed = bool(self.indicators)
+        sections, fields = {}, {}
+        for water_unit, (df_waterunits, users_watersheds) in scored.items():
+            water_name, section = self.water_unit_names[water_unit]
+            if not prefixed:
+                section = "locations"
+            if self.results_format == "columnar":
+                df_successes = self.score_locations(
+                    df_waterunits, users_watersheds, water_unit, water_name
+                )
+                fields[section] = columnar(
+                    self.payload_frame(df_successes, prefixed), self.payload_coded_keys()
+                )
+            else:
+                # Scored, serialized and compressed a batch of records at a time
+                sections[section] = self.scored_batches(
+                    df_waterunits, users_watersheds, water_unit, water_name, prefixed
+                )
+        if self.results_format == "columnar":
+            fields["errors"] = columnar(
+                self.payload_frame(df_errorlog), self.payload_coded_keys()
             )
-            results["indicator"] = self.user_indicator
-            # results['all_waterunits'] = sourcing_watersheds
-            # results['priority_waterunits'] = priority_watersheds
+        else:
+            sections["errors"] = self.payload_batches(df_errorlog)
+        return sections, fields
 
-            if self.bucket:
-                self.upload_results(results)
-            else:
-                self.redis.hset(self.job_token, "results", json.dumps(results))
+    def score_locations(self, df_waterunits, users_watersheds, water_unit, water_name):
+        """
+        :param df_waterunits: matched locations, see find_locations
+        :param users_watersheds: indicator values of the water units
+        :return: locations with their indicator values
+        """
+        # Merge with user's OG data
+        df_successes = pd.merge(
+            df_waterunits.astype({water_unit: int}),
+            users_watersheds,
+            how="left",
+            left_on=water_unit,
+            right_on=water_unit,
+        )
+        df_successes.rename(columns={water_unit: water_name}, inplace=True)
 
-            self.redis.hset(self.job_token, "status", "ready")
-            self.set_percent_complete(100)
+        df_successes["row"] = df_successes["row"].astype(int)
+        if "Watershed ID" in df_successes.columns:
+            df_successes["Watershed ID"] = df_successes["Watershed ID"].astype(int)
+        return df_successes
 
-            logging.info(
-                "Analysis Time: {} seconds".format(time.time() - self.analysis_time)
+    def scored_batches(
+        self, df_waterunits, users_watersheds, water_unit, water_name, prefixed=False
+    ):
+        """payload_batches of the scored locations, BATCH_SIZE locations scored at a time"""
+        for start in range(0, len(df_waterunits), BATCH_SIZE):
+            df_successes = self.score_locations(
+                df_waterunits.iloc[start : start + BATCH_SIZE],
+                users_watersheds,
+                water_unit,
+                water_name,
             )
-        except Exception as e:
-            # logging.fatal(e.back)
-            self.redis.hset(self.job_token, "status", "error")
-            self.redis.hset(self.job_token, "results", json.dumps({"error": str(e)}))
+            yield from self.payload_batches(df_successes, prefixed)
 
-    def upload_results(self, results):
-        session = boto3.session.Session()
-        s3 = None
-
-        if os.environ.get("ENDPOINT_URL"):
-            s3 = session.client(
-                service_name="s3",
-                aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-                aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-                endpoint_url=os.environ.get("ENDPOINT_URL"),
+    def payload_batches(self, df, prefixed=False):
+        frame = self.payload_frame(df, prefixed)
+        for start in range(0, len(frame), BATCH_SIZE):
+            yield records(frame.iloc[start : start + BATCH_SIZE])
+
+    def append_segments(self, water_unit, thresholds, df_waterunits, df_errorlog, errors=True):
+        """
+        Scores the locations of a chunk of rows and appends them, with its errors, to the result segments.
+        A segment is a partial results document of a batch of records (or a columnar chunk), stored as a
+        gzip member
+        :param thresholds: {indicator: desired condition} of the water unit
+        :param errors: append the errors of the chunk
+        """
+        with self.spans.span("segments") as span:
+            users_watersheds = self.indicator_values(
+                self.reference.aq, water_unit, df_waterunits[water_unit], thresholds
             )
-        else:
-            s3 = session.client(
-                service_name="s3",
-                aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-                aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
+            sections, fields = self.result_sections(
+                {water_unit: (df_waterunits, users_watersheds)}, df_errorlog
+            )
+            if not errors:
+                sections.pop("errors", None)
+                fields.pop("errors", None)
+            key = self.segments_key()
+            pipe = self.redis.pipeline(transaction=False)
+            for name, batches in sections.items():
+                for batch in batches:
+                    if batch:
+                        pipe.rpush(key, gzip_member(json.dumps({name: batch})))
+            for name, document in fields.items():
+                if document["length"]:
+                    pipe.rpush(key, gzip_member(json.dumps({name: document})))
+            pipe.llen(key)
+            # as the unfinished job
+            pipe.expire(key, 60 * 60)
+            # published with the next progress update
+            self.pending["segments"] = pipe.execute()[-2]
+            span.rows = len(df_waterunits)
+
+    def store_results(self, sections, fields):
+        """Writes the results document to redis as a list of gzip chunks"""
+        key = self.results_key()
+        self.redis.delete(key)
+        writer = GzipChunkWriter(lambda chunk: self.redis.rpush(key, chunk))
+        # records are scored as they are written
+        with self.spans.span("serialize"):
+            write_document(writer, sections, **fields)
+        self.redis.expire(key, RESULTS_TTL)
+        self.pending["results_chunks"] = writer.chunks
+        logging.info(
+            "Stored {} bytes of compressed results in {} chunks".format(
+                writer.size, writer.chunks
             )
+        )
+
+    def upload_results(self, sections, fields):
+        s3 = s3_client()
 
         key = "food-supply-chain/{}".format(self.job_token.decode("utf-8"))
 
-        s3.put_object(Bucket=self.bucket, Key=key, Body=json.dumps(results))
+        # Served with Content-Encoding: gzip, so clients decompress it transparently
+        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as body:
+            with self.spans.span("serialize"):
+                write_document(GzipChunkWriter(body.write), sections, **fields)
+            body.seek(0)
+            with self.spans.span("upload"):
+                s3.upload_fileobj(
+                    body,
+                    self.bucket,
+                    key,
+                    ExtraArgs={
+                        "ContentType": "application/json",
+                        "ContentEncoding": "gzip",
+                    },
+                )
 
         # Generate the URL to get 'key-name' from 'bucket-name'
         s3_url = s3.generate_presigned_url(
             ClientMethod="get_object",
-            ExpiresIn=3600,
+            # valid as long as the job is kept, up to the 7 days S3 allows
+            ExpiresIn=min(RESULTS_TTL, 7 * 24 * 60 * 60),
             Params={"Bucket": self.bucket, "Key": key},
         )
 
-        self.redis.hset(self.job_token, "results", json.dumps({"s3_url": s3_url}))
+        self.pending["results"] = json.dumps({"s3_url": s3_url})
+
+    def resolve_locations(self, content, water_unit, progress=(10, 75), partial=None):
+        """
+        Matches the upload to water units in chunks of rows, so memory does not grow with the file
+        :param content: uploaded file (xlsx template, csv or parquet)
+        :param water_unit: AQID for aquifers or PFAF_ID for watersheds
+        :param progress: percent complete before and after matching the whole file
+        :param partial: called with the results of every chunk (see find_locations), unless the file
+                        is a single chunk
+        :return: see find_locations
+        """
+        located, failed = [], []
+        rows, start, published = 0, progress[0], 0
+        try:
+            chunks = self.spans.iterate("read", read_chunks(content), lambda chunk: len(chunk[0]))
+            for df, fraction in chunks:
+                self.check_cancelled()
+                end = progress[0] + int((progress[1] - progress[0]) * fraction)
+                self.chunk_progress = (start, max(start, end))
+                df_waterunits, df_errorlog = self.resolve_chunk(df, water_unit)
+                located.append(df_waterunits)
+                failed.append(df_errorlog)
+                # the fraction read of csv files is known once they are read, a single chunk waits
+                # for the next one
+                if partial is not None and (fraction < 1 or len(located) > 1):
+                    for chunk in range(published, len(located)):
+                        partial(located[chunk], failed[chunk])
+                    published = len(located)
+                rows += len(df)
+                start = max(start, end)
+                self.pending["rows_processed"] = rows
+                logging.info("{} rows matched".format(rows))
+        finally:
+            self.chunk_progress = None
+
+        if not located:
+            raise ValueError("The uploaded file has no rows")
+        return pd.concat(located), pd.concat(failed)
+
+    def resolve_chunk(self, df, water_unit):
+        """
+        :param df: rows of the upload, indexed by their row number
+        :param water_unit: AQID for aquifers or PFAF_ID for watersheds
+        :return: see find_locations
+        """
+        self.set_percent_complete(10)
+        span = self.spans.start("clean")
+
+        # ----------
+        # CLEAN DATA
+        # ----------
+        # Crops (for now, use all crops in import file. But leaving the ability
+        # to filter by crop in the future)
+        crop_selection = sorted(self.df_crops["short_name"].tolist())
+        self.set_percent_complete(35)
+
+        # REMOVE POTENTIAL WHITESPACE FROM TEXT FIELDS
+        clean_columns = [
+            "State/Province",
+            "Country",
+            "Radius Unit",
+            "Material Type",
+        ]
+        for c in clean_columns:
+            # import pdb
+            # pdb.set_trace()
+            if str(df[c].dtype) == "object":
+                df[c] = df[c].str.strip()  # Remove extra whitespaces
+            df[c].replace("None", np.nan, inplace=True)  # Turn "None" into np.nan
+
+        self.set_percent_complete(40)
+        span.stop(rows=len(df))
+        span = self.spans.start("crop_match")
+
+        # CROP NAME LOOKUP TABLE
+
+        # Create lookup dictionary of crop names to crop IDs using IFPRI
+        # definitions
+        crop_dict = self.df_crops.set_index("full_name")["short_name"].to_dict()
+        self.set_percent_complete(45)
+
+        # Add alternatives that might appear
+        crop_dict.update(self.crop_fixes)
+
+        # Match user crops to IFPRI crops
+        # Create Crop ID using IFPRI crop name lookup dictionary
+        df["SPAM_code"] = df["Material Type"].str.lower().map(crop_dict)
+
+        # Drop rows without crop IDs
+        self.df_2 = df[df["SPAM_code"].isin(crop_selection)]
+
+        # CREATE ERROR LOG
+        # List of crops that failed
+        self.df_cropfail = df[df["SPAM_code"].isna()]
+        self.df_cropfail["Error"] = "Invalid Material Type"
+        self.df_cropfail.drop(["SPAM_code"], axis=1, inplace=True)
+        self.df_cropfail["row"] = self.df_cropfail.index
+        span.stop(rows=len(df))
+        span = self.spans.start("clean")
+
+        # ----------------------------------
+        # FIND LOCATIONS BASED ON WATER UNIT
+        # ----------------------------------
+        # Categorize location type
+        self.df_2["Select_By"] = self.find_selection_type(self.df_2)
+        self.set_percent_complete(50)
+
+        # CREATE ERROR LOG
+        self.df_locfail = self.df_2[self.df_2["Select_By"].isna()]
+        self.df_locfail["Error"] = "Missing Location"
+        self.df_locfail.drop(["SPAM_code", "Select_By"], axis=1, inplace=True)
+        self.df_locfail["row"] = self.df_locfail.index
+        span.stop()
+        self.set_percent_complete(55)
+
+        return self.find_locations(water_unit)
 
     # Define whether location will use point + radius, state, or country to
     # select watersheds
-    def find_selection_type(self, row):
+    def find_selection_type(self, df):
         """
-        :param row: individual row
-        :return: location type (point, state, country, none)
+        :param df: supply chain rows
+        :return: location type of every row (point, state, country, none)
         """
         # If coordiantes exist, location type is point
-        if isinstance(row["Latitude"], float) and np.isnan(row["Latitude"]) == False:
-            select_by = "point"
+        point = self.instances_of(df["Latitude"], float) & df["Latitude"].notna()
         # If state exists WITH country name, location type is state
-        elif (isinstance(row["State/Province"], str) == True) & (
-            isinstance(row["Country"], str) == True
-        ):
-            select_by = "state"
+        state = self.instances_of(df["State/Province"], str) & self.instances_of(
+            df["Country"], str
+        )
         # If neither of those are true, and a country name exists, location type is country
-        elif isinstance(row["Country"], str) == True:
-            select_by = "country"
+        country = self.instances_of(df["Country"], str)
         # Else, no location type given. These will be dropped from the analysis
-        else:
-            select_by = np.nan
+        select_by = pd.Series(np.nan, index=df.index, dtype=object)
+        select_by[country] = "country"
+        select_by[state] = "state"
+        select_by[point] = "point"
         return select_by
 
-    # Clean up Radius buffer values. Remove 0's, convert to decimal degrees
-    # (units of the analysis)
-    def clean_buffer(self, row):
+    @staticmethod
+    def instances_of(values, kind):
+        """Mask of the values that are instances of kind, as isinstance(value, kind)"""
+        types = values.map(type)
+        return types.isin([t for t in types.unique() if issubclass(t, kind)])
+
+    # Radius units: km = radius * multiplier / divisor
+    radius_units = {
+        "miles": (1.609, 1),
+        "mile": (1.609, 1),
+        "m": (1, 1000),
+        "met": (1, 1000),
+        "meter": (1, 1000),
+        "meters": (1, 1000),
+        "km": (1, 1),
+        "kilometer": (1, 1),
+        "kilometers": (1, 1),
+    }
+
+    # Clean up Radius buffer values. Remove 0's, convert to km (units of the
+    # radius queries, measured along great circles)
+    def clean_buffer(self, df):
         """
-        :param row: individual row (1 coordinate + material type)
-        :return: buffer radius in decimal degrees
+        :param df: point rows (1 coordinate + material type)
+        :return: buffer radius in km, NaN when the radius or its unit are invalid
         """
-        val = row.Radius  # Find the radius value
-        unit = str(row["Radius Unit"]).lower()  # Find the radius units
-        try:
-            float_val = float(val)  # Turn value to floast
-            if float_val == 0.0:  # If radius is 0, set to NA
-                new_val = np.nan
-            elif unit in [
-                "miles",
-                "mile",
-            ]:  # If units are in miles, convert to KM (multiple by 1.609), then to degrees (divide by 111)
-                new_val = float_val * 1.609 / 111.0
-            elif unit in [
-                "m",
-                "met",
-                "meter",
-                "meters",
-            ]:  # If units are in meters, convert to KM then to degrees (divide by 111)
-                new_val = (float_val / 1000) / 111.0
-            elif unit in [
-                "km",
-                "kilometer",
-                "kilometers",
-            ]:  # If units are in kilometers, convert to degrees (divide by 111)
-                new_val = float_val / 111.0
-            else:  # Else, return Null radius, report as error
-                new_val = np.nan
-        except:
-            new_val = np.nan
-        return new_val
-
-    # Create buffer (in decimal degrees) around point
-    def buffer(self, row):
-        """
-        :param row: individual row (1 coordinate + material type)
-        :return: circle polygon
-        """
-        return row.geometry.buffer(row.Buffer)
-
-    # Match user-entered state and country names to GADM names
-    def fuzzy_merge(self, df_1, df_2, key1, key2, threshold=90, limit=1):
-        """
-        source of function:
-        https://stackoverflow.com/questions/13636848/is-it-possible-to-do-fuzzy-match-merge-with-python-pandas
-        :param df_1: the left table to join
-        :param df_2: the right table to join
-        :param key1: key column of the left table
-        :param key2: key column of the right table
-        :param threshold: how close the matches should be to return a match, based on Levenshtein distance
-        :param limit: the amount of matches that will get returned, these are sorted high to low
-        :return: dataframe with boths keys and matches
-        """
-        s = df_2[key2].tolist()
-
-        m = df_1[key1].apply(lambda x: process.extract(x, s, limit=limit))
-        df_1["matches"] = m
-
-        m2 = df_1["matches"].apply(
-            lambda x: ", ".join([i[0] for i in x if i[1] >= threshold])
-        )
-        df_1["matches"] = m2
-
-        return df_1
-
-    # Explode sourcing locations by intersecting watersheds
-    def explode_data(self, inDATA, user_id, pf_id):
-        """
-        source of function:
-        https://stackoverflow.com/questions/12680754/split-explode-pandas-dataframe-string-entry-to-separate-rows
-        :param inDATA: table of user locations with a column containing list of watershed intersecting row's location
-                        primary key = location + material
-        :param user_id: row id column
-        :param pf_id: Unique watershed ID
-        :return: table where every location is repeated based on the number of watersheds it intersects with
-                        primary key = watershed ID + location + material
-        """
-        # Copy data
-        sc2 = inDATA.reset_index()
-        # Final all watersheds
-        vals = sc2[pf_id].values.tolist()
-        # find number of watersheds to repeat per row
-        rs = [len(r) for r in vals]
-        # create repeating combo of field per watershed
-        a = np.repeat(sc2[user_id], rs)
-        explode = pd.DataFrame(
-            np.column_stack((a, np.concatenate(vals))), columns=[user_id, pf_id]
-        )
-        explode.drop_duplicates(subset=[pf_id, user_id], inplace=True)
-        return explode
+        radius = pd.to_numeric(df["Radius"], errors="coerce").astype(float)
+        units = df["Radius Unit"].astype(str).str.lower()
+        multiplier = units.map({unit: m for unit, (m, d) in self.radius_units.items()})
+        divisor = units.map({unit: d for unit, (m, d) in self.radius_units.items()})
+        # Convert to KM. 0 or unknown units are Null
+        return (radius * multiplier / divisor).where(radius != 0.0)
 
     # Perform a geospatial analysis and fuzzy name lookup to find locations
     def find_locations(self, water_unit):
@@ -673,64 +1119,33 @@ class FoodSupplyChainService(object):
         :param water_unit: Geometry ID associated with the selected indicator. AQID for aquifers or PFAF_ID for watersheds
         :return: dataframe with that matches each supply location to its watersheds and crops (close to final product); dataframe with all errors logged
         """
-        # INDICATOR SPECIFIC
-        if water_unit == "AQID":
-            ifpri_path = (
-                "aqueduct/services/supply_chain_data/inputs_ifpri_production_aqid.csv"
-            )
-        else:
-            ifpri_path = (
-                "aqueduct/services/supply_chain_data/inputs_ifpri_production_pfaf.csv"
-            )
-
         # ---------------
         # CROP PRODUCTION
         # ---------------
-        # IFPRI crop production (make sure column names are lower case)
-        df_ifpri = pd.read_csv(ifpri_path, index_col=0, header=0)
-        df_ifpri.columns = [x.lower() for x in df_ifpri]
-        # Filter by irrigation selection
-        df_if = df_ifpri[
-            [x for x in df_ifpri.columns if self.irrigation_selection in x]
-        ]
-        # Remove irrigation suffix
-        df_if.columns = [x.replace(self.irrigation_selection, "") for x in df_if]
-        # Melt dataframe so every row is unique watershed + crop combo
-        df_prod = pd.melt(df_if, ignore_index=False)
-        # Rename columns
-        df_prod.columns = ["SPAM_code", "IFPRI_production_MT"]
-        # Create a binary variable. Crops are grown if at least 10 MT are produced
-        df_prod["grown_yn"] = np.where(df_prod["IFPRI_production_MT"] >= 10, 1, 0)
+        # IFPRI crop production, watershed x crop matrix
+        df_prod = self.reference.production(water_unit, self.irrigation_selection)
 
         self.set_percent_complete(56)
 
         # ---------
         # COUNTRIES
         # ---------
-        stime1 = time.time()
+        span = self.spans.start("country")
         # Select Country and State location types
         df_ad = self.df_2[
             (self.df_2["Select_By"] == "country") | (self.df_2["Select_By"] == "state")
         ]
         # Apply automatic fix to select country names
-        df_ad["Country"][df_ad["Country"].isin(self.country_fixes)] = df_ad["Country"][
-            df_ad["Country"].isin(self.country_fixes)
-        ].apply(lambda x: self.country_fixes.get(x.strip()))
-        # Create country-to-water lookup
-        ad0hys = self.df_admnames.filter(["GID_0", water_unit])
-        # Group GID_0 lists together
-        ad0hys = ad0hys.groupby(["GID_0"])[water_unit].agg(list).to_frame()
-        # Unnest the lists
-        ad0hys[water_unit] = ad0hys[water_unit].apply(
-            lambda x: list(chain.from_iterable(x))
-        )
-        # Create GADM country names lookup
-        gdf0 = self.df_admnames.filter(["GID_0", "NAME_0"]).drop_duplicates()
+        df_ad["Country"] = df_ad["Country"].replace(self.country_fixes)
+        # Country-to-water lookup (precomputed)
+        ad0hys = self.reference.lookups.admin_basins(water_unit, "gid0")
+        # GADM country names lookup
+        gdf0 = self.reference.country_ids
         # - - - - - - - - - - - MATCH USER NAME TO GADM NAME - - - - - - - - - - - #
-        df_adm = self.fuzzy_merge(
-            df_ad.reset_index(), gdf0, "Country", "NAME_0", threshold=85
+        df_adm = df_ad.reset_index()
+        df_adm["Country_clean"] = self.reference.country_matcher.match(
+            df_adm["Country"], threshold=85
         )
-        df_adm.rename(columns={"matches": "Country_clean"}, inplace=True)
         df_adm = pd.merge(
             df_adm, gdf0, how="left", left_on="Country_clean", right_on="NAME_0"
         )
@@ -738,12 +1153,12 @@ class FoodSupplyChainService(object):
         # Filter by GID_0
         ad0_ids = df_adm[["row", "GID_0"]][
             (df_adm["Select_By"] == "country") & (~df_adm["Country_clean"].isna())
-        ].set_index("row")
+        ]
         # - - - - - - - - - - - LINK WATERSHED ID BASED ON GADM NAME- - - - - - - - - - - #
-        ad0_basins = pd.merge(
-            ad0_ids, ad0hys, how="left", left_on="GID_0", right_index=True
+        positions, basins = ad0hys.explode(ad0_ids["GID_0"])
+        ad0_basins = pd.DataFrame(
+            {"row": ad0_ids["row"].values[positions], water_unit: basins}
         )
-        ad0_basins.drop(["GID_0"], axis=1, inplace=True)
 
         # # # - - - - - - - - - - - CREATE ERROR LOG - - - - - - - - - - - #
         df_ad0fail = df_adm[df_adm["Country_clean"].isna()]
@@ -756,25 +1171,25 @@ class FoodSupplyChainService(object):
         )
         df_ad0fail["row"] = df_ad0fail.index
 
-        logging.info("Countries found in {} seconds".format(time.time() - stime1))
+        span.stop(rows=len(df_adm))
         self.set_percent_complete(57)
 
         # ------
         # STATES
         # ------
-        stime1 = time.time()
-        ad1hys = self.df_admnames.filter(["GID_1", water_unit]).set_index("GID_1")
+        span = self.spans.start("state")
+        ad1hys = self.reference.lookups.admin_basins(water_unit, "gid1")
         # Seperate out state location types
         df_ad1 = df_adm[df_adm["Select_By"] == "state"]
         # - - - - - - - - - - - CREATE STATE NAME (State, Country) - - - - - - - - - - - #
         # Create full state name include cleaned country name for match
         df_ad1["state_full"] = df_ad1["State/Province"] + ", " + df_ad1["Country_clean"]
         # - - - - - - - - - - - MATCH USER NAME TO GADM NAME - - - - - - - - - - - #
-        # Perform fuzzy match
-        df_ad1m = self.fuzzy_merge(
-            df_ad1, self.df_admnames, "state_full", "state_full", threshold=90
+        # Perform fuzzy match, only against the states of the matched country
+        df_ad1["State_clean"] = self.reference.state_matcher.match(
+            df_ad1["state_full"], threshold=90, groups=df_ad1["Country_clean"]
         )
-        df_ad1m.rename(columns={"matches": "State_clean"}, inplace=True)
+        df_ad1m = df_ad1
         df_ad1m = pd.merge(
             df_ad1m,
             self.df_admnames.filter(["GID_1", "state_full"]),
@@ -785,12 +1200,12 @@ class FoodSupplyChainService(object):
         df_ad1m["State_clean"].replace("", np.nan, inplace=True)
         ad1_ids = df_ad1m[["row", "GID_1"]][
             (df_ad1m["Select_By"] == "state") & (~df_ad1m["State_clean"].isna())
-        ].set_index("row")
+        ]
         # # - - - - - - - - - - - LINK WATERSHED ID - - - - - - - - - - - #
-        ad1_basins = pd.merge(
-            ad1_ids, ad1hys, how="left", left_on="GID_1", right_index=True
+        positions, basins = ad1hys.explode(ad1_ids["GID_1"])
+        ad1_basins = pd.DataFrame(
+            {"row": ad1_ids["row"].values[positions], water_unit: basins}
         )
-        ad1_basins.drop(["GID_1"], axis=1, inplace=True)
 
         # # # - - - - - - - - - - - CREATE ERROR LOG - - - - - - - - - - - #
         df_ad1fail = df_ad1m[df_ad1m["State_clean"].isna()]
@@ -799,25 +1214,14 @@ class FoodSupplyChainService(object):
         df_ad1fail["Error"] = "State name did not match lookup table"
         df_ad1fail["row"] = df_ad1fail.index
 
-        logging.info("States found in {} seconds".format(time.time() - stime1))
+        span.stop(rows=len(df_ad1))
         self.set_percent_complete(58)
 
         # ------
         # POINTS
         # ------
-        stime1 = time.time()
-
-        # Read in water geometries
+        span = self.spans.start("points")
 
-        if not exists(self.hybas_path(water_unit)):
-            gz_filename = "{}.gz".format(self.hybas_path(water_unit))
-            logging.info("Decompressing {}".format(gz_filename))
-            import gzip
-            import shutil
-
-            with gzip.open(gz_filename, "rb") as f_in:
-                with open(self.hybas_path(water_unit), "wb") as f_out:
-                    shutil.copyfileobj(f_in, f_out)
         # - - - - - - - - - - - CHECK THAT ANALYSIS NEEDS POINTS - - - - - - - - - - - #
         # SELECT POINT LOCATIONS
         df_points = self.df_2[self.df_2["Select_By"] == "point"]
@@ -827,10 +1231,6 @@ class FoodSupplyChainService(object):
         print("There are {} points".format(len(df_points)))
 
         if len(df_points) > 0:
-            gdf = gpd.read_file(self.hybas_path(water_unit))
-            gdf = gdf[1:]
-            gdf.rename(columns={water_unit.lower(): water_unit.upper()}, inplace=True)
-
             # CLEAN DATA
             # Make sure coordinates are floats. Drop rows where encoding fails
             df_points["Latitude"] = pd.to_numeric(
@@ -845,8 +1245,6 @@ class FoodSupplyChainService(object):
                 (df_points["Longitude"].isna()) | (df_points["Latitude"].isna())
             ]
             df_ptfail["Error"] = "Non-numeric coordinates"
-            df_ptfail.drop(["SPAM_code", "Select_By"], axis=1, inplace=True)
-            df_ptfail["row"] = df_ptfail.index
 
             self.set_percent_complete(60)
 
@@ -859,49 +1257,55 @@ class FoodSupplyChainService(object):
             df_points["Radius Unit"][(df_points["Radius Unit"].isna())] = "km"
 
             # FIND WATERSHEDS
-            # Convert Radius into decimal degree value
-            df_points["Buffer"] = df_points.apply(
-                lambda x: self.clean_buffer(x), axis=1
-            )
+            # Convert Radius into km
+            df_points["Buffer"] = self.clean_buffer(df_points)
+
+            # CREATE ERROR LOG
+            df_radiusfail = df_points[df_points["Buffer"].isna()]
+            df_radiusfail["Error"] = "Invalid Radius"
+            df_ptfail = pd.concat([df_ptfail, df_radiusfail.drop(["Buffer"], axis=1)])
+            df_ptfail.drop(["SPAM_code", "Select_By"], axis=1, inplace=True)
+            df_ptfail["row"] = df_ptfail.index
+            df_points = df_points[df_points["Buffer"].notna()]
 
             self.set_percent_complete(61)
 
-            # Create XY from coordinates
-            df_points["geometry"] = df_points.apply(
-                lambda row: Point(float(row.Longitude), row.Latitude), axis=1
+            # Find all basins within the radius (great-circle distance) of every
+            # point, in a single query against the spatial index kept by the worker
+            positions, basins = self.reference.basin_index(water_unit).query(
+                df_points["Longitude"].values,
+                df_points["Latitude"].values,
+                df_points["Buffer"].values,
             )
-            buffered = df_points.filter(["Buffer", "geometry", "id"])
-            buffered["geometry"] = buffered.apply(
-                lambda x: x.geometry.buffer(x.Buffer), axis=1
+            pts_basins = pd.DataFrame(
+                {"row": df_points.index.values[positions], water_unit: basins}
             )
-            buffered = gpd.GeoDataFrame(buffered, geometry=buffered.geometry)
-
-            # Find allbasins within every buffer
-            pts_hy6 = gpd.sjoin(buffered, gdf, how="left", op="intersects")
-            pts_basins = pts_hy6.groupby(["row"])[water_unit].agg(list).to_frame()
+            # Grouped by row, keeping the order of the basins of each row
+            pts_basins = pts_basins.iloc[
+                np.argsort(pts_basins["row"].values, kind="stable")
+            ]
 
             self.set_percent_complete(62)
-
-            # Set name to uppercase
-            pts_basins.columns = [water_unit.upper()]
         # - - - - - - - - - - - IF NOT POINTS GIVEN, CREATE BLANKS - - - - - - - - - - - #
         else:
             self.set_percent_complete(63)
-            pts_basins = pd.DataFrame(columns=ad0_basins.columns)
+            pts_basins = pd.DataFrame(
+                {"row": np.zeros(0, dtype=np.int64), water_unit: np.zeros(0, dtype=np.int64)}
+            )
             df_ptfail = pd.DataFrame(columns=df_ad0fail.columns)
             df_ptfail["row"] = df_ptfail.index
-            ad0_basins["row"] = ad0_basins.index
-            ad1_basins["row"] = ad1_basins.index
 
-        logging.info("Points found in {} seconds".format(time.time() - stime1))
+        span.stop(rows=len(df_points))
 
         # -------
         # COMBINE
         # -------
-        # Combine all basins together
-        df_basins = pd.concat([pts_basins, ad0_basins, ad1_basins])
-        # # Explode data for every row has a unique row # + sourcing watershed ID
-        df_basinsexplode = self.explode_data(df_basins, "row", water_unit)
+        span = self.spans.start("combine")
+        # Combine all basins together: every row + sourcing watershed ID, once
+        df_basinsexplode = pd.concat(
+            [pts_basins, ad0_basins, ad1_basins], ignore_index=True
+        )
+        df_basinsexplode.drop_duplicates(subset=[water_unit, "row"], inplace=True)
         self.set_percent_complete(67)
         # # Find cropped sourced in each watershed
         df_sourcing = pd.merge(
@@ -914,38 +1318,33 @@ class FoodSupplyChainService(object):
 
         self.set_percent_complete(70)
 
-        # Add IFPRI production data to see what's actually grown
-        df_sourced = pd.merge(
-            df_sourcing,
-            df_prod,
-            how="left",
-            left_on=[water_unit, "SPAM_code"],
-            right_on=[water_unit, "SPAM_code"],
+        # Add IFPRI production data to see what's actually grown (at least 10 MT)
+        production = df_prod.lookup(
+            df_sourcing[water_unit].values, df_sourcing["SPAM_code"].values
+        )
+        grown = production >= 10
+        df_sourced = df_sourcing[grown]
+        df_sourced["IFPRI_production_MT"] = production[grown].astype(
+            df_prod.values.dtype
         )
-        df_sourced = df_sourced[df_sourced.grown_yn == 1]
         # Add full crop name
-        df_sourced = pd.merge(
-            df_sourced,
-            self.df_crops.filter(["full_name", "short_name"]).set_index("short_name"),
-            how="left",
-            left_on="SPAM_code",
-            right_index=True,
+        df_sourced["Crop_Name"] = df_sourced["SPAM_code"].map(
+            self.df_crops.set_index("short_name")["full_name"]
         )
 
         self.set_percent_complete(73)
 
         # Clean columns
-        df_sourced.drop(["grown_yn", "SPAM_code"], axis=1, inplace=True)
         df_sourced = df_sourced[
-            ["row", "Location ID", water_unit, "full_name", "IFPRI_production_MT"]
+            ["row", "Location ID", water_unit, "Crop_Name", "IFPRI_production_MT"]
         ]
-        df_sourced.rename(columns={"full_name": "Crop_Name"}, inplace=True)
 
         self.set_percent_complete(75)
 
         df_fails = pd.concat(
             [self.df_cropfail, self.df_locfail, df_ptfail, df_ad0fail, df_ad1fail]
         )
+        span.stop(rows=len(df_sourced))
 
         return df_sourced, df_fails
 
@@ -993,7 +1392,7 @@ if __name__ == "__main__":
     print("job_token = {}".format(job_token))
 
     # print("testing s3 upload")
-    # analyzer.upload_results({"apples": "yum"})
+    # analyzer.upload_results({"apples": [[{"taste": "yum"}]]}, {})
 
     print("popping work")
     FoodSupplyChainService.pop_and_do_work()
@@ -359,30 +359,6 @@ class RiskService(object):
         y_new = f(x_i)
         return y_new
 
-    @staticmethod
-    def extrap1d(interpolator):
-        """
-        Purpose: Make an extrapolation function
-        """
-        xs = interpolator.x
-        ys = interpolator.y
-
-        def pointwise(x):
-            # If new prob is smaller than smallest prob in function
-            if x < xs[0]:
-                return ys[0] + (x - xs[0]) * (ys[1] - ys[0]) / (xs[1] - xs[0])
-            # If new prob is larger than largest prob in function
-            elif x > xs[-1]:
-                return ys[-1] + (x - xs[-1]) * (ys[-1] - ys[-2]) / (xs[-1] - xs[-2])
-            # If prob falls within set range of prob in function
-            else:
-                return interpolator(x)
-
-        def ufunclike(xs):
-            return np.fromiter(map(pointwise, np.array(xs)))
-
-        return ufunclike
-
     def compute_rp_change(self, ref_impact, target_impact, rp, min_rp=2, max_rp=1000):
         """
         Purpose: Compute how return period protection changes from one impact
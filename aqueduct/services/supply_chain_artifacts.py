@@ -0,0 +1,202 @@
+"""
+Precomputed lookups of the food supply chain analysis.
+
+Built offline from the GADM names and IFPRI production inputs, and saved as
+.npy arrays the worker memory-maps:
+- country (GID_0) and state (GID_1) to water units, in CSR form: sorted keys,
+  offsets and the concatenated water unit lists;
+- crop production, as a (water unit, crop) matrix per irrigation type.
+
+Exploding locations into water units and looking up their production are then
+array indexing instead of groupby / melt / merge on every job.
+
+Build with: python aqueduct/services/supply_chain_artifacts.py [--out DIR]
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+WATER_UNITS = {"PFAF_ID": "pfaf", "AQID": "aqid"}
+ADMIN_LEVELS = {"gid0": "GID_0", "gid1": "GID_1"}
+MANIFEST = "manifest.json"
+
+
+def fingerprint(paths):
+    """md5 of every input file, None for the missing ones"""
+    sums = {}
+    for path in paths:
+        if os.path.exists(path):
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    md5.update(block)
+            sums[os.path.basename(path)] = md5.hexdigest()
+        else:
+            sums[os.path.basename(path)] = None
+    return sums
+
+
+class CSRLookup(object):
+    """Sorted keys, each with its values in values[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, keys, offsets, values):
+        self.keys = keys
+        self.offsets = offsets
+        self.values = values
+
+    @classmethod
+    def from_lists(cls, keys, lists):
+        """Values of repeated keys are concatenated, in order"""
+        grouped = {}
+        for key, values in zip(keys, lists):
+            grouped.setdefault(key, []).extend(values)
+        ordered = sorted(grouped)
+        counts = [len(grouped[key]) for key in ordered]
+        offsets = np.zeros(len(ordered) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        values = [value for key in ordered for value in grouped[key]]
+        return cls(np.array(ordered, dtype=str), offsets, np.array(values, dtype=np.int64))
+
+    def explode(self, keys):
+        """
+        :param keys: keys to look up. Unknown keys have no values
+        :return: (positions, values): every value of every key, with the position of its key
+        """
+        keys = np.asarray(keys, dtype=str)
+        if not len(self.keys):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        starts = self.offsets[index]
+        counts = np.where(self.keys[index] == keys, self.offsets[index + 1] - starts, 0)
+        positions = np.repeat(np.arange(len(keys)), counts)
+        # index of every value within its key's slice
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return positions, np.asarray(self.values[np.repeat(starts, counts) + within])
+
+
+class ProductionMatrix(object):
+    """IFPRI crop production (MT), one row per water unit (sorted) and one column per crop"""
+
+    def __init__(self, basins, crops, values):
+        self.basins = basins
+        self.crops = crops
+        self.values = values
+        self._crop_positions = {crop: position for position, crop in enumerate(crops)}
+
+    def lookup(self, basins, crops):
+        """Production of every (basin, crop) pair, NaN when the basin or the crop is unknown"""
+        basins = np.asarray(basins, dtype=np.int64)
+        production = np.full(len(basins), np.nan)
+        if not len(self.basins):
+            return production
+        rows = np.minimum(np.searchsorted(self.basins, basins), len(self.basins) - 1)
+        columns = np.array([self._crop_positions.get(crop, -1) for crop in crops], dtype=np.int64)
+        found = (self.basins[rows] == basins) & (columns >= 0)
+        production[found] = self.values[rows[found], columns[found]]
+        return production
+
+
+class SupplyChainLookups(object):
+    def __init__(self, arrays, sources):
+        """
+        :param arrays: {name: array}, see build
+        :param sources: fingerprint of the inputs the arrays were built from
+        """
+        self.arrays = arrays
+        self.sources = sources
+
+    def admin_basins(self, water_unit, level):
+        """CSRLookup of the water units of every country (gid0) or state (gid1)"""
+        name = "{}.{}".format(water_unit, level)
+        return CSRLookup(*(self.arrays["{}.{}".format(name, part)] for part in ["keys", "offsets", "values"]))
+
+    def production(self, water_unit, irrigation_selection):
+        name = "{}.production".format(water_unit)
+        return ProductionMatrix(
+            self.arrays[name + ".basins"],
+            list(self.arrays[name + ".crops"]),
+            self.arrays["{}{}".format(name, irrigation_selection)],
+        )
+
+    @classmethod
+    def build(cls, admnames, ifpri_paths, sources):
+        """
+        :param admnames: GADM names, with the water unit lists parsed
+        :param ifpri_paths: {water unit: IFPRI production csv}
+        :param sources: fingerprint of the inputs
+        """
+        arrays = {}
+        for water_unit in WATER_UNITS:
+            for level, column in ADMIN_LEVELS.items():
+                lookup = CSRLookup.from_lists(admnames[column], admnames[water_unit])
+                name = "{}.{}".format(water_unit, level)
+                arrays[name + ".keys"] = lookup.keys
+                arrays[name + ".offsets"] = lookup.offsets
+                arrays[name + ".values"] = lookup.values
+
+            path = ifpri_paths[water_unit]
+            if not os.path.exists(path):
+                logging.warning("[SupplyChainLookups]: {} not found, no production for {}".format(path, water_unit))
+                continue
+            df_ifpri = pd.read_csv(path, index_col=0, header=0)
+            df_ifpri.columns = [x.lower() for x in df_ifpri]
+            df_ifpri = df_ifpri[~df_ifpri.index.duplicated()].sort_index()
+            name = "{}.production".format(water_unit)
+            arrays[name + ".basins"] = df_ifpri.index.values.astype(np.int64)
+            # columns are <crop>_<irrigation>, e.g. maiz_a
+            crops = list(dict.fromkeys(column.rsplit("_", 1)[0] for column in df_ifpri))
+            arrays[name + ".crops"] = np.array(crops, dtype=str)
+            for suffix in sorted({"_" + column.rsplit("_", 1)[1] for column in df_ifpri if "_" in column}):
+                # crops without this irrigation type are NaN
+                arrays[name + suffix] = df_ifpri.reindex(columns=[crop + suffix for crop in crops]).values
+        return cls(arrays, sources)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(directory, name + ".npy"), array)
+        # written last: artifacts without a manifest are never loaded
+        with open(os.path.join(directory, MANIFEST), "w") as f:
+            json.dump({"sources": self.sources, "arrays": sorted(self.arrays)}, f, indent=2)
+
+    @classmethod
+    def load(cls, directory, sources):
+        """Memory-mapped artifacts, or None if they are missing or were built from other inputs"""
+        path = os.path.join(directory, MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest["sources"] != sources:
+            return None
+        arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in manifest["arrays"]}
+        return cls(arrays, sources)
+
+
+def main():
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from supply_chain_reference import SupplyChainReference
+
+    parser = argparse.ArgumentParser(description="Builds the supply chain lookup artifacts")
+    parser.add_argument("--out", default=SupplyChainReference.artifacts_path)
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    lookups = SupplyChainLookups.build(
+        SupplyChainReference.read_admnames(),
+        SupplyChainReference.ifpri_paths(),
+        fingerprint(SupplyChainReference.lookup_sources()),
+    )
+    lookups.save(args.out)
+    logging.info("Wrote {} arrays to {}".format(len(lookups.arrays), args.out))
+
+
+if __name__ == "__main__":
+    main()
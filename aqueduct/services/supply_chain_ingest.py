@@ -0,0 +1,248 @@
+"""
+Reading of the supply chain uploads in chunks of rows.
+
+Workbooks are read row by row with openpyxl in read-only mode, CSV files with
+the pandas chunked reader and Parquet files one record batch at a time, so the
+worker never holds the whole sheet as a DataFrame. Legacy .xls workbooks (at most
+65536 rows) are loaded with xlrd, then cut in chunks the same way. Every chunk is indexed by
+the row number the user sees in the file, and comes with the fraction of the
+file read so far.
+
+Parquet is optional: it needs pyarrow, which is not in requirements.txt.
+"""
+
+import csv
+import io
+import itertools
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+CHUNK_ROWS = int(os.environ.get("SUPPLY_CHAIN_CHUNK_ROWS", 10000))
+# Rows and bytes read to estimate the cost of a job when it is submitted
+SAMPLE_ROWS = 1000
+SAMPLE_BYTES = 1024 * 1024
+# Bytes of a row of the supply chain template in a workbook, zipped
+ZIPPED_ROW_BYTES = 48
+
+# Row of the column names in the supply chain template (1-based, as in Excel)
+TEMPLATE_HEADER_ROW = 5
+HEADER_COLUMN = "Material Type"
+# Kept as text even when a chunk has no values, e.g. only countries and no states
+TEXT_COLUMNS = ["State/Province", "Country", "Radius Unit", "Material Type"]
+
+
+def upload_format(content):
+    if content[:4] == b"PAR1":
+        return "parquet"
+    if content[:4] == b"PK\x03\x04":
+        return "xlsx"
+    if content[:4] == b"\xd0\xcf\x11\xe0":  # OLE2, e.g. an Excel 97-2003 workbook
+        return "xls"
+    return "csv"
+
+
+def _open(content):
+    """File object of the upload, given as bytes or as a file object at its start"""
+    return io.BytesIO(content) if isinstance(content, bytes) else content
+
+
+def _frame(df, rows):
+    df.index = pd.Index(rows, name="row")
+    for column in TEXT_COLUMNS:
+        if column in df:
+            df[column] = df[column].astype(object)
+    return df
+
+
+def _xlsx_chunks(content, chunk_rows):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(_open(content), read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        # same cell conversion as pd.read_excel: empty cells are empty strings
+        values = (["" if value is None else value for value in row] for row in sheet.iter_rows(values_only=True))
+        yield from _sheet_chunks(values, sheet.max_row, chunk_rows)
+    finally:
+        workbook.close()
+
+
+def _xls_chunks(content, chunk_rows):
+    import xlrd
+    from xlrd.compdoc import CompDocError
+
+    if not isinstance(content, bytes):
+        content = content.read()
+    try:
+        workbook = xlrd.open_workbook(file_contents=content, on_demand=True)
+        sheet = workbook.sheet_by_index(0)
+    except (xlrd.XLRDError, CompDocError) as e:
+        raise ValueError("Could not read the uploaded file: {}".format(e))
+    try:
+        values = ([_xls_value(cell, workbook.datemode) for cell in sheet.row(number)] for number in range(sheet.nrows))
+        yield from _sheet_chunks(values, sheet.nrows, chunk_rows)
+    finally:
+        workbook.release_resources()
+
+
+def _xls_value(cell, datemode):
+    """Value of an xlrd cell, converted as pd.read_excel does"""
+    import xlrd
+
+    if cell.ctype == xlrd.XL_CELL_DATE:
+        return xlrd.xldate_as_datetime(cell.value, datemode)
+    if cell.ctype == xlrd.XL_CELL_BOOLEAN:
+        return bool(cell.value)
+    if cell.ctype == xlrd.XL_CELL_ERROR:
+        return np.nan
+    if cell.ctype == xlrd.XL_CELL_NUMBER and cell.value == int(cell.value):
+        return int(cell.value)
+    return cell.value
+
+
+def _sheet_chunks(values, max_row, chunk_rows):
+    """
+    Chunks of the rows of a sheet, after the column names on TEMPLATE_HEADER_ROW
+    :param values: lists of the cell values of the rows, empty cells are empty strings
+    :param max_row: rows of the sheet, for the fraction read
+    """
+    total = max((max_row or 0) - TEMPLATE_HEADER_ROW, 1)
+    header = None
+    rows, numbers = [], []
+    for number, row in enumerate(values, 1):
+        if number < TEMPLATE_HEADER_ROW:
+            continue
+        if header is None:
+            header = row
+            continue
+        if all(value == "" for value in row):
+            continue
+        rows.append(row)
+        numbers.append(number)
+        if len(rows) == chunk_rows:
+            yield _xlsx_frame(header, rows, numbers), min((number - TEMPLATE_HEADER_ROW) / total, 1)
+            rows, numbers = [], []
+    if rows:
+        yield _xlsx_frame(header, rows, numbers), 1
+
+
+def _xlsx_frame(header, rows, numbers):
+    # TextParser is what pd.read_excel uses, so the values and types are the same
+    width = len(header)
+    df = TextParser([header] + [row[:width] + [""] * (width - len(row)) for row in rows], header=0).read()
+    return _frame(df, numbers)
+
+
+def _csv_chunks(content, chunk_rows):
+    # Template exports keep the title lines above the column names
+    lines = io.TextIOWrapper(io.BytesIO(content), encoding="utf-8", errors="replace", newline="")
+    header = 0
+    for position, values in enumerate(itertools.islice(csv.reader(lines), TEMPLATE_HEADER_ROW)):
+        if HEADER_COLUMN in values:
+            header = position
+            break
+
+    stream = io.BytesIO(content)
+    first_row = header + 2
+    for df in pd.read_csv(stream, skiprows=header, chunksize=chunk_rows):
+        yield _frame(df, range(first_row, first_row + len(df))), stream.tell() / max(len(content), 1)
+        first_row += len(df)
+
+
+def _parquet_chunks(content, chunk_rows):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Parquet uploads need pyarrow")
+
+    parquet = pq.ParquetFile(_open(content))
+    total = max(parquet.metadata.num_rows, 1)
+    first_row = 2  # as if the column names were on the first row
+    for batch in parquet.iter_batches(batch_size=chunk_rows):
+        df = batch.to_pandas()
+        df = df.where(df.notna(), np.nan)
+        yield _frame(df, range(first_row, first_row + len(df))), min((first_row - 2 + len(df)) / total, 1)
+        first_row += len(df)
+
+
+READERS = {"xlsx": _xlsx_chunks, "xls": _xls_chunks, "csv": _csv_chunks, "parquet": _parquet_chunks}
+
+
+def read_chunks(content, chunk_rows=CHUNK_ROWS):
+    """
+    :param content: uploaded file, xlsx or xls (supply chain template), csv or parquet
+    :param chunk_rows: rows per chunk
+    :return: iterator of (DataFrame indexed by row number, fraction of the file read)
+    """
+    try:
+        yield from READERS[upload_format(content)](content, chunk_rows)
+    except (zipfile.BadZipFile, UnicodeDecodeError, pd.errors.ParserError) as e:
+        raise ValueError("Could not read the uploaded file: {}".format(e))
+
+
+def sample(upload, size, lines, rows=SAMPLE_ROWS):
+    """
+    The first rows of a stored upload and its estimated rows, without reading all of it: the start of
+    a CSV file, the first rows and the row elements of a workbook, the first rows of an xls workbook and
+    its row count, the first batch of a Parquet file
+    :param upload: the upload, a seekable file object at its start
+    :param size: bytes of the upload
+    :param lines: line breaks of the upload, counted while storing it
+    :return: (DataFrame of up to rows rows, estimated rows of the upload); an empty DataFrame if the
+        upload can't be read, the worker reports why
+    """
+    head = upload.read(SAMPLE_BYTES)
+    kind = upload_format(head)
+    if kind == "csv" and len(head) < size:
+        head = head[: head.rfind(b"\n") + 1]  # whole lines only
+    upload.seek(0)
+    chunks = READERS[kind](head if kind == "csv" else upload, rows)
+    try:
+        df, fraction = next(chunks)
+    except StopIteration:
+        return pd.DataFrame(), 0
+    except Exception:
+        return pd.DataFrame(), estimate_rows(head, size, lines)
+    finally:
+        chunks.close()
+    if len(df) < rows:  # the whole upload
+        return df, len(df)
+    if kind == "xlsx":
+        # the sheet dimensions are optional, the row elements are always there
+        upload.seek(0)
+        total = _xlsx_rows(upload) - TEMPLATE_HEADER_ROW
+    elif kind in ("xls", "parquet"):
+        total = len(df) / fraction
+    else:
+        total = estimate_rows(head, size, lines)
+    return df, max(int(total), len(df))
+
+
+def _xlsx_rows(content, chunk_size=1024 * 1024):
+    """Rows of the first sheet, counted in its XML without parsing it"""
+    with zipfile.ZipFile(_open(content)) as archive:
+        sheets = sorted(name for name in archive.namelist() if name.startswith("xl/worksheets/sheet"))
+        rows, tail = 0, b""
+        with archive.open(sheets[0]) as sheet:
+            for chunk in iter(lambda: sheet.read(chunk_size), b""):
+                # a tag may be split between two chunks
+                rows += (tail + chunk).count(b"<row ") - tail.count(b"<row ")
+                tail = chunk[-4:]
+    return rows
+
+
+def estimate_rows(head, size, lines):
+    """
+    Rows of an upload, from what UploadStore.put counts while storing it, when it can't be sampled
+    :param head: first bytes of the upload
+    :param size: bytes of the upload
+    :param lines: line breaks of the upload
+    """
+    if upload_format(head) == "csv":
+        return max(lines - 1, 0)  # the column names
+    # the lines of workbooks and Parquet files mean nothing
+    return size // ZIPPED_ROW_BYTES
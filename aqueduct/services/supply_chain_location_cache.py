@@ -0,0 +1,47 @@
+"""
+Cache of the resolved supply chain locations.
+
+The (row, water unit, crop, production) table and the error log only depend on
+the uploaded file, the water unit of the indicator and the reference data.
+They are kept in redis for a while, so re-running an upload with another threshold or
+indicator of the same water unit only recomputes the scoring.
+
+The key holds the version of the reference data and RESOLUTION_VERSION, the version
+of the code resolving the locations: bump it when the matching changes what is
+resolved, so frames resolved the old way are not served until they expire.
+
+The frames are pickled, which runs code when they are loaded: the redis of the jobs
+must be a trusted store, reachable only by the API and the workers.
+"""
+
+import logging
+import os
+import pickle
+import zlib
+
+# 2: point radii are great-circle km
+RESOLUTION_VERSION = 2
+
+
+class LocationCache(object):
+    ttl = int(os.environ.get("SUPPLY_CHAIN_LOCATIONS_TTL", 24 * 60 * 60))
+
+    def __init__(self, redis, md5sum, water_unit, reference_version):
+        self.redis = redis
+        self.key = "locations:{}:{}:{}:{}".format(md5sum, water_unit, reference_version, RESOLUTION_VERSION)
+
+    def get(self):
+        """(df_waterunits, df_errorlog), or None if they were not resolved yet"""
+        value = self.redis.get(self.key)
+        if value is None:
+            return None
+        try:
+            return pickle.loads(zlib.decompress(value))
+        except Exception as e:
+            logging.warning("[LocationCache]: discarding {}: {}".format(self.key, e))
+            self.redis.delete(self.key)
+            return None
+
+    def set(self, df_waterunits, df_errorlog):
+        value = zlib.compress(pickle.dumps((df_waterunits, df_errorlog), protocol=pickle.HIGHEST_PROTOCOL))
+        self.redis.set(self.key, value, ex=self.ttl)
@@ -0,0 +1,204 @@
+"""
+Per-stage instrumentation of the food supply chain jobs.
+
+A job records a span for each stage it runs (read, clean, crop_match, country,
+state, points, combine, segments, score, serialize, upload): wall time, CPU time,
+growth of the peak RSS of the worker process and rows handled. Stages run once per
+chunk of the upload add up. The spans are stored with the job and returned with
+its status.
+
+Finished jobs also feed per-stage histograms of the wall time in redis, shared by
+all the workers, and a bounded log of the recent jobs with their upload md5. A
+stage regression can then be traced to the files it happens on:
+python aqueduct/services/supply_chain_metrics.py [--stage points] [--top 10]
+
+The throughput of the finished jobs, in seconds per row and per point row (the
+point queries dominate), and their share of point rows give the estimated cost of the submitted jobs the queue
+schedules by (see supply_chain_queue.py).
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+STAGES = ("read", "clean", "crop_match", "country", "state", "points", "combine", "segments", "score", "serialize",
+          "upload")
+# upper bounds of the wall time buckets, in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, float("inf"))
+HISTOGRAM = "job_stage_histogram:{}".format
+LOG = "job_stage_log"
+LOG_SIZE = 1000
+# rows, wall, point_rows, point_wall of the jobs that read their upload
+THROUGHPUT = "job_throughput"
+# seconds per row, per point row and per job, and share of point rows, until jobs were recorded
+DEFAULT_RATES = {"row": 0.0005, "point_row": 0.001, "job": 1.0, "point_share": 0.4}
+# ru_maxrss is in kilobytes on Linux, bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def peak_rss():
+    """Peak resident set size of this process, in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+class Span(object):
+    def __init__(self, spans, name):
+        self.spans = spans
+        self.name = name
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.rss = peak_rss()
+
+    def stop(self, rows=None):
+        """Adds the span to its stage. rows: rows handled by the stage, if it counts them"""
+        stage = self.spans.stages.setdefault(
+            self.name, {"wall": 0.0, "cpu": 0.0, "peak_rss_delta": 0, "rows": 0, "calls": 0})
+        wall = time.perf_counter() - self.wall
+        stage["wall"] += wall
+        stage["cpu"] += time.process_time() - self.cpu
+        stage["peak_rss_delta"] += peak_rss() - self.rss
+        stage["rows"] += rows or 0
+        stage["calls"] += 1
+        logging.info("[{}] {:.3f} s{}".format(self.name, wall, "" if rows is None else ", {} rows".format(rows)))
+
+
+class StageSpans(object):
+    def __init__(self):
+        self.stages = {}
+
+    def start(self, name):
+        """Span of the stage, ended by Span.stop"""
+        return Span(self, name)
+
+    @contextmanager
+    def span(self, name):
+        """Span around a block. Set .rows on the yielded span to count the rows"""
+        span = self.start(name)
+        span.rows = None
+        try:
+            yield span
+        finally:
+            span.stop(span.rows)
+
+    def iterate(self, name, items, rows=None):
+        """Yields the items, producing each one is a span of the stage. rows: rows of an item"""
+        items = iter(items)
+        while True:
+            span = self.start(name)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            span.stop(None if rows is None else rows(item))
+            yield item
+
+    def summary(self):
+        """{stage: {wall, cpu, peak_rss_delta, rows, calls}}, in order of the stages"""
+        order = {name: position for position, name in enumerate(STAGES)}
+        return {
+            name: dict(stage, wall=round(stage["wall"], 4), cpu=round(stage["cpu"], 4))
+            for name, stage in sorted(self.stages.items(), key=lambda item: order.get(item[0], len(order)))
+        }
+
+    def record(self, pipe, job_token, upload=None):
+        """Adds the spans of a finished job to the histograms and the job log, in the pipe"""
+        summary = self.summary()
+        for name, stage in summary.items():
+            key = HISTOGRAM(name)
+            bucket = next(bound for bound in BUCKETS if stage["wall"] <= bound)
+            pipe.hincrby(key, "le_{}".format(bucket), 1)
+            pipe.hincrby(key, "count", 1)
+            pipe.hincrbyfloat(key, "wall", stage["wall"])
+            pipe.hincrbyfloat(key, "cpu", stage["cpu"])
+            pipe.hincrby(key, "rows", stage["rows"])
+        if "read" in summary:  # jobs of cached locations tell nothing of the throughput
+            points = summary.get("points", {"rows": 0, "wall": 0.0})
+            pipe.hincrby(THROUGHPUT, "rows", summary["read"]["rows"])
+            pipe.hincrbyfloat(THROUGHPUT, "wall", sum(stage["wall"] for stage in summary.values()) - points["wall"])
+            pipe.hincrby(THROUGHPUT, "point_rows", points["rows"])
+            pipe.hincrbyfloat(THROUGHPUT, "point_wall", points["wall"])
+        if isinstance(job_token, bytes):
+            job_token = job_token.decode("utf-8")
+        pipe.lpush(LOG, json.dumps({"job_token": job_token, "upload": upload, "finished_at": time.time(),
+                                    "stages": summary}))
+        pipe.ltrim(LOG, 0, LOG_SIZE - 1)
+
+
+def histograms(redis):
+    """{stage: {"count", "wall", "cpu", "rows", "buckets": {upper bound: jobs}}} of the finished jobs"""
+    result = {}
+    for name in STAGES:
+        fields = {key.decode("utf-8"): value for key, value in redis.hgetall(HISTOGRAM(name)).items()}
+        if not fields:
+            continue
+        result[name] = {
+            "count": int(fields["count"]),
+            "wall": float(fields["wall"]),
+            "cpu": float(fields["cpu"]),
+            "rows": int(fields["rows"]),
+            "buckets": {bound: int(fields.get("le_{}".format(bound), 0)) for bound in BUCKETS},
+        }
+    return result
+
+
+def throughput(redis):
+    """
+    {"row", "point_row", "job", "point_share"}: seconds per row, per point row and per job of the finished
+    jobs, and the point rows per row they read
+    """
+    fields = {key.decode("utf-8"): float(value) for key, value in redis.hgetall(THROUGHPUT).items()}
+    rates = dict(DEFAULT_RATES)
+    if fields.get("rows"):
+        rates["row"] = fields["wall"] / fields["rows"]
+        rates["point_share"] = fields.get("point_rows", 0) / fields["rows"]
+    if fields.get("point_rows"):
+        rates["point_row"] = fields["point_wall"] / fields["point_rows"]
+    return rates
+
+
+def estimate_seconds(rates, rows, point_rows=0):
+    """Estimated duration of a job reading rows, of which point_rows are points. rates: see throughput"""
+    return rates["job"] + rates["row"] * rows + rates["point_row"] * point_rows
+
+
+def recent_jobs(redis):
+    return [json.loads(entry) for entry in redis.lrange(LOG, 0, -1)]
+
+
+def main():
+    import redis
+
+    parser = argparse.ArgumentParser(description="Stage timings of the supply chain jobs")
+    parser.add_argument("--stage", help="lists the slowest recent jobs of this stage")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    uri = urlparse(os.environ["REDIS_URL"])
+    client = redis.Redis(host=uri.hostname, port=uri.port or 6379, db=3)
+
+    print("{:<12} {:>6} {:>10} {:>10} {:>10}  wall time buckets (s: jobs)".format(
+        "stage", "jobs", "mean (s)", "cpu (s)", "rows/s"))
+    for name, stage in histograms(client).items():
+        buckets = " ".join("{:g}:{}".format(bound, jobs) for bound, jobs in stage["buckets"].items() if jobs)
+        print("{:<12} {:>6} {:>10.3f} {:>10.3f} {:>10.0f}  {}".format(
+            name, stage["count"], stage["wall"] / stage["count"], stage["cpu"] / stage["count"],
+            stage["rows"] / stage["wall"] if stage["wall"] else 0, buckets))
+
+    if args.stage:
+        jobs = [job for job in recent_jobs(client) if args.stage in job["stages"]]
+        jobs.sort(key=lambda job: job["stages"][args.stage]["wall"], reverse=True)
+        print("\nSlowest {} of the last {} jobs".format(args.stage, LOG_SIZE))
+        for job in jobs[: args.top]:
+            stage = job["stages"][args.stage]
+            print("{:>9.3f} s {:>9} rows  upload {}  job {}".format(
+                stage["wall"], stage["rows"], job["upload"], job["job_token"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Matching of the user-entered country and state names to the GADM names.
+
+Supply chain files repeat the same few names thousands of times, so names are
+deduplicated first. Exact and case-insensitive matches are plain lookups. Only
+the remaining unique names are fuzzy-scored, all at once with rapidfuzz (the same
+WRatio + full_process scoring thefuzz.process.extract uses). Candidates can be
+restricted to a group, e.g. the states of the matched country. Best matches are
+memoized across jobs in a bounded LRU cache.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz, process
+from thefuzz import utils
+
+
+class NameMatcher(object):
+    def __init__(self, choices, groups=None, cache_size=20000):
+        """
+        :param choices: names to match against
+        :param groups: group of every choice (same length as choices). When given, names are only
+                       matched against the choices of their own group
+        :param cache_size: number of (group, name) best matches kept between jobs
+        """
+        choices = pd.Series(list(choices))
+        groups = pd.Series([None] * len(choices)) if groups is None else pd.Series(list(groups))
+        self.candidates = {}
+        self.exact = {}
+        self.casefolded = {}
+        for group, members in choices.groupby(groups.fillna("").values, sort=False):
+            members = list(dict.fromkeys(members.dropna()))  # unique, keeps the first occurrence
+            self.candidates[group] = members
+            self.exact[group] = set(members)
+            casefolded = {}
+            for member in members:
+                casefolded.setdefault(member.casefold(), member)
+            self.casefolded[group] = casefolded
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        return None
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    @staticmethod
+    def _groups(groups, size):
+        if groups is None:
+            return [""] * size
+        return ["" if pd.isna(group) else group for group in groups]
+
+    def best_matches(self, names, groups=None):
+        """
+        :param names: iterable of names. Anything that is not a string never matches
+        :param groups: iterable with the group of every name, if the matcher was built with groups
+        :return: dict {(group, name): (best choice, rounded score)}
+        """
+        names = list(names)
+        groups = self._groups(groups, len(names))
+        best = {}
+        pending = {}
+        for key in dict.fromkeys(zip(groups, names)):
+            group, name = key
+            if not isinstance(name, str) or group not in self.candidates:
+                best[key] = ("", 0)
+            elif name in self.exact[group]:
+                best[key] = (name, 100)
+            elif name.casefold() in self.casefolded[group]:
+                best[key] = (self.casefolded[group][name.casefold()], 100)
+            else:
+                cached = self._cached(key)
+                if cached is not None:
+                    best[key] = cached
+                else:
+                    pending.setdefault(group, []).append(name)
+
+        for group, queries in pending.items():
+            candidates = self.candidates[group]
+            if not candidates:
+                best.update({(group, query): ("", 0) for query in queries})
+                continue
+            scores = process.cdist(queries, candidates, scorer=fuzz.WRatio, processor=utils.full_process)
+            positions = scores.argmax(axis=1)
+            for query, position, score in zip(queries, positions, scores[np.arange(len(queries)), positions]):
+                best[(group, query)] = (candidates[position], int(round(score)))
+                self._remember((group, query), best[(group, query)])
+        return best
+
+    def match(self, names, threshold, groups=None):
+        """
+        Same result as thefuzz process.extract(name, choices, limit=1) filtered by the threshold
+        :param names: Series or list of names
+        :param threshold: minimum score (0-100) to accept the best match
+        :param groups: group of every name, see best_matches
+        :return: list with the matched choice for every name, or "" when there is no match
+        """
+        names = list(names)
+        groups = self._groups(groups, len(names))
+        best = self.best_matches(names, groups)
+        return [choice if score >= threshold else "" for choice, score in (best[key] for key in zip(groups, names))]
@@ -0,0 +1,319 @@
+"""
+Reliable redis queue of the food supply chain jobs.
+
+Jobs are scheduled by their estimated cost (see supply_chain_metrics.py), in size
+classes (small, medium, large) that are sorted sets. The score of a job is its
+virtual finish time: the later of the submission time and the finish time of the
+previous job of the same tenant and size class, plus its cost. The lowest score across the
+classes runs first, so:
+- small jobs go ahead of the large ones queued before them;
+- a tenant submitting many jobs does not hold back the others;
+- large jobs still get their turn as time passes.
+At most large_jobs large jobs run at once, so workers are left for the smaller ones.
+
+Idle workers block on the wakeup list, which holds at most one token. A push adds it, and so
+does a worker that takes a job while others are left, so the idle workers wake one after the
+other. Only while the large jobs limit holds back the head of the queue do they look at it
+again every poll_interval.
+
+A popped job is moved, in a transaction, to the processing list of the worker
+that took it and only removed once the job is over. Workers keep a heartbeat
+key alive while they run. When a heartbeat expires (e.g. the worker was
+OOM-killed), the jobs left in its processing list are put back in the queue.
+After max_attempts starts, a job goes to the dead-letter list instead.
+
+The tokens waiting in the queue are also kept in a set, so a job is never queued
+twice.
+
+Status updates of a job are also published to its events channel, so clients can
+follow a job without polling.
+"""
+
+import heapq
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+
+class JobQueue(object):
+    schedule = "job_schedule:{}".format  # size class: sorted set of the waiting tokens
+    queued = "job_queued"  # tokens waiting in the queue
+    costs = "job_costs"  # token: estimated seconds, of the waiting and running jobs
+    started = "job_started"  # token: start time, of the running jobs
+    running = "job_running:{}".format  # size class: set of the running tokens
+    tenants = "job_tenants"  # tenant:size class: virtual finish time of its last job
+    wakeup = "job_wakeup"  # a token while there may be a job to take
+    workers = "job_workers"
+    dead_letter = "job_dead_letter"
+    processing = "job_processing:{}".format
+    heartbeat = "job_heartbeat:{}".format
+
+    # size class: estimated seconds of its largest jobs
+    size_classes = {"small": 30, "medium": 300, "large": float("inf")}
+
+    # job fields published on the events channel, and the statuses after which nothing is
+    event_fields = ("status", "percent_complete", "rows_processed", "segments", "error")
+    final_statuses = ("ready", "error", "failed", "cancelled")
+
+    max_attempts = int(os.environ.get("SUPPLY_CHAIN_MAX_ATTEMPTS", 3))
+    heartbeat_interval = int(os.environ.get("SUPPLY_CHAIN_HEARTBEAT_INTERVAL", 10))
+    heartbeat_ttl = int(os.environ.get("SUPPLY_CHAIN_HEARTBEAT_TTL", 60))
+    # large jobs run at once. By default all the workers but one, at least one
+    large_jobs = int(os.environ.get("SUPPLY_CHAIN_LARGE_JOBS", 0))
+    # seconds between two looks at the queue while the large jobs limit holds back its head
+    poll_interval = int(os.environ.get("SUPPLY_CHAIN_POLL_INTERVAL", 1))
+    dead_letter_size = 1000
+
+    # one heartbeat thread per worker process
+    _heartbeat_pid = None
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+
+    @staticmethod
+    def events(job_token):
+        """Pub/sub channel of the status updates of a job"""
+        if isinstance(job_token, bytes):
+            job_token = job_token.decode("utf-8")
+        return "job_events:{}".format(job_token)
+
+    @classmethod
+    def size_class(cls, cost):
+        return next(size for size, largest in cls.size_classes.items() if cost <= largest)
+
+    @classmethod
+    def finish_tag(cls, pipe, tenant, cost):
+        """
+        Score of a job of the tenant: its virtual finish time. Read before the transaction of push,
+        watching tenants
+        """
+        if tenant is None:
+            return time.time() + cost
+        previous = float(pipe.hget(cls.tenants, cls._tenant_class(tenant, cost)) or 0)
+        return max(time.time(), previous) + cost
+
+    @classmethod
+    def _tenant_class(cls, tenant, cost):
+        return "{}:{}".format(tenant, cls.size_class(cost))
+
+    @classmethod
+    def push(cls, pipe, job_token, cost, tag, tenant=None):
+        """
+        Queues job_token in a transaction. The caller checks the token is not queued yet (see
+        is_queued), watching the queued set
+        :param cost: estimated seconds of the job
+        :param tag: score of the job, see finish_tag
+        :param tenant: the tenant the job is accounted to
+        """
+        pipe.sadd(cls.queued, job_token)
+        pipe.hset(cls.costs, job_token, cost)
+        pipe.zadd(cls.schedule(cls.size_class(cost)), {job_token: tag})
+        if tenant is not None:
+            pipe.hset(cls.tenants, cls._tenant_class(tenant, cost), tag)
+        cls._signal(pipe)
+
+    @classmethod
+    def _signal(cls, pipe):
+        """Wakes an idle worker"""
+        pipe.lpush(cls.wakeup, 1)
+        pipe.ltrim(cls.wakeup, 0, 0)
+
+    @classmethod
+    def remove(cls, pipe, job_token):
+        """Takes a waiting job out of the queue, in a transaction"""
+        for size in cls.size_classes:
+            pipe.zrem(cls.schedule(size), job_token)
+        pipe.srem(cls.queued, job_token)
+        pipe.hdel(cls.costs, job_token)
+
+    @classmethod
+    def _forget(cls, pipe, job_token):
+        """A running job is over"""
+        for size in cls.size_classes:
+            pipe.srem(cls.running(size), job_token)
+        pipe.hdel(cls.costs, job_token)
+        pipe.hdel(cls.started, job_token)
+
+    def is_queued(self, job_token):
+        return bool(self.redis.sismember(self.queued, job_token))
+
+    def _start_heartbeat(self):
+        if JobQueue._heartbeat_pid == os.getpid():
+            return
+        JobQueue._heartbeat_pid = os.getpid()
+        self.redis.set(self.heartbeat(self.worker_id), time.time(), ex=self.heartbeat_ttl)
+
+        def beat():
+            while True:
+                time.sleep(self.heartbeat_interval)
+                try:
+                    self.redis.set(self.heartbeat(self.worker_id), time.time(), ex=self.heartbeat_ttl)
+                except Exception as e:
+                    logging.error("[JobQueue, heartbeat]: " + str(e))
+
+        threading.Thread(target=beat, name="job-heartbeat", daemon=True).start()
+
+    def pop(self, timeout=5):
+        """
+        Next job token, moved to this worker's processing list; None after timeout seconds (0 waits
+        until there is one)
+        """
+        self._start_heartbeat()
+        self.redis.sadd(self.workers, self.worker_id)
+        deadline = time.time() + timeout if timeout else None
+        watched = [self.schedule(size) for size in self.size_classes] + [self.running("large")]
+        while True:
+            # retried if another worker takes a job meanwhile
+            job_token, held_back = self.redis.transaction(self._take, *watched, value_from_callable=True)
+            if job_token is not None:
+                return job_token
+            wait = self.poll_interval if held_back else 0
+            if deadline is not None:
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                wait = min(wait, left) if wait else left
+            # whole seconds, redis 5 does not block for less
+            self.redis.brpop(self.wakeup, timeout=int(math.ceil(wait)))
+
+    def _take(self, pipe):
+        """
+        Moves the job with the lowest score to the processing list
+        :return: (job token, whether large jobs are held back); job token None if there is none to run
+        """
+        heads = {}
+        for size in self.size_classes:
+            head = pipe.zrange(self.schedule(size), 0, 0, withscores=True)
+            if head:
+                heads[size] = head[0]
+        held_back = False
+        if "large" in heads:
+            limit = self.large_jobs or max(pipe.scard(self.workers) - 1, 1)
+            if pipe.scard(self.running("large")) >= limit:
+                del heads["large"]
+                held_back = True
+        if not heads:
+            return None, held_back
+        size = min(heads, key=lambda size: heads[size][1])
+        job_token = heads[size][0]
+        left = len(heads) > 1 or pipe.zcard(self.schedule(size)) > 1
+        pipe.multi()
+        pipe.zrem(self.schedule(size), job_token)
+        pipe.srem(self.queued, job_token)
+        pipe.lpush(self.processing(self.worker_id), job_token)
+        pipe.sadd(self.running(size), job_token)
+        pipe.hset(self.started, job_token, time.time())
+        pipe.hincrby(job_token, "attempts", 1)
+        if left:
+            self._signal(pipe)
+        return job_token, held_back
+
+    def ack(self, job_token):
+        """The job is over (ready or error), it won't be retried"""
+        pipe = self.redis.pipeline()
+        pipe.lrem(self.processing(self.worker_id), 0, job_token)
+        self._forget(pipe, job_token)
+        self._signal(pipe)  # a large job may be waiting for this one
+        pipe.execute()
+
+    def position(self, job_token):
+        """0 for the job popped next, None if the job is not waiting"""
+        pipe = self.redis.pipeline(transaction=False)
+        self.read_schedule(pipe)
+        return self.estimated_start(pipe.execute(), job_token)[0]
+
+    @classmethod
+    def read_schedule(cls, pipe):
+        """Adds the reads estimated_start needs to the pipe"""
+        for size in cls.size_classes:
+            pipe.zrange(cls.schedule(size), 0, -1, withscores=True)
+        for size in cls.size_classes:
+            pipe.smembers(cls.running(size))
+        pipe.hgetall(cls.costs)
+        pipe.hgetall(cls.started)
+        pipe.scard(cls.workers)
+
+    @classmethod
+    def length(cls, replies):
+        """Number of waiting jobs, from the results of the read_schedule commands"""
+        return sum(len(reply) for reply in replies[: len(cls.size_classes)])
+
+    @classmethod
+    def estimated_start(cls, replies, job_token):
+        """
+        Position and estimated start time of a waiting job: the jobs popped before it, and when a worker
+        should be free for it given the estimated cost of those and of the running jobs. The limit of large
+        jobs is not accounted for
+        :param replies: results of the read_schedule commands
+        :return: (position, start time); (None, None) if the job is not waiting
+        """
+        if isinstance(job_token, str):
+            job_token = job_token.encode("utf-8")
+        sizes = len(cls.size_classes)
+        waiting = [token for token, score in sorted(
+            (entry for reply in replies[:sizes] for entry in reply), key=lambda entry: entry[1])]
+        if job_token not in waiting:
+            return None, None
+        running = set().union(*replies[sizes: 2 * sizes])
+        costs, started, workers = replies[2 * sizes:]
+        now = time.time()
+
+        # a worker is free once its running job is over, then takes the jobs in order
+        remaining = sorted(
+            max(float(costs.get(token, 0)) - (now - float(started.get(token, now))), 0) for token in running)
+        free = (remaining + [0.0] * max(workers, 1))[: max(workers, 1)]
+        heapq.heapify(free)
+        position = waiting.index(job_token)
+        for token in waiting[:position]:
+            heapq.heappush(free, heapq.heappop(free) + float(costs.get(token, 0)))
+        return position, now + free[0]
+
+    def requeue_stale(self):
+        """Puts back the jobs of workers whose heartbeat expired, dead-letters the ones out of attempts"""
+        for worker_id in self.redis.smembers(self.workers):
+            worker_id = worker_id.decode("utf-8")
+            if self.redis.exists(self.heartbeat(worker_id)):
+                continue
+            processing = self.processing(worker_id)
+            for job_token in self.redis.lrange(processing, 0, -1):
+                if not self.redis.exists(job_token):  # expired, nobody is waiting for it anymore
+                    self.redis.lrem(processing, 1, job_token)
+                    continue
+                attempts = int(self.redis.hget(job_token, "attempts") or 0)
+                if attempts >= self.max_attempts:
+                    error = "worker died while running the job {} times".format(attempts)
+                    if self.redis.lrem(processing, 1, job_token):
+                        self.bury(job_token, error)
+                elif self.redis.lrem(processing, 1, job_token):
+                    logging.warning("[JobQueue]: requeuing {} from {}".format(job_token, worker_id))
+                    cost = float(self.redis.hget(self.costs, job_token) or 0)
+                    pipe = self.redis.pipeline()
+                    pipe.hset(job_token, "status", "enqueued")
+                    self._forget(pipe, job_token)
+                    if not self.is_queued(job_token):  # or it was resubmitted meanwhile
+                        # ahead of the jobs of its size submitted since it started
+                        self.push(pipe, job_token, cost, time.time())
+                    pipe.publish(self.events(job_token), json.dumps({"status": "enqueued"}))
+                    pipe.execute()
+            if not self.redis.llen(processing):
+                self.redis.srem(self.workers, worker_id)
+
+    def bury(self, job_token, error):
+        """Gives up on a job: moves it to the dead-letter list with its error"""
+        logging.error("[JobQueue]: dead-lettering {}: {}".format(job_token, error))
+        token = job_token.decode("utf-8") if isinstance(job_token, bytes) else job_token
+        attempts = int(self.redis.hget(job_token, "attempts") or 0)
+        pipe = self.redis.pipeline()
+        pipe.lpush(self.dead_letter, json.dumps(
+            {"job_token": token, "error": error, "attempts": attempts, "failed_at": time.time()}))
+        pipe.ltrim(self.dead_letter, 0, self.dead_letter_size - 1)
+        pipe.hset(job_token, mapping={"status": "failed", "error": error, "results": json.dumps({"error": error})})
+        pipe.expire(job_token, 60 * 60)
+        self._forget(pipe, job_token)
+        pipe.publish(self.events(job_token), json.dumps({"status": "failed", "error": error}))
+        pipe.execute()
@@ -0,0 +1,144 @@
+"""
+Reference data of the food supply chain analysis (Aqueduct indicators, crop list,
+GADM names, IFPRI production and water unit geometries).
+
+The worker keeps a single SupplyChainReference in memory, so jobs do not re-read
+and re-parse the inputs. The files are checked for changes before every job and
+reloaded when they are updated.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import geopandas as gpd
+import pandas as pd
+
+try:
+    from aqueduct.services.supply_chain_artifacts import SupplyChainLookups, WATER_UNITS, fingerprint
+    from aqueduct.services.supply_chain_names import NameMatcher
+    from aqueduct.services.supply_chain_spatial import BasinIndex
+except ImportError:  # supply-chain-worker.py runs with the services folder on the path
+    from supply_chain_artifacts import SupplyChainLookups, WATER_UNITS, fingerprint
+    from supply_chain_names import NameMatcher
+    from supply_chain_spatial import BasinIndex
+
+DATA_PATH = "aqueduct/services/supply_chain_data"
+
+
+class SupplyChainReference(object):
+    croplist_path = os.path.join(DATA_PATH, "inputs_ifpri_croplist.csv")  # Full crop names and SPAM_code ID
+    adm_path = os.path.join(DATA_PATH, "inputs_admin_names.csv")  # GADM v3.6 Administative names for levels 1 & 0
+    # Aqueduct geospatial data. Replace with Carto
+    aq_path = os.path.join(DATA_PATH, "inputs_aqueduct30.csv")
+    ifpri_path = os.path.join(DATA_PATH, "inputs_ifpri_production_{}.csv").format
+    # INDICATOR SPECIFIC GEOMETRY (WATERSHEDS OR AQUIFERS)
+    hybas_path = os.path.join(DATA_PATH, "Aqueduct30_{}.shp").format
+    # Lookups built by supply_chain_artifacts.py
+    artifacts_path = os.path.join(DATA_PATH, "artifacts")
+
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        load_time = time.time()
+        # Aqueduct indicators. Read with geopandas so every column is kept as text
+        self.aq = gpd.read_file(self.aq_path)
+        # IFPRI crop names and ID codes
+        self.crops = pd.read_csv(self.croplist_path, index_col=0, header=0)
+        self.admnames = self.read_admnames()
+        # GADM name matching, memoized across jobs
+        self.country_matcher = NameMatcher(self.admnames["NAME_0"])
+        self.state_matcher = NameMatcher(self.admnames["state_full"], groups=self.admnames["NAME_0"])
+        # GADM country names lookup
+        self.country_ids = self.admnames.filter(["GID_0", "NAME_0"]).drop_duplicates()
+
+        # Water units of the countries and states, crop production
+        sources = fingerprint(self.lookup_sources())
+        self.lookups = SupplyChainLookups.load(self.artifacts_path, sources)
+        if self.lookups is None:
+            logging.warning(
+                "[SupplyChainReference]: lookup artifacts missing or outdated, building them in memory. "
+                "Run supply_chain_artifacts.py to build them once"
+            )
+            self.lookups = SupplyChainLookups.build(self.admnames, self.ifpri_paths(), sources)
+
+        self._geometries = {}
+        self._basin_indexes = {}
+        self._mtimes = self._stat()
+        # identifies this load of the inputs, e.g. in the cached locations
+        self.version = hashlib.md5(json.dumps(sorted(self._mtimes.items())).encode()).hexdigest()[:12]
+        logging.info("[SupplyChainReference]: loaded in {} seconds".format(time.time() - load_time))
+
+    @classmethod
+    def read_admnames(cls):
+        """GADM Admin 1 and 0 place names, with their water units"""
+        # encoding should retain non-english characters
+        admnames = pd.read_csv(cls.adm_path, encoding="utf-8-sig")
+        # Make sure lists are lists, not strings
+        admnames["PFAF_ID"] = [json.loads(x) for x in admnames["PFAF_ID"]]
+        admnames["AQID"] = [json.loads(x) for x in admnames["AQID"]]
+        return admnames
+
+    @classmethod
+    def ifpri_paths(cls):
+        return {water_unit: cls.ifpri_path(name) for water_unit, name in WATER_UNITS.items()}
+
+    @classmethod
+    def lookup_sources(cls):
+        """Inputs of the lookup artifacts"""
+        return [cls.adm_path] + list(cls.ifpri_paths().values())
+
+    @classmethod
+    def _paths(cls):
+        paths = [cls.aq_path, cls.croplist_path, os.path.join(cls.artifacts_path, "manifest.json")]
+        paths.extend(cls.lookup_sources())
+        for water_unit in WATER_UNITS:
+            paths.append(cls.hybas_path(water_unit))
+        return paths
+
+    @classmethod
+    def _stat(cls):
+        return {path: os.path.getmtime(path) if os.path.exists(path) else None for path in cls._paths()}
+
+    @classmethod
+    def current(cls):
+        """The loaded reference data; reloaded if any of the input files changed since it was read"""
+        with cls._lock:
+            if cls._current is None or cls._current._mtimes != cls._stat():
+                if cls._current is not None:
+                    logging.info("[SupplyChainReference]: input files changed, reloading")
+                cls._current = cls()
+            return cls._current
+
+    def production(self, water_unit, irrigation_selection):
+        """IFPRI crop production, a ProductionMatrix of water unit x crop"""
+        return self.lookups.production(water_unit, irrigation_selection)
+
+    def geometries(self, water_unit):
+        """Watershed or aquifer polygons"""
+        if water_unit not in self._geometries:
+            path = self.hybas_path(water_unit)
+            if not os.path.exists(path):
+                gz_filename = "{}.gz".format(path)
+                logging.info("Decompressing {}".format(gz_filename))
+                with gzip.open(gz_filename, "rb") as f_in:
+                    with open(path, "wb") as f_out:
+                        shutil.copyfileobj(f_in, f_out)
+                self._mtimes[path] = os.path.getmtime(path)
+            gdf = gpd.read_file(path)
+            gdf = gdf[1:]
+            gdf.rename(columns={water_unit.lower(): water_unit.upper()}, inplace=True)
+            self._geometries[water_unit] = gdf
+        return self._geometries[water_unit]
+
+    def basin_index(self, water_unit):
+        """Spatial index over the water unit polygons, built once and reused by every job"""
+        if water_unit not in self._basin_indexes:
+            self._basin_indexes[water_unit] = BasinIndex(self.geometries(water_unit), water_unit)
+        return self._basin_indexes[water_unit]
@@ -0,0 +1,123 @@
+"""
+Compressed, chunked storage of the supply chain results.
+
+The results document is serialized a batch of records at a time into a single gzip
+stream, which is cut into chunks as it is produced. Neither the worker nor the
+API ever hold the whole JSON document: the API streams the stored chunks as they
+are, wrapped by two small gzip members for the status fields around them
+(concatenated gzip members are a valid gzip body).
+
+Record sections are arrays of {key: value} rows. The columnar format stores one
+array per key instead, with the missing values listed in an explicit null mask
+and label columns (crops, indicator labels...) stored as integer codes.
+"""
+
+import json
+import zlib
+
+import numpy as np
+import pandas as pd
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+CHUNK_SIZE = 1024 * 1024  # compressed bytes per stored chunk
+BATCH_SIZE = 5000  # records serialized at once
+
+
+def gzip_member(text):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(text.encode("utf-8")) + compressor.flush()
+
+
+def gunzip_stream(chunks):
+    """Decompresses a stream of gzip bytes, possibly made of several members, chunk by chunk"""
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+    yield decompressor.flush()
+
+
+class GzipChunkWriter(object):
+    def __init__(self, sink, chunk_size=CHUNK_SIZE):
+        """
+        :param sink: called with every compressed chunk, in order
+        :param chunk_size: size of the chunks passed to the sink, except the last one
+        """
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+        self.buffer = bytearray()
+        self.chunks = 0
+        self.size = 0
+
+    def _emit(self, final=False):
+        while len(self.buffer) >= self.chunk_size or (final and self.buffer):
+            chunk = bytes(self.buffer[: self.chunk_size])
+            del self.buffer[: self.chunk_size]
+            self.sink(chunk)
+            self.chunks += 1
+            self.size += len(chunk)
+
+    def write(self, text):
+        self.buffer += self.compressor.compress(text.encode("utf-8"))
+        self._emit()
+
+    def close(self):
+        self.buffer += self.compressor.flush()
+        self._emit(final=True)
+
+
+def records(frame):
+    """Rows of frame as dicts, None for the missing values"""
+    return frame.astype(object).where(frame.notna(), None).to_dict("records")
+
+
+def columnar(frame, coded=()):
+    """
+    Columns of frame as {"length": rows, "columns": {key: [values]}, "nulls": {key: [rows]},
+    "labels": {key: [labels]}}. Missing values are listed by row in nulls and stored as 0 (or
+    null for text). Columns in coded are stored as indexes into their labels
+    """
+    document = {"length": len(frame), "columns": {}, "nulls": {}, "labels": {}}
+    for key, column in frame.items():
+        missing = column.isna().to_numpy()
+        if missing.any():
+            document["nulls"][key] = np.flatnonzero(missing).tolist()
+        if key in coded:
+            codes, labels = pd.factorize(column)
+            document["columns"][key] = np.where(missing, 0, codes).tolist()
+            document["labels"][key] = labels.tolist()
+        elif column.dtype.kind in "biuf":
+            document["columns"][key] = column.where(~missing, 0).tolist()
+        else:
+            document["columns"][key] = column.astype(object).where(~missing, None).tolist()
+    return document
+
+
+def write_document(writer, sections, **fields):
+    """
+    Writes {"<section>": [records...], ..., "<field>": value} without building it in memory
+    :param writer: GzipChunkWriter
+    :param sections: {name: iterable of lists of records}
+    :param fields: values serialized at once, after the sections
+    """
+    separator = ""
+    writer.write("{")
+    for name, batches in sections.items():
+        writer.write("{}{}: [".format(separator, json.dumps(name)))
+        first = True
+        for batch in batches:
+            if batch:
+                writer.write(("" if first else ", ") + json.dumps(batch)[1:-1])
+                first = False
+        writer.write("]")
+        separator = ", "
+    for name, value in fields.items():
+        writer.write("{}{}: {}".format(separator, json.dumps(name), json.dumps(value)))
+        separator = ", "
+    writer.write("}")
+    writer.close()
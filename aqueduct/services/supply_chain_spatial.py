@@ -0,0 +1,174 @@
+"""
+Spatial index over the watershed / aquifer polygons, used to match the supply
+chain coordinates (point + radius) to the water units they source from.
+
+Radius queries use great-circle distances on a spherical earth. The polygons are
+first filtered by the bounding box of every circle (in longitude / latitude, so
+wider at high latitudes and split at the antimeridian). Those that also reach into
+a box inscribed in the circle are within the radius; for the others the exact
+distance is measured in the azimuthal equidistant projection centred on the point,
+where distances from the centre are true. The polygons the distances are measured
+on are simplified and densified once per resolution, and kept with the index.
+"""
+
+import numpy as np
+import shapely
+
+EARTH_RADIUS = 6371.0088  # mean earth radius, km
+KM_PER_DEGREE = np.pi * EARTH_RADIUS / 180
+# simplification tolerances of the polygons, in degrees
+RESOLUTIONS = (0.001, 0.01, 0.05)
+# the tolerance is at most this share of the smallest radius of a query
+RESOLUTION_ERROR = 0.02
+# longest edge kept when densifying, in degrees: edges are straight in longitude /
+# latitude, not once projected
+SEGMENT_LENGTH = 1.0
+
+
+class BasinIndex(object):
+    def __init__(self, gdf, water_unit):
+        """
+        :param gdf: water unit polygons, as read by SupplyChainReference.geometries
+        :param water_unit: ID column. AQID for aquifers or PFAF_ID for watersheds
+        """
+        self.water_unit = water_unit
+        self.ids = gdf[water_unit].to_numpy()
+        self.geometries = np.asarray(gdf.geometry.values, dtype=object)
+        self.tree = shapely.STRtree(self.geometries)
+        self._simplified = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def simplified(self, resolution):
+        """Polygons simplified with a tolerance of resolution degrees and densified, built once"""
+        if resolution not in self._simplified:
+            geometries = shapely.simplify(self.geometries, resolution, preserve_topology=True)
+            self._simplified[resolution] = shapely.segmentize(geometries, SEGMENT_LENGTH)
+        return self._simplified[resolution]
+
+    @staticmethod
+    def resolution(radius):
+        """Coarsest resolution within RESOLUTION_ERROR of the smallest radius (km)"""
+        radius = np.asarray(radius, dtype=float)
+        radius = radius[radius > 0]
+        if not len(radius):
+            return RESOLUTIONS[0]
+        fine_enough = [r for r in RESOLUTIONS if r * KM_PER_DEGREE <= RESOLUTION_ERROR * radius.min()]
+        return max(fine_enough) if fine_enough else RESOLUTIONS[0]
+
+    def query(self, longitudes, latitudes, radius, resolution=None):
+        """
+        Find all water units within `radius` of every point, in one bulk query
+        :param longitudes: array of longitudes
+        :param latitudes: array of latitudes
+        :param radius: array (or scalar) of radius in km. Must be finite
+        :param resolution: simplification tolerance of the polygons in degrees, by default from the radius
+        :return: (positions, ids) pairs; positions index the input points, ids are the water unit IDs
+        """
+        longitudes = np.asarray(longitudes, dtype=float)
+        latitudes = np.asarray(latitudes, dtype=float)
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), longitudes.shape)
+        if resolution is None:
+            resolution = self.resolution(radius)
+
+        # Candidates: polygons whose bounding box overlaps the one of the circle
+        boxes, box_positions = bounding_boxes(longitudes, latitudes, radius)
+        box_index, basins = self.tree.query(boxes)
+        positions = box_positions[box_index]
+        if len(boxes) > len(longitudes):  # circles split at the antimeridian
+            pairs = np.unique(np.stack([positions, basins]), axis=1)
+            positions, basins = pairs[0], pairs[1]
+
+        # Polygons reaching into the inscribed box are within the radius
+        inner = inscribed_boxes(longitudes, latitudes, radius)
+        inner_positions, inner_basins = self.tree.query(inner, predicate="intersects")
+        pairs = positions * len(self) + basins
+        within = np.isin(pairs, inner_positions * len(self) + inner_basins)
+
+        # Exact distance to the other candidates
+        check = np.flatnonzero(~within)
+        candidates = self.simplified(resolution)[basins[check]].copy()
+        coordinates, owner = shapely.get_coordinates(candidates, return_index=True)
+        centre = positions[check][owner]
+        projected = azimuthal_equidistant(
+            coordinates[:, 0], coordinates[:, 1], longitudes[centre], latitudes[centre])
+        shapely.set_coordinates(candidates, projected)
+        within[check] = shapely.distance(shapely.points(0.0, 0.0), candidates) <= radius[positions[check]]
+
+        # grouped by point, in order of the polygons of the layer
+        order = np.lexsort((basins[within], positions[within]))
+        return positions[within][order], self.ids[basins[within][order]]
+
+
+def bounding_boxes(longitudes, latitudes, radius):
+    """
+    Longitude / latitude boxes enclosing the circles of radius km. Boxes crossing the antimeridian are split in two
+    :return: box polygons, position of the point of each box
+    """
+    distance = radius / EARTH_RADIUS  # angular radius
+    lat = np.radians(latitudes)
+    south = np.degrees(lat - distance)
+    north = np.degrees(lat + distance)
+    # half width of the box; all longitudes when the circle reaches a pole
+    with np.errstate(invalid="ignore", divide="ignore"):
+        half_width = np.degrees(np.arcsin(np.sin(distance) / np.cos(lat)))
+    polar = (north >= 90) | (south <= -90) | np.isnan(half_width)
+    half_width = np.where(polar, 180, half_width)
+    west = np.where(polar, -180, longitudes - half_width)
+    east = np.where(polar, 180, longitudes + half_width)
+    south, north = np.maximum(south, -90), np.minimum(north, 90)
+
+    positions = np.arange(len(longitudes))
+    wraps_west, wraps_east = west < -180, east > 180
+    boxes = shapely.box(np.maximum(west, -180), south, np.minimum(east, 180), north)
+    wrapped = shapely.box(
+        np.where(wraps_west, west + 360, -180)[wraps_west | wraps_east],
+        south[wraps_west | wraps_east],
+        np.where(wraps_east, east - 360, 180)[wraps_west | wraps_east],
+        north[wraps_west | wraps_east],
+    )
+    return np.concatenate([boxes, wrapped]), np.concatenate([positions, positions[wraps_west | wraps_east]])
+
+
+def inscribed_boxes(longitudes, latitudes, radius):
+    """
+    Longitude / latitude boxes within the circles of radius km, empty when the circle reaches a pole or the
+    antimeridian. The distance to the centre is largest at a corner of the box, the corners are checked
+    """
+    half_height = np.degrees(radius / EARTH_RADIUS) / np.sqrt(2)
+    # the box is widest where it is closest to the equator
+    equatorward = np.clip(np.abs(latitudes) - half_height, 0, 90)
+    half_width = half_height / np.maximum(np.cos(np.radians(equatorward)), 1e-12)
+    south, north = latitudes - half_height, latitudes + half_height
+    west, east = longitudes - half_width, longitudes + half_width
+    corners = np.maximum(
+        great_circle(longitudes, latitudes, west, south), great_circle(longitudes, latitudes, west, north))
+    usable = (corners <= radius) & (south > -90) & (north < 90) & (west >= -180) & (east <= 180) & (radius > 0)
+    return np.where(usable, shapely.box(west, south, east, north), None)
+
+
+def great_circle(longitudes, latitudes, other_longitudes, other_latitudes):
+    """Great-circle distance in km (haversine)"""
+    lon, lat = np.radians(longitudes), np.radians(latitudes)
+    lon1, lat1 = np.radians(other_longitudes), np.radians(other_latitudes)
+    h = np.sin((lat1 - lat) / 2) ** 2 + np.cos(lat) * np.cos(lat1) * np.sin((lon1 - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def azimuthal_equidistant(longitudes, latitudes, centre_longitudes, centre_latitudes):
+    """
+    Spherical azimuthal equidistant projection, centred on a point per coordinate
+    :return: (n, 2) array of x, y in km
+    """
+    lon, lat = np.radians(longitudes), np.radians(latitudes)
+    lon0, lat0 = np.radians(centre_longitudes), np.radians(centre_latitudes)
+    dlon = lon - lon0
+    # great-circle distance to the centre (haversine)
+    h = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lat) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    sin_c = np.sin(c)
+    k = np.where(sin_c > 1e-12, c / np.where(sin_c > 1e-12, sin_c, 1), 1.0)
+    x = EARTH_RADIUS * k * np.cos(lat) * np.sin(dlon)
+    y = EARTH_RADIUS * k * (np.cos(lat0) * np.sin(lat) - np.sin(lat0) * np.cos(lat) * np.cos(dlon))
+    return np.column_stack([x, y])
@@ -0,0 +1,170 @@
+"""
+Content-addressed store of the uploaded supply chains.
+
+The API decodes the base64 upload as it is read, a bounded chunk at a time, and
+hashes it on the way, counting its bytes and lines. Before the stored file is
+closed, put can inspect it, e.g. to sample the first rows for the estimated cost
+of the job (see supply_chain_ingest.sample). The decoded file is stored once, keyed by its md5: in the S3
+bucket S3_BUCKET_NAME, or in the directory SUPPLY_CHAIN_UPLOADS_PATH the API shares
+with the workers. Exactly one of them must be set, the same in the API and the
+workers. Only the md5 goes through redis, and identical uploads are stored once.
+
+S3 credentials are S3_ACCESS_KEY_ID and S3_SECRET_ACCESS_KEY, or the AWS ones. The
+API keeps AWS_ACCESS_KEY_ID for its CloudWatch logs.
+
+Local uploads are pruned after SUPPLY_CHAIN_UPLOADS_TTL seconds. Uploads in S3
+should be expired by a lifecycle rule on the uploads/ prefix.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+
+import boto3
+
+CHUNK_SIZE = 1024 * 1024  # bytes read from the upload at once
+NOT_BASE64 = re.compile(rb"[^A-Za-z0-9+/=]")
+
+
+def s3_client():
+    session = boto3.session.Session()
+    access_key_id = os.environ.get("S3_ACCESS_KEY_ID", os.environ.get("AWS_ACCESS_KEY_ID"))
+    secret_access_key = os.environ.get("S3_SECRET_ACCESS_KEY", os.environ.get("AWS_SECRET_ACCESS_KEY"))
+    if os.environ.get("ENDPOINT_URL"):
+        return session.client(
+            service_name="s3",
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            endpoint_url=os.environ.get("ENDPOINT_URL"),
+        )
+    return session.client(
+        service_name="s3",
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+    )
+
+
+def read_stream(stream, chunk_size=CHUNK_SIZE):
+    """The bytes of a file object, chunk_size at a time"""
+    return iter(lambda: stream.read(chunk_size), b"")
+
+
+def decode_base64(chunks):
+    """
+    Decodes a stream of base64 bytes chunk by chunk. As base64.b64decode, characters out of the
+    base64 alphabet (e.g. line breaks) are skipped
+    """
+    pending = b""
+    for chunk in chunks:
+        pending += NOT_BASE64.sub(b"", chunk)
+        # whole groups of 4 characters only
+        usable = len(pending) - len(pending) % 4
+        if usable:
+            yield base64.b64decode(pending[:usable])
+            pending = pending[usable:]
+    if pending:
+        yield base64.b64decode(pending)
+
+
+class UploadStore(object):
+    path = os.environ.get("SUPPLY_CHAIN_UPLOADS_PATH")
+    ttl = int(os.environ.get("SUPPLY_CHAIN_UPLOADS_TTL", 24 * 60 * 60))
+    prefix = "food-supply-chain/uploads/"
+
+    def __init__(self, bucket=None, path=None):
+        """
+        :param bucket: S3 bucket of the uploads, S3_BUCKET_NAME by default. "" for the local store
+        :param path: directory of the local store, SUPPLY_CHAIN_UPLOADS_PATH by default
+        """
+        self.bucket = bucket if bucket is not None else os.environ.get("S3_BUCKET_NAME")
+        if path is not None:
+            self.path = path
+        # an API and workers storing in different places lose every upload
+        if self.bucket and self.path:
+            raise Exception("Set S3_BUCKET_NAME or SUPPLY_CHAIN_UPLOADS_PATH for the uploads, not both")
+        if not self.bucket and not self.path:
+            raise Exception("Set S3_BUCKET_NAME or SUPPLY_CHAIN_UPLOADS_PATH for the uploads")
+        # of the last upload put: first bytes, size and line breaks, and what inspect returned
+        self.head, self.size, self.lines = b"", 0, 0
+        self.inspected = None
+
+    def put(self, chunks, inspect=None):
+        """
+        Stores the upload, unless the same content is already stored. Sets head, size, lines and inspected
+        :param chunks: bytes of the upload
+        :param inspect: called with the stored upload, a file object at its start, once it is complete
+        :return: md5 of the upload, its key in the store
+        """
+        md5 = hashlib.md5()
+        chunks = self._count(chunks)
+        self.inspected = None
+        if self.bucket:
+            with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as body:
+                for chunk in chunks:
+                    md5.update(chunk)
+                    body.write(chunk)
+                key = md5.hexdigest()
+                self._inspect(body, inspect)
+                s3 = s3_client()
+                if not self._in_bucket(s3, key):
+                    body.seek(0)
+                    s3.upload_fileobj(body, self.bucket, self.prefix + key)
+            return key
+
+        os.makedirs(self.path, exist_ok=True)
+        self.prune()
+        with tempfile.NamedTemporaryFile(dir=self.path, prefix=".upload-", delete=False) as f:
+            try:
+                for chunk in chunks:
+                    md5.update(chunk)
+                    f.write(chunk)
+                self._inspect(f, inspect)
+            except Exception:
+                os.remove(f.name)
+                raise
+        key = md5.hexdigest()
+        # renamed once complete, so a stored upload is never partial
+        os.replace(f.name, os.path.join(self.path, key))
+        return key
+
+    def _inspect(self, f, inspect):
+        if inspect is not None:
+            f.seek(0)
+            self.inspected = inspect(f)
+
+    def _count(self, chunks):
+        self.head, self.size, self.lines = b"", 0, 0
+        for chunk in chunks:
+            if len(self.head) < 4:
+                self.head += chunk[: 4 - len(self.head)]
+            self.size += len(chunk)
+            self.lines += chunk.count(b"\n")
+            yield chunk
+
+    def get(self, key):
+        """Content of the upload"""
+        if self.bucket:
+            return s3_client().get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"].read()
+        with open(os.path.join(self.path, key), "rb") as f:
+            return f.read()
+
+    def _in_bucket(self, s3, key):
+        try:
+            s3.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except Exception:
+            return False
+
+    def prune(self):
+        """Removes the local uploads older than ttl"""
+        oldest = time.time() - self.ttl
+        for entry in os.scandir(self.path):
+            try:
+                if entry.stat().st_mtime < oldest:
+                    os.remove(entry.path)
+            except OSError as e:  # removed by another process
+                logging.debug("[UploadStore]: {}".format(e))
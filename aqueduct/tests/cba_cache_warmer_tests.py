@@ -0,0 +1,74 @@
+import importlib.util
+
+import pytest
+import sqlalchemy
+
+WARMER = "aqueduct/workers/cba-cache-warmer.py"
+
+LOG = (
+    '10.0.0.1 - - [12/Mar/2024:10:00:00 +0000] "GET /api/v1/aqueduct/analysis/cba?geogunit_unique_name=Spain'
+    "&scenario=optimistic&existing_prot=null&prot_fut=100&implementation_start=2020&implementation_end=2035"
+    "&infrastructure_life=30&benefits_start=2030&ref_year=2050&estimated_costs=null&discount_rate=0.05"
+    '&om_costs=0.01&user_urb_cost=null&user_rur_cost=null HTTP/1.1" 200 512 "-" "python-requests/2.31"\n'
+    '10.0.0.2 - - [12/Mar/2024:10:00:01 +0000] "GET /api/v1/aqueduct/analysis/cba/widget/table/?'
+    'geogunit_unique_name=Spain&scenario=optimistic HTTP/1.1" 200 2048 "-" "Mozilla/5.0"\n'
+    '10.0.0.3 - - [12/Mar/2024:10:00:02 +0000] "GET /api/v1/aqueduct/analysis/cba/default?'
+    'geogunit_unique_name=Lima%2C%20Peru&scenario=pessimistic HTTP/1.1" 200 128 "-" "-"\n'
+    # not CBA requests, or truncated request lines
+    '10.0.0.4 - - [12/Mar/2024:10:00:03 +0000] "GET /api/v1/aqueduct/analysis/risk?wscheme=x HTTP/1.1" 200 9 "-" "-"\n'
+    '10.0.0.5 - - [12/Mar/2024:10:00:04 +0000] "POST /api/v1/aqueduct/analysis/cba?scenario=x HTTP/1.1" 405 0 "-" "-"\n'
+    '10.0.0.6 - - [12/Mar/2024:10:00:05 +0000] "GET /api/v1/aqueduct/analysis/cba?geogunit_unique_name=Spa\n'
+    "\n"
+    "[2024-03-12 10:00:06 +0000] [8] [INFO] Worker spawned (pid: 9)\n"
+)
+
+# the CBA_SCHEMA values sorted by parameter name, as in CBAICache
+KEY = "2030_0.05_None_None_{}_2035_2020_30_0.01_100_2050_optimistic_None_None"
+
+
+@pytest.fixture(scope="module")
+def warmer(client):
+    spec = importlib.util.spec_from_file_location("cba_cache_warmer", WARMER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_read_log(warmer, tmp_path):
+    log = tmp_path / "access.log"
+    log.write_text(LOG)
+    requests = list(warmer.read_log(str(log)))
+    assert [kind for kind, _ in requests] == ["cba", "cba", "default"]
+    assert requests[0][1]["implementation_end"] == "2035"
+    assert requests[0][1]["estimated_costs"] == "null"
+    assert requests[1][1] == {"geogunit_unique_name": "Spain", "scenario": "optimistic"}
+    assert requests[2][1]["geogunit_unique_name"] == "Lima, Peru"
+
+
+def test_parse_key(warmer):
+    params = warmer.parse_key(KEY.format("Spain"))
+    assert params["geogunit_unique_name"] == "Spain"
+    assert (params["benefits_start"], params["scenario"], params["user_urb_cost"]) == ("2030", "optimistic", "null")
+    # unit names can contain the separator
+    assert warmer.parse_key(KEY.format("Rio_de_Janeiro"))["geogunit_unique_name"] == "Rio_de_Janeiro"
+    # too few values
+    assert warmer.parse_key("2030_0.05_Spain") is None
+    assert warmer.parse_key("") is None
+
+
+def test_read_recent_window(warmer, tmp_path, monkeypatch):
+    database = "sqlite:///{}".format(tmp_path / "cache.db")
+    monkeypatch.setenv("POSTGRES_URL", database)
+    assert warmer.read_recent(2, expire=False) == []  # no cache table yet
+
+    engine = sqlalchemy.create_engine(database)
+    engine.execute("CREATE TABLE cache_cba (key TEXT, last_updated TIMESTAMP)")
+    for day, name in enumerate(["Spain", "France", "garbage", "Peru"], 1):
+        key = "2030_0.05" if name == "garbage" else KEY.format(name)
+        engine.execute("INSERT INTO cache_cba VALUES (?, ?)", key, "2024-03-{:02d} 10:00:00".format(day))
+    engine.dispose()
+
+    assert [params["geogunit_unique_name"] for _, params in warmer.read_recent(2, expire=False)] == ["Peru"]
+    recent = warmer.read_recent(10, expire=False)
+    assert [kind for kind, _ in recent] == ["cba"] * 3
+    assert [params["geogunit_unique_name"] for _, params in recent] == ["Peru", "France", "Spain"]
@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests_mock
+from RWAPIMicroservicePython.test_utils import mock_request_validation
+
+CBA_QUERY = (
+    "geogunit_unique_name=Spain&scenario=optimistic&existing_prot=null&prot_fut=100"
+    "&implementation_start=2020&implementation_end=2035&infrastructure_life=30"
+    "&benefits_start=2030&ref_year=2050&estimated_costs=null&discount_rate=0.05"
+    "&om_costs=0.01&user_urb_cost=null&user_rur_cost=null"
+)
+
+
+@pytest.fixture
+def end_service(client):
+    from aqueduct.services.cba_service import CBAEndService
+
+    years = np.arange(2010, 2081)
+    df = pd.DataFrame(
+        {
+            column: np.linspace(1, 100, len(years))
+            for column in [
+                "urb_benefits_avg",
+                "gdp_costs_avg",
+                "pop_benefits_avg",
+                "gdp_benefits_avg",
+                "prot_present_avg",
+                "prot_future_avg",
+            ]
+        },
+        index=pd.Index(years, name="year"),
+    )
+    meta = {
+        "implementionStart": 2020,
+        "implementionEnd": 2035,
+        "infrastructureLifespan": 30,
+        "benefitsStart": 2030,
+        "discount": 0.05,
+        "om": 0.01,
+    }
+    service = CBAEndService.__new__(CBAEndService)
+    service.data = {"meta": meta, "df": df}
+    return service
+
+
+def test_cba_widgets_keep_their_own_meta(end_service):
+    widgets = end_service.get_widgets(["annual_costs", "flood_prot", "table"])
+    assert [widget["meta"].get("yAxisTitle") for widget in widgets] == [
+        "Cost and Benefits ($)",
+        "Protection level (Return period)",
+        None,
+    ]
+
+
+def test_cba_widget_mainteinance_only_within_lifespan(end_service):
+    data = pd.DataFrame(end_service.widget_mainteinance()["data"]).set_index("year")
+    assert data.loc[:2019, "value"].isna().all()
+    assert data.loc[2051:, "value"].isna().all()
+    assert data.loc[2020:2050, "value"].notna().all()
+
+
+@requests_mock.mock(kw="mocker")
+def test_get_cba_widgets_unknown_widget(client, mocker):
+    mock_request_validation(mocker, microservice_token=os.getenv("MICROSERVICE_TOKEN"))
+
+    response = client.get(
+        f"/api/v1/aqueduct/analysis/cba/widgets?widgets=table,pie&{CBA_QUERY}",
+        headers={"x-api-key": "api-key-test"},
+    )
+    assert response.status_code == 400
+    assert response.json == {"errors": [{"detail": "Unknown widgets: pie", "status": 400}]}
@@ -1,10 +1,17 @@
+import importlib
 import os
+
+import fakeredis
 import pytest
 from moto import mock_logs
 
 
 @pytest.fixture(scope="package")
 def client():
+    """
+    Test client of the app. Importing any aqueduct module creates the app, which registers with the
+    gateway and CloudWatch: tests import them in fixtures depending on this one, not at module level
+    """
     mocked_log = mock_logs()
     mocked_log.start()
 
@@ -20,3 +27,67 @@ def client():
 
     yield client
     mocked_log.stop()
+
+
+def imported(module, name=None):
+    """Fixture of an aqueduct module, or of a name in it, imported once the app is mocked (see client)"""
+
+    @pytest.fixture(scope="package")
+    def fixture(client):
+        imported_module = importlib.import_module(module)
+        return getattr(imported_module, name) if name else imported_module
+
+    return fixture
+
+
+artifacts = imported("aqueduct.services.supply_chain_artifacts")
+codec = imported("aqueduct.utils.frame_codec")
+ingest = imported("aqueduct.services.supply_chain_ingest")
+metrics = imported("aqueduct.services.supply_chain_metrics")
+results = imported("aqueduct.services.supply_chain_results")
+uploads = imported("aqueduct.services.supply_chain_uploads")
+interp_extrap1d = imported("aqueduct.utils.interpolation", "interp_extrap1d")
+BasinIndex = imported("aqueduct.services.supply_chain_spatial", "BasinIndex")
+FoodSupplyChainService = imported("aqueduct.services.food_supply_chain_service", "FoodSupplyChainService")
+JobQueue = imported("aqueduct.services.supply_chain_queue", "JobQueue")
+location_cache = imported("aqueduct.services.supply_chain_location_cache")
+NameMatcher = imported("aqueduct.services.supply_chain_names", "NameMatcher")
+
+
+@pytest.fixture
+def fake_redis(JobQueue):
+    """An empty redis, seen by a new worker"""
+    JobQueue._heartbeat_pid = None
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def new_service(FoodSupplyChainService, fake_redis, monkeypatch):
+    """Factory of services on fake_redis, taking the arguments of FoodSupplyChainService"""
+    monkeypatch.setenv("REDIS_URL", "redis://localhost:6379")  # replaced by fake_redis
+
+    def create(**kwargs):
+        service = FoodSupplyChainService(**kwargs)
+        service.redis = fake_redis
+        return service
+
+    return create
+
+
+@pytest.fixture
+def job(new_service, JobQueue):
+    """
+    Factory of the service of the enqueued job "job" of the indicator and threshold. It is queued with
+    its cost after the (job token, cost) of ahead
+    """
+
+    def create(user_indicator="bws", user_threshold=0.5, cost=1, ahead=()):
+        service = new_service(job_token="job", user_indicator=user_indicator, user_threshold=user_threshold)
+        service.redis.hset("job", mapping={
+            "user_indicator": user_indicator, "user_threshold": user_threshold, "status": "enqueued",
+            "percent_complete": 5, "results": "{}"})
+        for tag, (job_token, job_cost) in enumerate([*ahead, ("job", cost)], 1):
+            JobQueue.push(service.redis, job_token, job_cost, tag)
+        return service
+
+    return create
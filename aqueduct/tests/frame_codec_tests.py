@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def cba_frame():
+    years = np.arange(2010, 2111)
+    return pd.DataFrame(
+        {"urb_benefits_avg": np.linspace(0, 1e6, len(years)), "gdp_costs_avg": np.nan, "prot_present_avg": 10.0},
+        index=pd.Index(years, name="year"),
+    )
+
+
+def test_frame_round_trip(codec):
+    df = cba_frame()
+    pd.testing.assert_frame_equal(codec.decode_frame(codec.encode_frame(df)), df)
+
+
+def test_frame_round_trip_mixed_dtypes_keeps_column_order(codec):
+    df = cba_frame()
+    df.insert(1, "models", np.arange(len(df), dtype=np.int32))
+    df["flag"] = df["models"] > 50
+    decoded = codec.decode_frame(memoryview(codec.encode_frame(df)))
+    pd.testing.assert_frame_equal(decoded, df)
+
+
+def test_decoded_frame_is_a_view_on_the_buffer(codec):
+    buffer = codec.encode_frame(cba_frame())
+    decoded = codec.decode_frame(buffer)
+    assert np.shares_memory(decoded.values, np.frombuffer(buffer, dtype=np.uint8))
+
+
+def test_frame_codec_rejects_non_numeric_columns(codec):
+    df = cba_frame()
+    df["name"] = "Spain"
+    with pytest.raises(ValueError):
+        codec.encode_frame(df)
+    with pytest.raises(ValueError):
+        codec.decode_frame(b'{"meta": {}, "data": []}')
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from scipy.interpolate import interp1d
+
+YEARS = [2010.0, 2030.0, 2050.0, 2080.0]
+TIME_SERIES = np.arange(2000, 2101)
+
+
+def pointwise_extrap1d(xp, fp, x):
+    """Reference implementation: the per-element extrap1d the services used to have"""
+    interpolator = interp1d(xp, fp)
+    xs = interpolator.x
+    ys = interpolator.y
+
+    def pointwise(value):
+        if value < xs[0]:
+            return ys[0] + (value - xs[0]) * (ys[1] - ys[0]) / (xs[1] - xs[0])
+        elif value > xs[-1]:
+            return ys[-1] + (value - xs[-1]) * (ys[-1] - ys[-2]) / (xs[-1] - xs[-2])
+        else:
+            return interpolator(value)
+
+    return np.fromiter(map(pointwise, np.array(x)), dtype=float)
+
+
+@pytest.mark.parametrize(
+    "fp",
+    [
+        [2.0, 10.0, 25.0, 100.0],
+        [1000.0, 500.0, 250.0, 100.0],
+        [0.0, 0.0, 0.0, 0.0],
+        [np.nan, 10.0, 25.0, 100.0],
+    ],
+)
+def test_interp_extrap1d_matches_pointwise_extrap1d(interp_extrap1d, fp):
+    expected = pointwise_extrap1d(YEARS, fp, TIME_SERIES)
+    np.testing.assert_allclose(interp_extrap1d(YEARS, fp, TIME_SERIES), expected, equal_nan=True)
+
+
+def test_interp_extrap1d_matches_interp1d_extrapolate(interp_extrap1d):
+    fp = [3.5, 7.25, 12.0, 4.0]
+    expected = interp1d(YEARS, fp, kind="linear", bounds_error=False, fill_value="extrapolate")(TIME_SERIES)
+    np.testing.assert_allclose(interp_extrap1d(YEARS, fp, TIME_SERIES), expected)
+
+
+def test_interp_extrap1d_relative_benefit_with_unsorted_points(interp_extrap1d):
+    # benefits_start can come after implementation_end
+    benefit_increase = [2050, 2035]
+    expected = pointwise_extrap1d(benefit_increase, [0.0, 1.0], TIME_SERIES)
+    np.testing.assert_allclose(interp_extrap1d(benefit_increase, [0.0, 1.0], TIME_SERIES), expected)
+
+
+def test_interp_extrap1d_batch_of_curves(interp_extrap1d):
+    curves = np.array([[2.0, 10.0, 25.0, 100.0], [5.0, 4.0, 3.0, 1.0], [0.0, 1.0, 0.0, 1.0]])
+    result = interp_extrap1d(YEARS, curves, TIME_SERIES)
+    assert result.shape == (3, len(TIME_SERIES))
+    for curve, row in zip(curves, result):
+        np.testing.assert_allclose(row, pointwise_extrap1d(YEARS, curve, TIME_SERIES))
+
+
+def test_interp_extrap1d_needs_two_points(interp_extrap1d):
+    with pytest.raises(ValueError):
+        interp_extrap1d([2010.0], [1.0], TIME_SERIES)
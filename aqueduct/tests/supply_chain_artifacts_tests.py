@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+
+def test_csr_explode_keeps_the_order_of_the_lists(artifacts):
+    lookup = artifacts.CSRLookup.from_lists(["PER", "CHL", "PER", "ARG"], [[3, 1], [7], [2], []])
+    positions, values = lookup.explode(["PER", "XXX", "CHL", "ARG", "PER"])
+    assert positions.tolist() == [0, 0, 0, 2, 4, 4, 4]
+    assert values.tolist() == [3, 1, 2, 7, 3, 1, 2]
+
+
+def test_saved_artifacts_are_memory_mapped(artifacts, tmp_path):
+    admnames = pd.DataFrame({
+        "GID_0": ["PER", "PER"],
+        "GID_1": ["PER.1", "PER.2"],
+        "PFAF_ID": [[11, 12], [13]],
+        "AQID": [[1], [2]],
+    })
+    production = tmp_path / "production.csv"
+    pd.DataFrame({"AQID": [2, 1], "MAIZ_A": [5.0, 20.0], "MAIZ_I": [1.0, 2.0], "RICE_A": [0.0, 30.0]}).to_csv(
+        production, index=False)
+    sources = {"production.csv": "md5"}
+    artifacts.SupplyChainLookups.build(admnames, {"PFAF_ID": "missing.csv", "AQID": str(production)}, sources).save(tmp_path)
+
+    assert artifacts.SupplyChainLookups.load(tmp_path, {"production.csv": "other"}) is None
+    lookups = artifacts.SupplyChainLookups.load(tmp_path, sources)
+    assert isinstance(lookups.arrays["AQID.production_a"], np.memmap)
+    assert lookups.admin_basins("PFAF_ID", "gid0").explode(["PER"])[1].tolist() == [11, 12, 13]
+    matrix = lookups.production("AQID", "_a")
+    assert np.allclose(matrix.lookup([1, 2, 1, 3], ["rice", "maiz", "whea", "maiz"]), [30.0, 5.0, np.nan, np.nan],
+                       equal_nan=True)
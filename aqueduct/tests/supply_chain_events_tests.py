@@ -0,0 +1,59 @@
+import json
+import time
+
+import pytest
+
+
+def queued(job):
+    # after "other", on the only worker
+    return job(cost=5, ahead=[("other", 10)])
+
+
+def test_status_in_one_round_trip(job):
+    status = queued(job).status()
+    assert status["status"] == "enqueued"
+    assert status["queue_length"] == 2
+    assert status["queue_position"] == 1
+    assert 9 < status["estimated_start"] - time.time() < 11
+
+
+def test_updates_are_published(job, JobQueue):
+    job = queued(job)
+    pubsub = job.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(JobQueue.events("job"))
+    pubsub.get_message(timeout=1)  # subscription confirmation
+
+    job.last_update = float("inf")  # progress waits for the next update
+    job.set_percent_complete(40)
+    assert job.redis.hget("job", "percent_complete") == b"5"
+    job.update_job(status="running")
+    assert job.redis.hmget("job", "status", "percent_complete") == [b"running", b"40"]
+    assert json.loads(pubsub.get_message(timeout=1)["data"]) == {"status": "running", "percent_complete": 40}
+
+
+def test_events_end_with_the_job(job):
+    job = queued(job)
+    events = job.events(timeout=5, keepalive=0.1)
+    assert next(events) == {"status": "enqueued", "percent_complete": 5, "rows_processed": 0, "segments": 0}
+    assert next(events) is None  # keepalive
+    job.update_job(status="ready", percent_complete=100)
+    assert next(events) == {"status": "ready", "percent_complete": 100}
+    assert list(events) == []
+
+
+def test_unknown_job(job):
+    job = queued(job)
+    job.job_token = "unknown"
+    expected = {"status": "invalid-job-token", "percent_complete": 0}
+    assert job.status() == dict(expected, job_token="unknown")
+    assert list(job.events(timeout=1)) == [expected]
+
+
+@pytest.mark.parametrize("path", ["", "/segments", "/events"])
+def test_unknown_job_not_found(client, fake_redis, monkeypatch, path):
+    import redis
+
+    monkeypatch.setenv("REDIS_URL", "redis://localhost:6379")
+    monkeypatch.setattr(redis, "Redis", lambda **kwargs: fake_redis)
+    response = client.get("/api/v1/aqueduct/analysis/food-supply-chain/unknown" + path)
+    assert response.status_code == 404
@@ -0,0 +1,50 @@
+import io
+
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def service(new_service):
+    return new_service(indicators={"bws": 0.25, "cep": 0.5})
+
+
+def test_indicators_scored_at_once(service):
+    df_aq = pd.DataFrame({
+        "pfaf_id": ["1", "2", "2", "3"],
+        "bws_raw": ["0.5", "0.1", "0.1", "0.9"],
+        "bws_label": ["High", "Low", "Low", "Extremely High"],
+        "cep_raw": ["0.75", "1", "1", "0.2"],
+        "cep_label": ["Medium", "High", "High", "Low"],
+    })
+    basins = pd.Series([2, 1, 2])
+
+    both = service.indicator_values(df_aq, "PFAF_ID", basins, {"bws": 0.25, "cep": 0.5})
+    assert both["PFAF_ID"].tolist() == [1, 2]
+    for indicator, threshold in [("bws", 0.25), ("cep", 0.5)]:
+        single = service.indicator_values(df_aq, "PFAF_ID", basins, {indicator: threshold})
+        pd.testing.assert_frame_equal(both[single.columns], single)
+    assert both["bws % Change Required"].tolist() == [50, 0]
+    assert both["cep % Change Required"].tolist() == [33, 50]
+
+
+def test_payload_keys_keep_the_indicator(service):
+    assert service.payload_key("bws Raw Value") == "rv"
+    assert service.payload_key("bws Raw Value", prefixed=True) == "bws_rv"
+    assert service.payload_key("cep % Change Required", prefixed=True) == "cep_pcr"
+    assert service.payload_key("Material Type", prefixed=True) == "mt"
+    assert {"bws_s", "cep_s", "cn"} <= service.payload_coded_keys()
+
+
+@pytest.mark.parametrize("query", [
+    "indicators=bws,xyz&thresholds=0.5,0.5",
+    "indicators=bws,bwd&thresholds=0.5",
+    "indicators=bws,bws&thresholds=0.5,0.5",
+    "indicators=bws&thresholds=high",
+])
+def test_invalid_indicators(client, query):
+    response = client.post(
+        "/api/v1/aqueduct/analysis/food-supply-chain?" + query,
+        data={"data": (io.BytesIO(b"eA=="), "supply_chain.xlsx.b64")},
+    )
+    assert response.status_code == 400
@@ -0,0 +1,95 @@
+import io
+
+import pandas as pd
+import pytest
+
+TEMPLATE = "aqueduct/services/supply_chain_data/template_supply_chain_v20210701_example2.xlsx"
+
+
+def test_workbook_chunks_match_read_excel(ingest):
+    with open(TEMPLATE, "rb") as f:
+        content = f.read()
+    assert ingest.upload_format(content) == "xlsx"
+
+    expected = pd.read_excel(io.BytesIO(content), header=4)
+    expected.index = pd.Index(range(6, len(expected) + 6), name="row")
+    expected = expected.astype({column: object for column in ingest.TEXT_COLUMNS})
+
+    chunks = list(ingest.read_chunks(content, chunk_rows=20000))
+    assert [len(df) for df, _ in chunks] == [20000, 20000, len(expected) - 40000]
+    assert chunks[-1][1] == 1
+    pd.testing.assert_frame_equal(pd.concat([df for df, _ in chunks]), expected)
+
+
+def test_sample_of_the_stored_upload(ingest):
+    with open(TEMPLATE, "rb") as f:
+        content = f.read()
+        f.seek(0)
+        df, rows = ingest.sample(f, len(content), content.count(b"\n"), rows=100)
+    assert len(df) == 100 and "Latitude" in df
+    assert rows == pytest.approx(sum(len(df) for df, _ in ingest.read_chunks(content)), rel=0.01)
+
+    content = b"Location ID,Country\n" + b"".join(b"%d,Peru\n" % row for row in range(500))
+    df, rows = ingest.sample(io.BytesIO(content), len(content), content.count(b"\n"), rows=100)
+    assert (len(df), rows) == (100, 500)
+    df, rows = ingest.sample(io.BytesIO(content), len(content), content.count(b"\n"))
+    assert (len(df), rows) == (500, 500)
+    # read by the worker, which reports what is wrong
+    content = b"PK\x03\x04 not a workbook"
+    df, rows = ingest.sample(io.BytesIO(content), len(content), 0)
+    assert df.empty
+
+
+def test_legacy_workbooks(ingest):
+    import datetime
+
+    import xlrd
+
+    content = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1" + b"\x00" * 504
+    assert ingest.upload_format(content) == "xls"
+    # not parsed as CSV
+    with pytest.raises(ValueError, match="Could not read the uploaded file"):
+        next(ingest.read_chunks(content))
+
+    cells = [
+        xlrd.sheet.Cell(xlrd.XL_CELL_NUMBER, 3.0),
+        xlrd.sheet.Cell(xlrd.XL_CELL_NUMBER, 2.5),
+        xlrd.sheet.Cell(xlrd.XL_CELL_TEXT, "Peru"),
+        xlrd.sheet.Cell(xlrd.XL_CELL_EMPTY, ""),
+        xlrd.sheet.Cell(xlrd.XL_CELL_DATE, 43831.0),
+        xlrd.sheet.Cell(xlrd.XL_CELL_BOOLEAN, 1),
+    ]
+    values = [ingest._xls_value(cell, datemode=0) for cell in cells]
+    assert values == [3, 2.5, "Peru", "", datetime.datetime(2020, 1, 1), True]
+    assert type(values[0]) is int
+
+
+def test_csv_with_template_title_lines(ingest):
+    content = (
+        b"Supply Chain Analysis template,,\n"
+        b",,\n"
+        b"Location ID,Country,Material Type\n"
+        b"1,Peru,CORN\n"
+        b"2,Chile,WHEAT\n"
+        b"3,,RICE\n"
+    )
+    assert ingest.upload_format(content) == "csv"
+
+    chunks = list(ingest.read_chunks(content, chunk_rows=2))
+    assert [df.index.tolist() for df, _ in chunks] == [[4, 5], [6]]
+    df = pd.concat([df for df, _ in chunks])
+    assert df["Material Type"].tolist() == ["CORN", "WHEAT", "RICE"]
+    assert df["Country"].dtype == object
+    assert pd.isna(df.loc[6, "Country"])
+
+
+def test_parquet_without_pyarrow(ingest):
+    try:
+        import pyarrow  # noqa: F401
+        pytest.skip("pyarrow is installed")
+    except ImportError:
+        pass
+    content = b"PAR1" + b"\0" * 16
+    assert ingest.upload_format(content) == "parquet"
+    with pytest.raises(ValueError, match="pyarrow"):
+        list(ingest.read_chunks(content))
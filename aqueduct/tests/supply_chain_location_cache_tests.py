@@ -0,0 +1,23 @@
+import pandas as pd
+
+
+def test_locations_are_cached_per_resolution_version(location_cache, fake_redis, monkeypatch):
+    df_waterunits = pd.DataFrame({"row": [6, 7], "PFAF_ID": [111011, 111012], "Crop_Name": ["wheat", "maize"]})
+    df_errorlog = pd.DataFrame({"row": [8], "Error": ["Invalid Material Type"]})
+    cache = location_cache.LocationCache(fake_redis, "md5", "PFAF_ID", "reference")
+    assert cache.get() is None
+    cache.set(df_waterunits, df_errorlog)
+    cached = location_cache.LocationCache(fake_redis, "md5", "PFAF_ID", "reference").get()
+    pd.testing.assert_frame_equal(cached[0], df_waterunits)
+    pd.testing.assert_frame_equal(cached[1], df_errorlog)
+
+    # resolved by an older version of the matching
+    monkeypatch.setattr(location_cache, "RESOLUTION_VERSION", location_cache.RESOLUTION_VERSION + 1)
+    assert location_cache.LocationCache(fake_redis, "md5", "PFAF_ID", "reference").get() is None
+
+
+def test_unreadable_locations_are_discarded(location_cache, fake_redis):
+    cache = location_cache.LocationCache(fake_redis, "md5", "PFAF_ID", "reference")
+    fake_redis.set(cache.key, b"not compressed")
+    assert cache.get() is None
+    assert not fake_redis.exists(cache.key)
@@ -0,0 +1,42 @@
+import json
+
+
+def test_spans_add_up_by_stage(metrics):
+    spans = metrics.StageSpans()
+    for chunk in spans.iterate("read", [[1, 2], [3]], rows=len):
+        with spans.span("clean") as span:
+            span.rows = len(chunk)
+    spans.start("upload").stop()
+
+    summary = spans.summary()
+    assert list(summary) == ["read", "clean", "upload"]
+    assert (summary["read"]["calls"], summary["read"]["rows"]) == (2, 3)
+    assert (summary["clean"]["calls"], summary["clean"]["rows"]) == (2, 3)
+    assert set(summary["upload"]) == {"wall", "cpu", "peak_rss_delta", "rows", "calls"}
+
+
+def test_histograms_across_jobs(metrics, fake_redis):
+    for job_token in [b"a", b"b"]:
+        spans = metrics.StageSpans()
+        spans.start("points").stop(rows=10)
+        pipe = fake_redis.pipeline()
+        spans.record(pipe, job_token, upload="md5")
+        pipe.execute()
+
+    points = metrics.histograms(fake_redis)["points"]
+    assert (points["count"], points["rows"]) == (2, 20)
+    assert sum(points["buckets"].values()) == 2
+    assert json.loads(fake_redis.lindex(metrics.LOG, 0))["job_token"] == "b"
+
+
+def test_throughput_of_the_finished_jobs(metrics, fake_redis):
+    assert metrics.throughput(fake_redis) == metrics.DEFAULT_RATES
+    spans = metrics.StageSpans()
+    spans.start("read").stop(rows=100)
+    spans.start("points").stop(rows=25)
+    pipe = fake_redis.pipeline()
+    spans.record(pipe, b"a")
+    pipe.execute()
+    rates = metrics.throughput(fake_redis)
+    assert rates["point_share"] == 0.25
+    assert rates["job"] == metrics.DEFAULT_RATES["job"]
@@ -0,0 +1,32 @@
+import pytest
+from thefuzz import process
+
+COUNTRIES = ["United States", "United Kingdom", "France", "Georgia", "Côte d'Ivoire"]
+STATES = ["Georgia, United States", "Texas, United States", "Paris, France", "Guria, Georgia"]
+STATE_COUNTRIES = ["United States", "United States", "France", "Georgia"]
+
+
+@pytest.mark.parametrize("name", ["France", "france", "Frnace", "United Stats", "Cote d'Ivoire", "Spain", ""])
+def test_name_matcher_same_as_thefuzz(NameMatcher, name):
+    expected = ", ".join(match for match, score in process.extract(name, COUNTRIES, limit=1) if score >= 85)
+    assert NameMatcher(COUNTRIES).match([name], threshold=85) == [expected]
+
+
+def test_name_matcher_groups_and_missing_names(NameMatcher):
+    matcher = NameMatcher(STATES, groups=STATE_COUNTRIES)
+    names = ["Georgia, United States", "texas, united states", "Georgia, United States", float("nan"), "Paris, France"]
+    groups = ["United States", "United States", "Georgia", "France", "United States"]
+    assert matcher.match(names, threshold=90, groups=groups) == [
+        "Georgia, United States",
+        "Texas, United States",
+        "",
+        "",
+        "",
+    ]
+
+
+def test_name_matcher_cache_is_bounded(NameMatcher):
+    matcher = NameMatcher(COUNTRIES, cache_size=2)
+    matcher.match(["Frnace", "Untied Kingdom", "Gorgia"], threshold=85)
+    assert list(matcher._cache) == [("", "Untied Kingdom"), ("", "Gorgia")]
+    assert matcher.match(["Gorgia"], threshold=85) == ["Georgia"]
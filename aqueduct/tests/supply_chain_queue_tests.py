@@ -0,0 +1,176 @@
+import json
+import threading
+import time
+
+
+def enqueue(fake_redis, job_token, cost=1, tenant=None):
+    from aqueduct.services.supply_chain_queue import JobQueue
+
+    fake_redis.hset(job_token, mapping={"status": "enqueued"})
+    JobQueue.push(fake_redis, job_token, cost, JobQueue.finish_tag(fake_redis, tenant, cost), tenant)
+
+
+def waiting(fake_redis):
+    from aqueduct.services.supply_chain_queue import JobQueue
+
+    return sum((fake_redis.zrange(JobQueue.schedule(size), 0, -1) for size in JobQueue.size_classes), [])
+
+
+def test_queue_position_and_ack(fake_redis, JobQueue):
+    for job_token, cost in [("a", 20), ("b", 10), ("c", 1)]:
+        enqueue(fake_redis, job_token, cost)
+    queue = JobQueue(fake_redis)
+    assert [queue.position(job_token) for job_token in ["a", "b", "c", "x"]] == [2, 1, 0, None]
+
+    assert queue.pop(timeout=1) == b"c"
+    assert fake_redis.lrange(JobQueue.processing(queue.worker_id), 0, -1) == [b"c"]
+    assert fake_redis.hget("c", "attempts") == b"1"
+    queue.ack(b"c")
+    assert fake_redis.llen(JobQueue.processing(queue.worker_id)) == 0
+    assert not fake_redis.hexists(JobQueue.costs, "c") and not fake_redis.scard(JobQueue.running("small"))
+
+
+def test_small_jobs_go_first_and_tenants_share(fake_redis, JobQueue):
+    enqueue(fake_redis, "large", 3600, tenant="x")
+    for job_token in ["x1", "x2", "x3"]:
+        enqueue(fake_redis, job_token, 20, tenant="x")
+    enqueue(fake_redis, "y1", 20, tenant="y")
+    queue = JobQueue(fake_redis)
+    # y1 is not held back by the jobs x submitted before, and none waits for the large one
+    assert [queue.pop(timeout=1) for _ in range(5)] == [b"x1", b"y1", b"x2", b"x3", b"large"]
+
+
+def test_tenant_is_not_set_by_the_client(client):
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    from werkzeug.test import EnvironBuilder
+
+    from aqueduct import app
+    from aqueduct.routes.api.v1.ps_router import request_tenant
+
+    def tenant(trusted_proxies, **request):
+        tenants = []
+
+        def submit(environ, start_response):
+            with app.request_context(environ):
+                tenants.append(request_tenant())
+
+        environ = EnvironBuilder(environ_base={"REMOTE_ADDR": "10.0.0.9"}, **request).get_environ()
+        ProxyFix(submit, x_for=trusted_proxies)(environ, None)
+        return tenants[0]
+
+    # the client, then the ingress, then the gateway
+    forwarded = {"X-Forwarded-For": "1.2.3.4, 192.0.2.1, 10.0.0.2"}
+    assert tenant(2, headers=forwarded) == "address:192.0.2.1"
+    assert tenant(0, headers=forwarded) == "address:10.0.0.9"
+    logged_user = {"loggedUser": json.dumps({"id": "u1"})}
+    assert tenant(2, headers=forwarded, query_string=logged_user) == "user:u1"
+
+
+def test_large_jobs_leave_workers_to_the_others(fake_redis, JobQueue):
+    queue = JobQueue(fake_redis)
+    queue.large_jobs = 1
+    for job_token in ["large1", "large2"]:
+        enqueue(fake_redis, job_token, 3600)
+    assert queue.pop(timeout=1) == b"large1"
+    assert queue.pop(timeout=0.1) is None
+    enqueue(fake_redis, "small", 1)
+    assert queue.pop(timeout=1) == b"small"
+    queue.ack(b"large1")
+    assert queue.pop(timeout=1) == b"large2"
+
+
+def test_idle_workers_wake_up_on_push(fake_redis, JobQueue):
+    queue = JobQueue(fake_redis)
+    threading.Timer(0.2, enqueue, (fake_redis, "job")).start()
+    start = time.time()
+    assert queue.pop(timeout=5) == b"job"
+    assert time.time() - start < 1
+    # the token is consumed, the next idle worker blocks again
+    assert queue.pop(timeout=1) is None
+
+
+def test_workers_wake_each_other_while_jobs_are_left(fake_redis, JobQueue):
+    for job_token in ["a", "b"]:
+        enqueue(fake_redis, job_token)
+    woken = []
+    for _ in range(2):
+        fake_redis.delete(JobQueue.wakeup)
+        JobQueue(fake_redis).pop(timeout=1)
+        woken.append(fake_redis.llen(JobQueue.wakeup))
+    # no token once the last one is taken
+    assert woken == [1, 0]
+
+
+def test_stale_jobs_are_requeued_then_dead_lettered(fake_redis, JobQueue):
+    enqueue(fake_redis, "job")
+    queue = JobQueue(fake_redis)
+    for attempt in range(JobQueue.max_attempts):
+        assert queue.pop(timeout=1) == b"job"
+        # the worker died: its heartbeat expires
+        fake_redis.delete(JobQueue.heartbeat(queue.worker_id))
+        queue.requeue_stale()
+        JobQueue._heartbeat_pid = None
+
+    assert waiting(fake_redis) == []
+    assert fake_redis.hget("job", "status") == b"failed"
+    dead = json.loads(fake_redis.lindex(JobQueue.dead_letter, 0))
+    assert dead["job_token"] == "job"
+    assert dead["attempts"] == JobQueue.max_attempts
+    assert fake_redis.sismember(JobQueue.workers, queue.worker_id) is False
+
+
+def test_live_workers_keep_their_jobs(fake_redis, JobQueue):
+    enqueue(fake_redis, "job")
+    queue = JobQueue(fake_redis)
+    queue.pop(timeout=1)
+    queue.requeue_stale()
+    assert fake_redis.lrange(JobQueue.processing(queue.worker_id), 0, -1) == [b"job"]
+
+
+def test_identical_submissions_attach_to_the_job(fake_redis, JobQueue, new_service):
+    def submit():
+        return new_service(user_indicator="bws", user_threshold=0.5, upload="md5").enqueue()
+
+    job_token = submit()
+    assert submit() == job_token
+    assert waiting(fake_redis) == [job_token.encode()]
+
+    queue = JobQueue(fake_redis)
+    assert queue.pop(timeout=1) == job_token.encode()
+    assert not queue.is_queued(job_token)
+    fake_redis.hset(job_token, mapping={"status": "ready", "results_chunks": 2})
+    submit()
+    assert waiting(fake_redis) == []
+    assert fake_redis.hget(job_token, "results_chunks") == b"2"
+
+    # failed jobs are run again
+    fake_redis.hset(job_token, "status", "error")
+    submit()
+    assert waiting(fake_redis) == [job_token.encode()]
+    assert fake_redis.hget(job_token, "status") == b"enqueued"
+
+
+def test_cost_is_estimated_from_the_upload_sample(fake_redis, new_service, monkeypatch):
+    import pandas as pd
+
+    from aqueduct.services import food_supply_chain_service
+    from aqueduct.services.supply_chain_metrics import DEFAULT_RATES, estimate_seconds
+
+    monkeypatch.setattr(food_supply_chain_service, "UploadStore", None)  # the upload is not read again
+    columns = {"State/Province": None, "Country": "Peru"}
+    samples = {
+        "countries": pd.DataFrame(dict(columns, Latitude=[None] * 4)),
+        "points": pd.DataFrame(dict(columns, Latitude=[-12.0, -13.0, -14.0, None])),
+        "unknown": None,
+    }
+    costs = {}
+    for name, df in samples.items():
+        service = new_service(
+            user_indicator="bws", user_threshold=0.5, upload=name, upload_sample=None if df is None else (df, 50000))
+        costs[name] = float(fake_redis.hget(service.enqueue(), "estimated_seconds"))
+
+    rates = DEFAULT_RATES
+    assert costs["countries"] == round(estimate_seconds(rates, 50000), 1)
+    assert costs["points"] == round(estimate_seconds(rates, 50000, 50000 * 0.75), 1)
+    # nothing known of the upload
+    assert costs["unknown"] == round(estimate_seconds(rates, 0), 1)
@@ -0,0 +1,47 @@
+import gzip
+import json
+
+import numpy as np
+import pandas as pd
+
+
+def test_document_is_written_in_chunks(results):
+    chunks = []
+    writer = results.GzipChunkWriter(chunks.append, chunk_size=64)
+    locations = [{"id": i, "name": "location {}".format(i)} for i in range(500)]
+    sections = {
+        "locations": [locations[:200], [], locations[200:]],
+        "errors": [],
+    }
+    results.write_document(writer, sections, indicator="bws")
+
+    assert len(chunks) == writer.chunks > 1
+    assert all(len(chunk) == 64 for chunk in chunks[:-1])
+    assert json.loads(gzip.decompress(b"".join(chunks))) == {"locations": locations, "errors": [], "indicator": "bws"}
+
+
+def test_members_around_stored_chunks(results):
+    chunks = []
+    results.write_document(results.GzipChunkWriter(chunks.append, chunk_size=16), {"locations": [[{"id": 1}]]})
+    stream = [results.gzip_member('{"status": "ready", "results": ')] + chunks + [results.gzip_member("}")]
+
+    expected = {"status": "ready", "results": {"locations": [{"id": 1}]}}
+    assert json.loads(gzip.decompress(b"".join(stream))) == expected
+    assert json.loads(b"".join(results.gunzip_stream(stream))) == expected
+
+
+def test_columnar_and_records(results):
+    frame = pd.DataFrame({
+        "rn": [6, 7, 8],
+        "cn": ["maize", None, "maize"],
+        "ra": [50.0, np.nan, 10.0],
+        "lid": ["a", 3, None],
+    })
+
+    assert results.records(frame)[1] == {"rn": 7, "cn": None, "ra": None, "lid": 3}
+    assert results.columnar(frame, coded={"cn"}) == {
+        "length": 3,
+        "columns": {"rn": [6, 7, 8], "cn": [0, 0, 0], "ra": [50.0, 0.0, 10.0], "lid": ["a", 3, None]},
+        "nulls": {"cn": [1], "ra": [1], "lid": [2]},
+        "labels": {"cn": ["maize"]},
+    }
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def service(new_service):
+    return new_service()
+
+
+def test_selection_type(service):
+    df = pd.DataFrame({
+        "Latitude": [12.5, np.nan, "12.5", None, np.nan],
+        "State/Province": ["Lima", "Lima", None, "Lima", None],
+        "Country": ["Peru", "Peru", "Peru", None, None],
+    })
+    assert service.find_selection_type(df).fillna("none").tolist() == ["point", "state", "country", "none", "none"]
+
+
+def test_clean_buffer(service):
+    df = pd.DataFrame({
+        "Radius": [111, "222", 1.609, 0, 111000, "x", 50],
+        "Radius Unit": ["km", "KM", "mile", "km", "meters", "km", "feet"],
+    })
+    buffer = service.clean_buffer(df)
+    assert buffer[:2].tolist() == [111.0, 222.0]
+    assert buffer[2] == pytest.approx(1.609 * 1.609)
+    assert buffer[4] == 111.0
+    assert buffer[[3, 5, 6]].isna().all()
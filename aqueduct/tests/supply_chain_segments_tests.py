@@ -0,0 +1,58 @@
+import json
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+
+def read(stream):
+    from aqueduct.services.supply_chain_results import gunzip_stream
+
+    return json.loads(b"".join(gunzip_stream(stream)))
+
+
+def test_segments_are_read_with_a_cursor(job):
+    job = job(user_threshold=0.25)
+    job.reference = SimpleNamespace(aq=pd.DataFrame({
+        "pfaf_id": ["1", "2"], "bws_raw": ["0.5", "0.1"], "bws_label": ["High", "Low"]}))
+    located = pd.DataFrame({"row": [6, 6, 7], "Location ID": [1, 1, 2], "PFAF_ID": [1, 2, 2],
+                            "Crop_Name": ["wheat"] * 3, "IFPRI_production_MT": [10.0] * 3})
+    failed = pd.DataFrame({"row": [8], "Error": ["Invalid Material Type"]})
+    job.append_segments("PFAF_ID", {"bws": 0.25}, located, failed)
+    job.append_segments("PFAF_ID", {"bws": 0.25}, located.iloc[:1], failed, errors=False)
+    job.update_job()
+
+    page = read(job.stream_segments(0, limit=2))
+    assert (page["segments"], page["cursor"]) == (3, 2)
+    assert [list(segment) for segment in page["results"]] == [["locations"], ["errors"]]
+    assert [record["rv"] for record in page["results"][0]["locations"]] == [50, 10, 10]
+    assert page["results"][1]["errors"] == [{"rn": 8, "e": "Invalid Material Type"}]
+
+    page = read(job.stream_segments(2))
+    assert page["cursor"] == 3
+    assert page["results"][0]["locations"][0]["wid"] == 1
+    assert read(job.stream_segments(3))["results"] == []
+
+
+def test_cancel(job, JobQueue):
+    from aqueduct.services.food_supply_chain_service import JobCancelled
+
+    job = job(user_threshold=0.25)
+    assert job.cancel()
+    assert job.status()["status"] == "cancelled"
+    assert not job.redis.zcard(JobQueue.schedule("small")) and not JobQueue(job.redis).is_queued("job")
+    assert not job.cancel()
+
+    # a running job stops at its next chunk of rows
+    job.redis.hset("job", "status", "running")
+    job.redis.hdel("job", "cancelled")
+    assert job.cancel()
+    assert job.status()["status"] == "running"
+    with pytest.raises(JobCancelled):
+        job.check_cancelled()
+
+
+@pytest.mark.parametrize("query", ["cursor=-1", "cursor=next", "limit=0", "limit=1000"])
+def test_invalid_cursor(client, query):
+    response = client.get("/api/v1/aqueduct/analysis/food-supply-chain/job/segments?" + query)
+    assert response.status_code == 400
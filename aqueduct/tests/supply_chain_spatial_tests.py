@@ -0,0 +1,37 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+
+def basins(south=0.0):
+    # two 1x1 degree basins side by side
+    return gpd.GeoDataFrame(
+        {"PFAF_ID": [111011, 111012]},
+        geometry=shapely.box(np.array([0.0, 1.0]), south, np.array([1.0, 2.0]), south + 1.0),
+    )
+
+
+def test_basin_index_point_and_radius(BasinIndex):
+    index = BasinIndex(basins(), "PFAF_ID")
+    positions, ids = index.query([0.5, 0.95, 5.0], [0.5, 0.5, 5.0], [11.0, 11.0, 11.0])
+    assert sorted(zip(positions.tolist(), ids.tolist())) == [(0, 111011), (1, 111011), (1, 111012)]
+
+
+def test_basin_index_scalar_radius(BasinIndex):
+    index = BasinIndex(basins(), "PFAF_ID")
+    positions, ids = index.query([1.5], [0.5], 0.0)
+    assert positions.tolist() == [0]
+    assert ids.tolist() == [111012]
+
+
+def test_basin_index_great_circle_distance(BasinIndex):
+    # at 70N a degree of longitude is ~38 km, a degree of latitude ~111 km
+    index = BasinIndex(basins(south=70.0), "PFAF_ID")
+    positions, ids = index.query([2.8, 2.8, 1.8, 1.8], [70.5, 70.5, 71.3, 71.4], [40.0, 25.0, 40.0, 40.0])
+    assert list(zip(positions.tolist(), ids.tolist())) == [(0, 111012), (2, 111012)]
+
+
+def test_basin_index_across_the_antimeridian(BasinIndex):
+    gdf = gpd.GeoDataFrame({"PFAF_ID": [1, 2]}, geometry=[shapely.box(179.5, 0, 180, 1), shapely.box(-10, 0, -9, 1)])
+    positions, ids = BasinIndex(gdf, "PFAF_ID").query([-179.8], [0.5], 50.0)
+    assert ids.tolist() == [1]
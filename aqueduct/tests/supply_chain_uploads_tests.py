@@ -0,0 +1,44 @@
+import base64
+import hashlib
+import io
+import os
+
+import pytest
+
+
+def test_base64_decoded_in_chunks(uploads):
+    content = os.urandom(10000)
+    encoded = base64.encodebytes(content)  # with line breaks
+    for chunk_size in [1, 7, 64, 100000]:
+        assert b"".join(uploads.decode_base64(uploads.read_stream(io.BytesIO(encoded), chunk_size))) == content
+
+
+def test_uploads_are_stored_by_md5(uploads, tmp_path):
+    store = uploads.UploadStore(bucket="", path=str(tmp_path))
+    content = b"Location ID,Country\n1,Peru\n"
+
+    key = store.put(uploads.read_stream(io.BytesIO(content), 3))
+    assert key == hashlib.md5(content).hexdigest()
+    # counted on the way
+    assert (store.head, store.size, store.lines) == (b"Loca", len(content), 2)
+    assert store.put([content], inspect=lambda f: f.read()) == key
+    assert store.inspected == content
+    assert os.listdir(tmp_path) == [key]
+    assert store.get(key) == content
+
+    os.utime(tmp_path / key, (0, 0))
+    store.prune()
+    assert os.listdir(tmp_path) == []
+
+
+def test_store_needs_one_place(uploads, monkeypatch):
+    monkeypatch.setattr(uploads.UploadStore, "path", None)
+    monkeypatch.delenv("S3_BUCKET_NAME", raising=False)
+    with pytest.raises(Exception, match="SUPPLY_CHAIN_UPLOADS_PATH"):
+        uploads.UploadStore()
+
+    monkeypatch.setenv("S3_BUCKET_NAME", "bucket")
+    assert uploads.UploadStore().bucket == "bucket"
+    monkeypatch.setattr(uploads.UploadStore, "path", "/uploads")
+    with pytest.raises(Exception, match="not both"):
+        uploads.UploadStore()
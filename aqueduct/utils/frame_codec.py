@@ -0,0 +1,97 @@
+"""Compact columnar binary encoding for the numeric frames kept in the caches."""
+
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b"AQF1"
+_HEADER_SIZE = struct.Struct("<I")
+_ALIGNMENT = 8
+
+
+def _pad(size):
+    return -size % _ALIGNMENT
+
+
+def encode_frame(df):
+    """
+    Purpose: Serialize a numeric DataFrame (and its index) into bytes
+    Layout:
+        MAGIC | header length (uint32) | JSON header | padding | blocks
+        Columns of the same dtype are stored together as a single C-contiguous
+        [columns, rows] block, the layout pandas uses internally, so decoding
+        can wrap the buffer without copying it
+    Input:
+        df: DataFrame with numeric or boolean columns and index
+    Output:
+        bytes
+    """
+    index = np.ascontiguousarray(df.index.values)
+    if index.dtype.kind not in "biuf":
+        raise ValueError("only numeric indexes can be encoded, got {}".format(index.dtype))
+
+    groups = {}
+    for position, (name, dtype) in enumerate(df.dtypes.items()):
+        if dtype.kind not in "biuf":
+            raise ValueError("column {} is not numeric ({})".format(name, dtype))
+        groups.setdefault(dtype.str, []).append(position)
+
+    buffers = [index.tobytes()]
+    blocks = []
+    for dtype, positions in groups.items():
+        block = np.ascontiguousarray(df.iloc[:, positions].values.T, dtype=np.dtype(dtype))
+        buffers.append(block.tobytes())
+        blocks.append({"dtype": dtype, "columns": [str(df.columns[p]) for p in positions]})
+
+    header = json.dumps({
+        "rows": len(df),
+        "index": {"name": df.index.name, "dtype": index.dtype.str},
+        "blocks": blocks,
+        "order": [str(column) for column in df.columns],
+    }).encode()
+    prefix = MAGIC + _HEADER_SIZE.pack(len(header)) + header
+    chunks = [prefix, b"\0" * _pad(len(prefix))]
+    for buffer in buffers:
+        chunks += [buffer, b"\0" * _pad(len(buffer))]
+    return b"".join(chunks)
+
+
+def decode_frame(buffer):
+    """
+    Purpose: Rebuild the DataFrame written by encode_frame
+    Input:
+        buffer: bytes, memoryview or anything exposing the buffer protocol (e.g. a bytea value)
+    Output:
+        DataFrame whose values are read-only views on the buffer
+    """
+    buffer = memoryview(buffer)
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError("not an encoded frame")
+    (header_size,) = _HEADER_SIZE.unpack_from(buffer, len(MAGIC))
+    start = len(MAGIC) + _HEADER_SIZE.size
+    header = json.loads(bytes(buffer[start:start + header_size]))
+    offset = start + header_size
+    offset += _pad(offset)
+    rows = header["rows"]
+
+    def take(dtype, count):
+        nonlocal offset
+        array = np.frombuffer(buffer, dtype=np.dtype(dtype), count=count, offset=offset)
+        offset += array.nbytes + _pad(array.nbytes)
+        return array
+
+    index = pd.Index(take(header["index"]["dtype"], rows), name=header["index"]["name"])
+    frames = []
+    for block in header["blocks"]:
+        values = take(block["dtype"], rows * len(block["columns"])).reshape(len(block["columns"]), rows)
+        frames.append(pd.DataFrame(values.T, index=index, columns=block["columns"], copy=False))
+
+    if len(frames) == 1:
+        df = frames[0]
+    elif frames:
+        df = pd.concat(frames, axis=1, copy=False)
+    else:
+        df = pd.DataFrame(index=index)
+    return df[header["order"]] if len(frames) > 1 else df
@@ -0,0 +1,38 @@
+"""Vectorized linear inter/extrapolation shared by the flood services."""
+
+import numpy as np
+
+
+def interp_extrap1d(xp, fp, x):
+    """
+    Purpose: Linear interpolation of fp(xp) inside the sampled range, and linear
+             extrapolation using the first/last segment outside of it
+    Input:
+        xp: sample points [N] (N >= 2). They do not need to be sorted
+        fp: sample values [N], or a batch of curves [..., N] sharing the same xp
+        x: points where the curve(s) are evaluated [M]
+    Output:
+        array [M] for a single curve, or [..., M] for a batch of curves
+    """
+    xp = np.asarray(xp, dtype=float)
+    fp = np.asarray(fp, dtype=float)
+    x = np.asarray(x, dtype=float)
+    if xp.ndim != 1 or xp.size < 2:
+        raise ValueError("xp must be a 1-D array with at least two points")
+    if fp.shape[-1] != xp.size:
+        raise ValueError("the last dimension of fp must match the length of xp")
+
+    order = np.argsort(xp, kind="stable")
+    xp = xp[order]
+    fp = fp[..., order]
+
+    # Index of the segment used for every point; points outside of the sampled
+    # range fall onto the first/last segment, which gives the extrapolation
+    idx = np.clip(np.searchsorted(xp, x, side="right") - 1, 0, xp.size - 2)
+    x0 = xp[idx]
+    x1 = xp[idx + 1]
+    y0 = fp[..., idx]
+    y1 = fp[..., idx + 1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return y0 + (x - x0) * (y1 - y0) / (x1 - x0)
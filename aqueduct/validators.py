@@ -103,121 +103,123 @@ def validate_wra_params(func):
     return wrapper
 
 
+CBA_SCHEMA = {
+    "geogunit_unique_name": {"type": "string", "required": True},
+    "existing_prot": {
+        "type": "integer",
+        "required": False,
+        "coerce": null2int,
+        "default": None,
+        "nullable": True,
+        "min": 0,
+        "max": 1000,
+    },
+    "scenario": {
+        "type": "string",
+        "required": True,
+        "allowed": [
+            "business as usual",
+            "pessimistic",
+            "optimistic",
+            "rcp4p5",
+            "rcp8p5",
+        ],
+        "coerce": to_lower,
+    },
+    "prot_fut": {
+        "type": "integer",
+        "required": False,
+        "coerce": null2int,
+        "default": None,
+        "nullable": True,
+        "min": 0,
+        "max": 1000,
+    },
+    "implementation_start": {
+        "type": "integer",
+        "required": True,
+        "coerce": int,
+        "min": 2020,
+        "max": 2079,
+    },
+    "implementation_end": {
+        "type": "integer",
+        "required": True,
+        "coerce": int,
+        "min": 2021,
+        "max": 2080,
+    },
+    "infrastructure_life": {
+        "type": "integer",
+        "required": True,
+        "coerce": int,
+        "min": 1,
+        "max": 100,
+    },
+    "benefits_start": {
+        "type": "integer",
+        "required": True,
+        "coerce": int,
+        "min": 2020,
+        "max": 2080,
+    },
+    "ref_year": {
+        "type": "integer",
+        "required": True,
+        "coerce": int,
+        "allowed": [2030, 2050, 2080],
+    },
+    "estimated_costs": {
+        "type": "float",
+        "required": False,
+        "coerce": null2float,
+        "default": None,
+        "nullable": True,
+        "min": 0,
+        "max": 1000,
+    },
+    "discount_rate": {
+        "type": "float",
+        "required": True,
+        "coerce": float,
+        "min": 0,
+        "max": 1,
+    },
+    "om_costs": {
+        "type": "float",
+        "required": True,
+        "coerce": float,
+        "min": 0,
+        "max": 1,
+    },
+    "user_urb_cost": {
+        "type": "float",
+        "required": False,
+        "coerce": null2float,
+        "default": None,
+        "nullable": True,
+        "min": 0,
+        "max": 1000,
+    },
+    "user_rur_cost": {
+        "type": "float",
+        "required": False,
+        "coerce": null2float,
+        "default": None,
+        "nullable": True,
+        "min": 0,
+        "max": 1000,
+    },
+}
+
+
 def validate_params_cba(func):
     """World Validation"""
 
     @wraps(func)
     def wrapper(*args, **kwargs):
-        validation_schema = {
-            "geogunit_unique_name": {"type": "string", "required": True},
-            "existing_prot": {
-                "type": "integer",
-                "required": False,
-                "coerce": null2int,
-                "default": None,
-                "nullable": True,
-                "min": 0,
-                "max": 1000,
-            },
-            "scenario": {
-                "type": "string",
-                "required": True,
-                "allowed": [
-                    "business as usual",
-                    "pessimistic",
-                    "optimistic",
-                    "rcp4p5",
-                    "rcp8p5",
-                ],
-                "coerce": to_lower,
-            },
-            "prot_fut": {
-                "type": "integer",
-                "required": False,
-                "coerce": null2int,
-                "default": None,
-                "nullable": True,
-                "min": 0,
-                "max": 1000,
-            },
-            "implementation_start": {
-                "type": "integer",
-                "required": True,
-                "coerce": int,
-                "min": 2020,
-                "max": 2079,
-            },
-            "implementation_end": {
-                "type": "integer",
-                "required": True,
-                "coerce": int,
-                "min": 2021,
-                "max": 2080,
-            },
-            "infrastructure_life": {
-                "type": "integer",
-                "required": True,
-                "coerce": int,
-                "min": 1,
-                "max": 100,
-            },
-            "benefits_start": {
-                "type": "integer",
-                "required": True,
-                "coerce": int,
-                "min": 2020,
-                "max": 2080,
-            },
-            "ref_year": {
-                "type": "integer",
-                "required": True,
-                "coerce": int,
-                "allowed": [2030, 2050, 2080],
-            },
-            "estimated_costs": {
-                "type": "float",
-                "required": False,
-                "coerce": null2float,
-                "default": None,
-                "nullable": True,
-                "min": 0,
-                "max": 1000,
-            },
-            "discount_rate": {
-                "type": "float",
-                "required": True,
-                "coerce": float,
-                "min": 0,
-                "max": 1,
-            },
-            "om_costs": {
-                "type": "float",
-                "required": True,
-                "coerce": float,
-                "min": 0,
-                "max": 1,
-            },
-            "user_urb_cost": {
-                "type": "float",
-                "required": False,
-                "coerce": null2float,
-                "default": None,
-                "nullable": True,
-                "min": 0,
-                "max": 1000,
-            },
-            "user_rur_cost": {
-                "type": "float",
-                "required": False,
-                "coerce": null2float,
-                "default": None,
-                "nullable": True,
-                "min": 0,
-                "max": 1000,
-            },
-        }
 
-        validator = Validator(validation_schema, allow_unknown=True)
+        validator = Validator(CBA_SCHEMA, allow_unknown=True)
         if not validator.validate(kwargs["params"]):
             return error(status=400, detail=validator.errors)
 
@@ -228,41 +230,43 @@ def validate_params_cba(func):
     return wrapper
 
 
+CBA_DEF_SCHEMA = {
+    "geogunit_unique_name": {"type": "string", "required": True},
+    "scenario": {
+        "type": "string",
+        "required": True,
+        "allowed": [
+            "business as usual",
+            "pessimistic",
+            "optimistic",
+            "rcp4p5",
+            "rcp8p5",
+        ],
+        "coerce": to_lower,
+    },
+    "flood": {
+        "type": "string",
+        "required": False,
+        "coerce": to_lower,
+        "default": "riverine",
+        "allowed": ["riverine", "coastal"],
+    },
+    "sub_scenario": {
+        "type": "boolean",
+        "required": False,
+        "default": False,
+        "coerce": (str, to_bool),
+    },
+}
+
+
 def validate_params_cba_def(func):
     """World Validation"""
 
     @wraps(func)
     def wrapper(*args, **kwargs):
-        validation_schema = {
-            "geogunit_unique_name": {"type": "string", "required": True},
-            "scenario": {
-                "type": "string",
-                "required": True,
-                "allowed": [
-                    "business as usual",
-                    "pessimistic",
-                    "optimistic",
-                    "rcp4p5",
-                    "rcp8p5",
-                ],
-                "coerce": to_lower,
-            },
-            "flood": {
-                "type": "string",
-                "required": False,
-                "coerce": to_lower,
-                "default": "riverine",
-                "allowed": ["riverine", "coastal"],
-            },
-            "sub_scenario": {
-                "type": "boolean",
-                "required": False,
-                "default": False,
-                "coerce": (str, to_bool),
-            },
-        }
         logging.debug(f"[VALIDATOR - cba_def_params]: {kwargs}")
-        validator = Validator(validation_schema, allow_unknown=True)
+        validator = Validator(CBA_DEF_SCHEMA, allow_unknown=True)
         if not validator.validate(kwargs["params"]):
             return error(status=400, detail=validator.errors)
 
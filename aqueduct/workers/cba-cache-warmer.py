@@ -0,0 +1,225 @@
+"""
+Fills cache_cba / cache_d_cba ahead of time, so users don't wait for cold CBA
+computations.
+
+The parameter sets come from any combination of:
+  --log FILE      gunicorn access logs (/cba, /cba/widget/<id> and /cba/default requests)
+  --file FILE     one parameter set per line, as JSON or as a query string
+  --recent N      the N most recently used cache_cba keys. With --expire the
+                  cache is cleaned once they are read, so they get recomputed
+                  against refreshed data
+
+Run with: ./entrypoint.sh cba-warmer --log access.log --workers 4 --rate 0.5
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from urllib.parse import parse_qs
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import sqlalchemy
+from cerberus import Validator
+
+from aqueduct.services.cba_defaults_service import CBADefaultService
+from aqueduct.services.cba_service import CBAICache
+from aqueduct.validators import CBA_DEF_SCHEMA, CBA_SCHEMA
+
+# Request line of the gunicorn access log format, see gunicorn.py
+REQUEST_LINE = re.compile(r'"GET (?P<path>\S*/cba(?:/widget/[^/?\s]+|/default)?)/?\?(?P<query>\S+) HTTP')
+
+# cache_cba keys are the param values joined in key order; the unit name is the
+# only value that can contain the separator
+CBA_KEY_ORDER = sorted(CBA_SCHEMA.keys())
+CBA_NAME_POSITION = CBA_KEY_ORDER.index("geogunit_unique_name")
+
+
+def normalize(params, schema):
+    """Same sanitize + validation the endpoints apply, so the cache keys match"""
+    params = {key: value for key, value in params.items() if key != "loggedUser"}
+    validator = Validator(schema, allow_unknown=True)
+    if not validator.validate(params):
+        return None
+    return validator.normalized(params)
+
+
+def from_query(query):
+    return {key: values[0] for key, values in parse_qs(query, keep_blank_values=True).items()}
+
+
+def read_log(path):
+    """(kind, params) for every CBA request in an access log"""
+    with open(path) as log:
+        for line in log:
+            match = REQUEST_LINE.search(line)
+            if match:
+                kind = "default" if match.group("path").endswith("/default") else "cba"
+                yield kind, from_query(match.group("query"))
+
+
+def read_file(path):
+    with open(path) as params_file:
+        for line in params_file:
+            line = line.strip()
+            if not line:
+                continue
+            params = json.loads(line) if line.startswith("{") else from_query(line.lstrip("?"))
+            yield "cba", params
+
+
+def parse_key(key):
+    parts = key.split("_")
+    tail = len(CBA_KEY_ORDER) - CBA_NAME_POSITION - 1
+    if len(parts) < len(CBA_KEY_ORDER):
+        return None
+    values = (parts[:CBA_NAME_POSITION] + ["_".join(parts[CBA_NAME_POSITION:len(parts) - tail])]
+              + parts[len(parts) - tail:])
+    # the endpoints receive missing optional values as "null"
+    return {name: ("null" if value == "None" else value) for name, value in zip(CBA_KEY_ORDER, values)}
+
+
+def read_recent(limit, expire):
+    engine = sqlalchemy.create_engine(os.getenv("POSTGRES_URL"))
+    try:
+        if "cache_cba" not in sqlalchemy.inspect(engine).get_table_names():
+            return []
+        keys = [row[0] for row in engine.execute(
+            "SELECT key FROM cache_cba ORDER BY last_updated DESC LIMIT {0}".format(int(limit)))]
+    finally:
+        engine.dispose()
+    if expire:
+        logging.info("[WARMER]: Cleaning the cba caches")
+        CBAICache({}).cleanCache()
+        CBADefaultService({}).cleanCache()
+    return [("cba", params) for params in map(parse_key, keys) if params]
+
+
+def collect(args):
+    """Unique (kind, normalized params) to warm, in the order they were read"""
+    sources = []
+    for path in args.log or []:
+        sources.append(read_log(path))
+    for path in args.file or []:
+        sources.append(read_file(path))
+    if args.recent:
+        sources.append(read_recent(args.recent, args.expire))
+
+    seen, jobs, invalid = set(), [], 0
+    for source in sources:
+        for kind, params in source:
+            schema = CBA_DEF_SCHEMA if kind == "default" else CBA_SCHEMA
+            params = normalize(params, schema)
+            if params is None:
+                invalid += 1
+                continue
+            key = (kind, tuple(sorted((k, str(v)) for k, v in params.items())))
+            if key not in seen:
+                seen.add(key)
+                jobs.append((kind, params))
+    if invalid:
+        logging.warning("[WARMER]: {} invalid parameter sets skipped".format(invalid))
+    return jobs
+
+
+def warm(kind, params):
+    """Runs in a pool process. Returns whether the entries were already cached"""
+    if kind == "default":
+        CBADefaultService(params).execute()
+        return "default"
+    cache = CBAICache(params)
+    if "cache_cba" in sqlalchemy.inspect(cache.engine).get_table_names() and cache.checkParams() is not None:
+        return "hit"
+    cache.execute()
+    # Default inputs shown for the same unit and scenario
+    default_params = normalize({"geogunit_unique_name": params["geogunit_unique_name"],
+                                "scenario": params["scenario"]}, CBA_DEF_SCHEMA)
+    CBADefaultService(default_params).execute()
+    return "filled"
+
+
+class RateLimiter(object):
+    """Spaces job starts so the database is never hit by more than `rate` new jobs per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_start = time.monotonic()
+
+    def wait(self):
+        now = time.monotonic()
+        if self.next_start > now:
+            time.sleep(self.next_start - now)
+        self.next_start = max(self.next_start, now) + self.interval
+
+
+class Progress(object):
+    def __init__(self, total):
+        self.total = total
+        self.start = time.time()
+        self.counts = {"filled": 0, "hit": 0, "default": 0, "failed": 0}
+        self.failures = []
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    def record(self, kind, params, future):
+        try:
+            self.counts[future.result()] += 1
+        except Exception as e:
+            self.counts["failed"] += 1
+            self.failures.append({"kind": kind, "params": params, "error": str(e)})
+            logging.error("[WARMER]: {} {} failed: {}".format(kind, params.get("geogunit_unique_name"), e))
+        elapsed = time.time() - self.start
+        rate = self.done / elapsed if elapsed else 0
+        eta = (self.total - self.done) / rate if rate else 0
+        logging.info("[WARMER]: {}/{} done ({filled} filled, {hit} already cached, {default} defaults, "
+                     "{failed} failed) {:.2f} jobs/min, eta {:.0f} seconds".format(
+                         self.done, self.total, rate * 60, eta, **self.counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-warm the CBA caches")
+    parser.add_argument("--log", action="append", help="gunicorn access log to read requests from")
+    parser.add_argument("--file", action="append", help="file with one parameter set per line")
+    parser.add_argument("--recent", type=int, default=0, help="re-warm the N most recent cache_cba keys")
+    parser.add_argument("--expire", action="store_true", help="with --recent, clean the caches before re-warming")
+    parser.add_argument("--workers", type=int, default=2, help="parallel computations")
+    parser.add_argument("--rate", type=float, default=1.0, help="max new computations per second, 0 = no limit")
+    parser.add_argument("--failures", help="write the failed parameter sets to this file, as JSON lines")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    jobs = collect(args)
+    logging.info("[WARMER]: {} parameter sets to warm with {} workers".format(len(jobs), args.workers))
+
+    progress = Progress(len(jobs))
+    limiter = RateLimiter(args.rate)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        pending = {}
+        for kind, params in jobs:
+            # bounded: never more jobs in flight than workers
+            while len(pending) >= args.workers:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    progress.record(*pending.pop(future), future)
+            limiter.wait()
+            pending[pool.submit(warm, kind, params)] = (kind, params)
+        for future in list(pending):
+            wait([future])
+            progress.record(*pending.pop(future), future)
+
+    if args.failures and progress.failures:
+        with open(args.failures, "w") as failures:
+            for failure in progress.failures:
+                failures.write(json.dumps(failure) + "\n")
+    logging.info("[WARMER]: finished in {:.0f} seconds".format(time.time() - progress.start))
+    return 1 if progress.counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,8 +4,17 @@ sys.path.append(os.path.abspath("/opt/aqueduct/aqueduct/services"))
 from food_supply_chain_service import *
 import time
 import logging
+import multiprocessing
+import signal
 import boto3
 
+# Number of jobs run side by side, one process each
+WORKERS = int(os.environ.get("SUPPLY_CHAIN_WORKERS", os.cpu_count() or 1))
+# Seconds a worker waits on the queue before checking whether it has to stop
+POP_TIMEOUT = int(os.environ.get("SUPPLY_CHAIN_POP_TIMEOUT", 5))
+# Seconds running jobs get to finish on shutdown
+SHUTDOWN_TIMEOUT = int(os.environ.get("SUPPLY_CHAIN_SHUTDOWN_TIMEOUT", 600))
+
 if os.environ.get("ENDPOINT_URL"):
     print("Using endpoint of {}".format(os.environ.get("ENDPOINT_URL")))
     bucket = os.environ.get('S3_BUCKET_NAME')
@@ -22,10 +31,60 @@ if os.environ.get("ENDPOINT_URL"):
     except Exception as e:
         print(str(e))
 
-while True:
+
+def work(stopping):
+    """One worker process: runs jobs until the supervisor asks it to stop"""
+    # the supervisor handles the signals
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    while not stopping.is_set():
+        try:
+            logging.debug("Checking for work")
+            FoodSupplyChainService.pop_and_do_work(timeout=POP_TIMEOUT)
+        except Exception as e:
+            print(str(e))
+            time.sleep(POP_TIMEOUT)
+
+
+def supervise():
+    stopping = multiprocessing.Event()
+    # Event.set takes a lock Event.wait may hold, so the handlers only record the signal
+    signals = []
+
+    def stop(signum, frame):
+        signals.append(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # Reference data is loaded before forking, so the workers share it
     try:
-        logging.info("Checking for work")
-        FoodSupplyChainService.pop_and_do_work()
-        time.sleep(5)
+        SupplyChainReference.current()
     except Exception as e:
         print(str(e))
+
+    workers = {}
+    while not signals:
+        for slot in range(WORKERS):
+            if slot not in workers or not workers[slot].is_alive():
+                if slot in workers:
+                    logging.error("Worker {} exited with {}, restarting".format(slot, workers[slot].exitcode))
+                workers[slot] = multiprocessing.Process(target=work, args=(stopping,), daemon=True)
+                workers[slot].start()
+        time.sleep(1)
+
+    logging.info("Stopping workers, waiting for running jobs")
+    stopping.set()
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    for worker in workers.values():
+        worker.join(max(0, deadline - time.time()))
+        if worker.is_alive():
+            logging.error("Worker {} did not finish in time, terminating".format(worker.pid))
+            worker.terminate()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    multiprocessing.set_start_method("fork")
+    logging.info("Starting {} supply chain workers".format(WORKERS))
+    supervise()
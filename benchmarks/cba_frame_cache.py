@@ -0,0 +1,60 @@
+"""
+Compares the cached CBA frame round-trip: JSON records (previous cache_cba format)
+against the columnar binary frames of aqueduct/utils/frame_codec.py.
+
+Run with: python benchmarks/cba_frame_cache.py [--years 100] [--columns 21] [--repeat 200]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import timeit
+
+import numpy as np
+import pandas as pd
+
+# loaded by path, importing the aqueduct package would start the whole app
+spec = importlib.util.spec_from_file_location(
+    "frame_codec", os.path.join(os.path.dirname(__file__), "..", "aqueduct", "utils", "frame_codec.py"))
+frame_codec = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(frame_codec)
+
+
+def cba_frame(years, columns):
+    index = pd.Index(np.arange(2010, 2010 + years), name="year")
+    data = np.random.default_rng(0).random((years, columns)) * 1e6
+    return pd.DataFrame(data, index=index, columns=["stat_{}".format(i) for i in range(columns)])
+
+
+def json_encode(df):
+    return json.dumps({"meta": {}, "data": df.reset_index().to_dict("records")})
+
+
+def json_decode(value):
+    return pd.DataFrame(json.loads(value)["data"]).set_index("year")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--years", type=int, default=100)
+    parser.add_argument("--columns", type=int, default=21)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    df = cba_frame(args.years, args.columns)
+    as_json = json_encode(df)
+    as_frame = frame_codec.encode_frame(df)
+    pd.testing.assert_frame_equal(json_decode(as_json), df)
+    pd.testing.assert_frame_equal(frame_codec.decode_frame(as_frame), df)
+
+    print("{} years x {} columns".format(args.years, args.columns))
+    print("{:<8} {:>10} {:>12} {:>12}".format("format", "bytes", "encode (us)", "decode (us)"))
+    for name, encode, decode, value in [("json", json_encode, json_decode, as_json),
+                                        ("frame", frame_codec.encode_frame, frame_codec.decode_frame, as_frame)]:
+        encode_time = min(timeit.repeat(lambda: encode(df), number=args.repeat, repeat=3)) / args.repeat
+        decode_time = min(timeit.repeat(lambda: decode(value), number=args.repeat, repeat=3)) / args.repeat
+        print("{:<8} {:>10} {:>12.1f} {:>12.1f}".format(name, len(value), encode_time * 1e6, decode_time * 1e6))
+
+
+if __name__ == "__main__":
+    main()
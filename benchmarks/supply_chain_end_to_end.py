@@ -0,0 +1,209 @@
+"""
+End-to-end timing of the food supply chain analysis.
+
+Runs FoodSupplyChainService.run on synthetic workbooks (see supply_chain_workload.py)
+against an in-memory redis (fakeredis) and a temporary upload store, and times its
+stages by wrapping the methods that implement them. Stages nest: locations
+includes reading and resolve_chunk, which includes find_locations and its name
+matching, point query and lookups. store includes scoring the locations, as
+records are scored while they are serialized.
+
+Needs the reference data of supply_chain_data, run from the repository root:
+python benchmarks/supply_chain_end_to_end.py [--rows 1000 10000 100000] [--indicator bws] [--repeat 3]
+    [--out supply_chain_baseline.json] [--compare previous_baseline.json]
+
+Mix options are the ones of supply_chain_workload.py. The timings are written as a
+JSON baseline; with --compare, the ratio to a previous baseline is printed per stage.
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import fakeredis
+import numpy as np
+import pandas as pd
+
+# importing the aqueduct package would start the whole app
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "aqueduct", "services"))
+sys.path.append(os.path.dirname(__file__))
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")  # replaced by fakeredis
+import food_supply_chain_service  # noqa: E402
+from food_supply_chain_service import FoodSupplyChainService  # noqa: E402
+from supply_chain_artifacts import CSRLookup, ProductionMatrix  # noqa: E402
+from supply_chain_location_cache import LocationCache  # noqa: E402
+from supply_chain_names import NameMatcher  # noqa: E402
+from supply_chain_queue import JobQueue  # noqa: E402
+from supply_chain_reference import SupplyChainReference  # noqa: E402
+from supply_chain_spatial import BasinIndex  # noqa: E402
+from supply_chain_uploads import UploadStore  # noqa: E402
+from supply_chain_workload import supply_chain, workbook  # noqa: E402
+
+# stage: (class, method)
+STAGES = {
+    "reference": (SupplyChainReference, "current"),
+    "locations": (FoodSupplyChainService, "resolve_locations"),
+    "resolve_chunk": (FoodSupplyChainService, "resolve_chunk"),
+    "selection_type": (FoodSupplyChainService, "find_selection_type"),
+    "find_locations": (FoodSupplyChainService, "find_locations"),
+    "name_matching": (NameMatcher, "match"),
+    "radius": (FoodSupplyChainService, "clean_buffer"),
+    "point_query": (BasinIndex, "query"),
+    "admin_lookup": (CSRLookup, "explode"),
+    "production_lookup": (ProductionMatrix, "lookup"),
+    "location_cache": (LocationCache, "set"),
+    "indicators": (FoodSupplyChainService, "indicator_values"),
+    "store": (FoodSupplyChainService, "store_results"),
+}
+
+
+class StageTimer(object):
+    """Accumulated wall time of the wrapped methods, by stage"""
+
+    def __init__(self):
+        self.times = {}
+
+    def wrap(self, stage, method):
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.times[stage] = self.times.get(stage, 0) + time.perf_counter() - start
+        return timed
+
+    def wrap_generator(self, stage, function):
+        """Time spent producing the items of a generator, e.g. reading the chunks of the upload"""
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            items = function(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    self.times[stage] = self.times.get(stage, 0) + time.perf_counter() - start
+                yield item
+        return timed
+
+    def install(self):
+        for stage, (cls, name) in STAGES.items():
+            method = cls.__dict__[name]
+            if isinstance(method, classmethod):
+                setattr(cls, name, classmethod(self.wrap(stage, method.__func__)))
+            else:
+                setattr(cls, name, self.wrap(stage, method))
+        food_supply_chain_service.read_chunks = self.wrap_generator("read", food_supply_chain_service.read_chunks)
+
+
+def run_job(content, indicator, threshold, timer):
+    """Enqueues and runs a job on a fresh redis, so no locations are cached. Returns its duration"""
+    with tempfile.TemporaryDirectory() as uploads:
+        redis = fakeredis.FakeStrictRedis()
+        store = UploadStore(bucket="", path=uploads)
+        service = FoodSupplyChainService(user_indicator=indicator, user_threshold=threshold,
+                                         upload=store.put([content]))
+        service.redis = redis
+        service.bucket = None
+        original_store = food_supply_chain_service.UploadStore
+        food_supply_chain_service.UploadStore = lambda: store
+        try:
+            service.enqueue()
+            worker = FoodSupplyChainService(job_token=JobQueue(redis).pop(timeout=1))
+            worker.redis = redis
+            worker.bucket = None
+            timer.times = {}
+            start = time.perf_counter()
+            worker.run()
+            total = time.perf_counter() - start
+        finally:
+            food_supply_chain_service.UploadStore = original_store
+        status = worker.status()
+        if status["status"] != "ready":
+            raise Exception("Job failed: {}".format(redis.hget(worker.job_token, "error")))
+        return total, status["rows_processed"]
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--points", type=float, default=0.4)
+    parser.add_argument("--states", type=float, default=0.3)
+    parser.add_argument("--countries", type=float, default=0.3)
+    parser.add_argument("--typos", type=float, default=0.1)
+    parser.add_argument("--bad", type=float, default=0.05)
+    parser.add_argument("--indicator", default="bws")
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per size, the median is kept")
+    parser.add_argument("--out", default="supply_chain_baseline.json")
+    parser.add_argument("--compare", help="previous baseline")
+    args = parser.parse_args()
+
+    if not os.path.exists(SupplyChainReference.aq_path):
+        sys.exit("{} not found: the benchmark needs the reference data".format(SupplyChainReference.aq_path))
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {run["rows"]: run["stages"] for run in json.load(f)["runs"]}
+
+    timer = StageTimer()
+    timer.install()
+    # loaded once, as by the worker
+    SupplyChainReference.current()
+
+    mix = {key: getattr(args, key) for key in ["points", "states", "countries", "typos", "bad"]}
+    runs = []
+    for rows in args.rows:
+        content = workbook(supply_chain(rows, **mix))
+        samples = []
+        for _ in range(args.repeat):
+            total, processed = run_job(content, args.indicator, args.threshold, timer)
+            samples.append(dict(timer.times, total=total))
+        stages = {stage: statistics.median(sample.get(stage, 0) for sample in samples)
+                  for stage in ["read"] + list(STAGES) + ["total"]}
+        runs.append({"rows": rows, "rows_processed": processed, "stages": stages,
+                     "rows_per_second": rows / stages["total"]})
+        print("{} rows: {:.2f} s, {:.0f} rows/s".format(rows, stages["total"], rows / stages["total"]))
+        for stage, seconds in stages.items():
+            print("  {:<18} {:>9.3f} s".format(stage, seconds))
+
+    baseline = {"environment": environment(), "mix": mix, "indicator": args.indicator,
+                "threshold": args.threshold, "repeat": args.repeat, "runs": runs}
+    with open(args.out, "w") as f:
+        json.dump(baseline, f, indent=2)
+    print("Baseline written to {}".format(args.out))
+
+    if previous is not None:
+        print("Compared to {} (current / previous)".format(args.compare))
+        for run in runs:
+            if run["rows"] not in previous:
+                continue
+            print("{} rows".format(run["rows"]))
+            for stage, seconds in run["stages"].items():
+                before = previous[run["rows"]].get(stage)
+                if before:
+                    print("  {:<18} {:>7.2f}x".format(stage, seconds / before))
+
+
+if __name__ == "__main__":
+    main()
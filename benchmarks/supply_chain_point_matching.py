@@ -0,0 +1,88 @@
+"""
+Point + radius to water unit matching of the food supply chain analysis.
+
+Compares the per-job approach (Point and buffer of radius / 111 degrees built row by
+row with apply, then gpd.sjoin against the whole layer) with the persistent
+BasinIndex great-circle query, on a synthetic layer of square basins covering the
+globe. The matches of both are counted: the degree buffers are too narrow east-west
+away from the equator.
+
+Run with: python benchmarks/supply_chain_point_matching.py [--points 1000 10000 50000] [--cell 1.0]
+"""
+import argparse
+import os
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Point
+
+# importing the aqueduct package would start the whole app
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "aqueduct", "services"))
+from supply_chain_spatial import RESOLUTIONS, BasinIndex  # noqa: E402
+
+WATER_UNIT = "PFAF_ID"
+
+
+def basins(cell):
+    xs, ys = np.meshgrid(np.arange(-180, 180, cell), np.arange(-60, 84, cell))
+    xs, ys = xs.ravel(), ys.ravel()
+    return gpd.GeoDataFrame({WATER_UNIT: np.arange(len(xs)) + 100000},
+                            geometry=shapely.box(xs, ys, xs + cell, ys + cell))
+
+
+def supply_chain(n):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({"Longitude": rng.uniform(-170, 170, n), "Latitude": rng.uniform(-55, 80, n),
+                         "Buffer": rng.choice([10, 50, 100], n).astype(float)},
+                        index=pd.Index(np.arange(6, n + 6), name="row"))
+
+
+def per_job(df_points, gdf):
+    df_points = df_points.copy()
+    df_points["geometry"] = df_points.apply(lambda row: Point(float(row.Longitude), row.Latitude), axis=1)
+    buffered = df_points.filter(["Buffer", "geometry"])
+    buffered["geometry"] = buffered.apply(lambda x: x.geometry.buffer(x.Buffer / 111.0), axis=1)
+    buffered = gpd.GeoDataFrame(buffered, geometry=buffered.geometry)
+    joined = gpd.sjoin(buffered, gdf, how="left", predicate="intersects")
+    return joined.groupby(["row"])[WATER_UNIT].agg(list)
+
+
+def indexed(df_points, index):
+    positions, ids = index.query(df_points["Longitude"].values, df_points["Latitude"].values,
+                                 df_points["Buffer"].values)
+    return pd.DataFrame({"row": df_points.index.values[positions], WATER_UNIT: ids}).groupby(["row"])[
+        WATER_UNIT].agg(list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--cell", type=float, default=1.0, help="basin size in degrees")
+    args = parser.parse_args()
+
+    gdf = basins(args.cell)
+    start = time.time()
+    index = BasinIndex(gdf, WATER_UNIT)
+    for resolution in RESOLUTIONS:  # kept by the worker across jobs
+        index.simplified(resolution)
+    print("{} basins, index built in {:.2f} seconds".format(len(index), time.time() - start))
+    print("{:>8} {:>12} {:>12} {:>14} {:>14}".format(
+        "points", "sjoin (s)", "index (s)", "sjoin matches", "index matches"))
+    for n in args.points:
+        df_points = supply_chain(n)
+        start = time.time()
+        expected = per_job(df_points, gdf)
+        sjoin_time = time.time() - start
+        start = time.time()
+        result = indexed(df_points, index)
+        index_time = time.time() - start
+        print("{:>8} {:>12.2f} {:>12.2f} {:>14} {:>14}".format(
+            n, sjoin_time, index_time, int(expected.map(len).sum()), int(result.map(len).sum())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Encoding of the food supply chain locations.
+
+Compares the former per-row prepare_payload loop with the vectorized records
+conversion and the columnar format, on a synthetic result table: encode time
+(conversion + json.dumps) and payload size, raw and gzipped.
+
+Run with: python benchmarks/supply_chain_results_format.py [--rows 10000 100000 500000]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# importing the aqueduct package would start the whole app
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "aqueduct", "services"))
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")  # the client connects lazily
+from food_supply_chain_service import FoodSupplyChainService  # noqa: E402
+from supply_chain_results import columnar, records  # noqa: E402
+
+
+def prepare_payload(service, payload):
+    new_payload = {}
+    for key in payload:
+        value = payload[key]
+        if pd.isna(value):
+            value = None
+        new_payload[service.payload_key(key)] = value
+    return new_payload
+
+
+def locations(n):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "row": np.arange(n) + 6,
+        "Location ID": rng.choice(["farm a", "farm b", None], n),
+        "Country": rng.choice(["Peru", "Chile", "Brazil", None], n),
+        "State/Province": rng.choice(["Lima", "Cusco", None], n),
+        "Crop_Name": rng.choice(["maize", "rice", "soybeans", "wheat"], n),
+        "Material Volume (MT)": rng.random(n) * 100,
+        "Latitude": rng.uniform(-55, 10, n),
+        "Longitude": rng.uniform(-80, -35, n),
+        "Radius": np.where(rng.random(n) < 0.2, np.nan, 50.0),
+        "Watershed ID": rng.integers(100000, 999999, n),
+        "bws Raw Value": rng.integers(0, 100, n),
+        "bws Score": rng.choice(["Low (<10%)", "Medium - High (20-40%)", "High (40-80%)"], n),
+        "bws Desired Condition": 25,
+        "bws % Change Required": rng.integers(0, 100, n),
+    })
+
+
+def measure(name, encode):
+    start = time.perf_counter()
+    document = encode()
+    elapsed = time.perf_counter() - start
+    print("  {:<10} {:>8.3f} s {:>10.1f} MB {:>8.1f} MB gzip".format(
+        name, elapsed, len(document) / 1e6, len(gzip.compress(document.encode(), 6)) / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 500000])
+    args = parser.parse_args()
+
+    service = FoodSupplyChainService()
+    for n in args.rows:
+        df = locations(n)
+        print("{} rows".format(n))
+        measure("per-row", lambda: json.dumps([prepare_payload(service, row) for row in df.to_dict("records")]))
+        measure("records", lambda: json.dumps(records(service.payload_frame(df))))
+        measure("columnar", lambda: json.dumps(columnar(service.payload_frame(df), service.coded_keys)))
+
+
+if __name__ == "__main__":
+    main()
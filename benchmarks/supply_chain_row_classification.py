@@ -0,0 +1,108 @@
+"""
+Row classification of the food supply chain analysis.
+
+Compares the former per-row implementations (DataFrame.apply(axis=1) for the
+selection type and the radius, apply(lambda) for the crop lookup and the
+country fixes) with the vectorized ones, on a synthetic supply chain shaped
+like the template (points, states and countries, mixed radius units and a few
+invalid cells).
+
+Run with: python benchmarks/supply_chain_row_classification.py [--rows 10000 50000 200000]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# importing the aqueduct package would start the whole app
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "aqueduct", "services"))
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")  # the client connects lazily
+from food_supply_chain_service import FoodSupplyChainService  # noqa: E402
+
+
+def find_selection_type(row):
+    if isinstance(row["Latitude"], float) and np.isnan(row["Latitude"]) == False:  # noqa: E712
+        return "point"
+    elif isinstance(row["State/Province"], str) and isinstance(row["Country"], str):
+        return "state"
+    elif isinstance(row["Country"], str):
+        return "country"
+    return np.nan
+
+
+def clean_buffer(row):
+    unit = str(row["Radius Unit"]).lower()
+    try:
+        float_val = float(row.Radius)
+        if float_val == 0.0:
+            return np.nan
+        elif unit in ["miles", "mile"]:
+            return float_val * 1.609 / 111.0
+        elif unit in ["m", "met", "meter", "meters"]:
+            return (float_val / 1000) / 111.0
+        elif unit in ["km", "kilometer", "kilometers"]:
+            return float_val / 111.0
+        return np.nan
+    except Exception:
+        return np.nan
+
+
+def supply_chain(n):
+    rng = np.random.default_rng(0)
+    kind = rng.choice(["point", "state", "country", "none"], n, p=[0.5, 0.2, 0.25, 0.05])
+    point = kind == "point"
+    return pd.DataFrame({
+        "Location ID": np.arange(n),
+        "Latitude": np.where(point, rng.uniform(-55, 70, n), np.nan),
+        "Longitude": np.where(point, rng.uniform(-170, 170, n), np.nan),
+        "Radius": pd.Series(np.where(point, rng.choice([0, 10, 50, 100], n), np.nan)).astype(object)
+        .where(rng.random(n) > 0.01, "n/a"),
+        "Radius Unit": pd.Series(np.where(point, rng.choice(["km", "Miles", "m", "feet"], n), None)),
+        "State/Province": pd.Series(np.where(kind == "state", rng.choice(["Iowa", "Parana", "Punjab"], n), None)),
+        "Country": pd.Series(np.where(np.isin(kind, ["state", "country"]),
+                                      rng.choice(["USA", "Brazil", "India", "Ivory Coast"], n), None)),
+        "Material Type": rng.choice(["CORN", "Soybeans", "wheat", "Coffee", "unobtainium"], n),
+    })
+
+
+def measure(name, old, new):
+    start = time.perf_counter()
+    expected = old()
+    old_time = time.perf_counter() - start
+    start = time.perf_counter()
+    result = new()
+    new_time = time.perf_counter() - start
+    same = expected.fillna(-1).equals(result.fillna(-1))
+    print("  {:<16} {:>8.3f} s {:>8.4f} s {:>7.0f}x {}".format(
+        name, old_time, new_time, old_time / new_time, "" if same else "MISMATCH"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 50000, 200000])
+    args = parser.parse_args()
+
+    service = FoodSupplyChainService()
+    crops = {"corn": "maiz", "soybeans": "soyb", "wheat": "whea", "coffee": "acof"}
+    for n in args.rows:
+        df = supply_chain(n)
+        print("{} rows          per-row  vectorized".format(n))
+        measure("selection type",
+                lambda: df.apply(find_selection_type, axis=1),
+                lambda: service.find_selection_type(df))
+        measure("radius",
+                lambda: df.apply(clean_buffer, axis=1),
+                lambda: service.clean_buffer(df))
+        measure("crop lookup",
+                lambda: df["Material Type"].apply(lambda x: crops.get(x.lower())).astype(object),
+                lambda: df["Material Type"].str.lower().map(crops).astype(object))
+        measure("country fixes",
+                lambda: df["Country"].apply(lambda x: service.country_fixes.get(x, x)),
+                lambda: df["Country"].replace(service.country_fixes))
+
+
+if __name__ == "__main__":
+    main()
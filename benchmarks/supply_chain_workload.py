@@ -0,0 +1,149 @@
+"""
+Synthetic supply chains in the layout of the upload template.
+
+Workbooks have the template's title and instruction rows, the column headers on
+row 5 and one sourcing location per row. Locations are drawn from the GADM names
+and the IFPRI crop list of supply_chain_data, with a tunable mix of:
+- points: coordinates with a radius in km, miles or meters (some left blank);
+- states: GADM state and country names;
+- countries: GADM country names, or the aliases of country_fixes;
+- typos: state and country names with a dropped, doubled or swapped letter, or
+  changed case, which have to be fuzzy matched;
+- bad rows: unknown materials, missing locations, non-numeric coordinates and
+  invalid radius units, which end up in the error log.
+
+Run from the repository root with:
+python benchmarks/supply_chain_workload.py [--rows 1000 10000 100000] [--points 0.4] [--states 0.3]
+    [--countries 0.3] [--typos 0.1] [--bad 0.05] [--out benchmarks/workloads]
+"""
+import argparse
+import io
+import os
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+DATA_PATH = os.path.join("aqueduct", "services", "supply_chain_data")
+TEMPLATE = os.path.join(DATA_PATH, "template_supply_chain_v20210701_example2.xlsx")
+COLUMNS = ["Location ID", "Latitude", "Longitude", "Radius", "Radius Unit", "State/Province", "Country",
+           "Material Type", "Material Volume (MT)", "Annual Spend"]
+# aliases handled by FoodSupplyChainService.crop_fixes and country_fixes
+CROP_ALIASES = ["CORN", "Soybeans", "soy", "Canola", "sugar cane", "Palm", "oats"]
+COUNTRY_ALIASES = ["USA", "US", "UK", "Ivory Coast"]
+
+
+def template_rows():
+    """The title, instruction and header rows of the template"""
+    workbook = openpyxl.load_workbook(TEMPLATE, read_only=True)
+    rows = list(workbook.worksheets[0].iter_rows(max_row=5, values_only=True))
+    workbook.close()
+    assert list(rows[-1]) == COLUMNS, "template layout changed"
+    return rows
+
+
+def typo(names, rng):
+    """names with one mistake each"""
+    result = []
+    for name in names:
+        kind = rng.integers(4)
+        i = rng.integers(1, max(len(name) - 1, 2))
+        if kind == 0:
+            name = name[:i] + name[i + 1:]
+        elif kind == 1:
+            name = name[:i] + name[i] + name[i:]
+        elif kind == 2 and len(name) > 2:
+            name = name[:i - 1] + name[i] + name[i - 1] + name[i + 1:]
+        else:
+            name = name.upper() if rng.random() < 0.5 else name.lower()
+        result.append(name)
+    return result
+
+
+def supply_chain(rows, points=0.4, states=0.3, countries=0.3, typos=0.1, bad=0.05, seed=0):
+    """
+    :param rows: number of rows
+    :param points, states, countries: shares of the location types, normalized
+    :param typos: share of the state and country names with a typo
+    :param bad: share of invalid rows
+    :return: DataFrame with the template columns
+    """
+    rng = np.random.default_rng(seed)
+    admnames = pd.read_csv(os.path.join(DATA_PATH, "inputs_admin_names.csv"), encoding="utf-8-sig",
+                           usecols=["NAME_0", "NAME_1"]).dropna()
+    crops = pd.read_csv(os.path.join(DATA_PATH, "inputs_ifpri_croplist.csv"))["full_name"].tolist()
+
+    shares = np.array([points, states, countries], dtype=float)
+    kind = rng.choice(["point", "state", "country"], rows, p=shares / shares.sum())
+    point, state, country = kind == "point", kind == "state", kind == "country"
+
+    df = pd.DataFrame({column: pd.Series([None] * rows, dtype=object) for column in COLUMNS})
+    df["Location ID"] = np.arange(1, rows + 1)
+
+    df.loc[point, "Latitude"] = rng.uniform(-40, 60, point.sum()).round(4)
+    df.loc[point, "Longitude"] = rng.uniform(-120, 140, point.sum()).round(4)
+    df.loc[point, "Radius"] = rng.choice([10, 50, 100, 250], point.sum())
+    df.loc[point, "Radius Unit"] = rng.choice(["km", "Kilometers", "miles", "m"], point.sum())
+    blank = point & (rng.random(rows) < 0.1)  # defaults to 100 km
+    df.loc[blank, ["Radius", "Radius Unit"]] = None
+
+    picked = admnames.iloc[rng.integers(len(admnames), size=rows)]
+    df.loc[state, "State/Province"] = picked["NAME_1"].values[state]
+    df.loc[state | country, "Country"] = picked["NAME_0"].values[state | country]
+    alias = country & (rng.random(rows) < 0.05)
+    df.loc[alias, "Country"] = rng.choice(COUNTRY_ALIASES, alias.sum())
+
+    misspelled = (state | country) & (rng.random(rows) < typos)
+    df.loc[misspelled, "Country"] = typo(df.loc[misspelled, "Country"], rng)
+    misspelled = state & (rng.random(rows) < typos)
+    df.loc[misspelled, "State/Province"] = typo(df.loc[misspelled, "State/Province"], rng)
+
+    df["Material Type"] = rng.choice(crops + CROP_ALIASES, rows)
+    df["Material Volume (MT)"] = rng.integers(1, 10000, rows)
+    df["Annual Spend"] = rng.integers(1000, 10000000, rows)
+
+    # bad rows, one problem each
+    problem = np.where(rng.random(rows) < bad, rng.integers(4, size=rows), -1)
+    df.loc[problem == 0, "Material Type"] = "unobtainium"
+    df.loc[problem == 1, ["Latitude", "Longitude", "Radius", "Radius Unit", "State/Province", "Country"]] = None
+    df.loc[(problem == 2) & point, "Latitude"] = "n/a"
+    df.loc[(problem == 3) & point, "Radius Unit"] = "furlongs"
+    return df
+
+
+def workbook(df):
+    """xlsx bytes of the supply chain, in the template layout"""
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet("sourcing_locations")
+    for row in template_rows():
+        sheet.append(list(row))
+    for row in df.astype(object).where(df.notna(), None).itertuples(index=False):
+        sheet.append(list(row))
+    out = io.BytesIO()
+    book.save(out)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--points", type=float, default=0.4)
+    parser.add_argument("--states", type=float, default=0.3)
+    parser.add_argument("--countries", type=float, default=0.3)
+    parser.add_argument("--typos", type=float, default=0.1)
+    parser.add_argument("--bad", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=os.path.join("benchmarks", "workloads"))
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    for rows in args.rows:
+        df = supply_chain(rows, args.points, args.states, args.countries, args.typos, args.bad, args.seed)
+        path = os.path.join(args.out, "supply_chain_{}.xlsx".format(rows))
+        with open(path, "wb") as f:
+            f.write(workbook(df))
+        print("{} rows: {} ({:.1f} MB)".format(rows, path, os.path.getsize(path) / 1e6))
+
+
+if __name__ == "__main__":
+    main()
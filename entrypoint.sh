@@ -18,6 +18,25 @@ case "$1" in
         echo "Running worker"
         exec python aqueduct/workers/supply-chain-worker.py
         ;;
+    supply-chain-artifacts)
+        echo "Building supply chain lookup artifacts"
+        shift
+        exec python aqueduct/services/supply_chain_artifacts.py "$@"
+        ;;
+    supply-chain-stats)
+        echo "Supply chain stage timings"
+        shift
+        exec python aqueduct/services/supply_chain_metrics.py "$@"
+        ;;
+    cba-defaults)
+        echo "Generating cba defaults"
+        exec python -m aqueduct.services.cba_defaults_service
+        ;;
+    cba-warmer)
+        echo "Warming cba caches"
+        shift
+        exec python aqueduct/workers/cba-cache-warmer.py "$@"
+        ;;
     *)
         exec "$@"
 esac
@@ -42,6 +42,11 @@ proc_name = None
 #
 #       A callable that accepts the same arguments as after_fork
 #
+#   post_worker_init - Called just after a worker has initialized the
+#       application.
+#
+#       A callable that takes a worker instance as argument.
+#
 #   pre_exec - Called just prior to forking off a secondary
 #       master process during things like config reloading.
 #
@@ -56,6 +61,15 @@ def pre_fork(server, worker):
     pass
 
 
+def post_worker_init(worker):
+    # Load the precomputed cba defaults once per worker, before serving requests
+    try:
+        from aqueduct.services.cba_defaults_service import CBADefaultsTable
+        CBADefaultsTable.load()
+    except Exception as e:
+        worker.log.error("Could not load cba defaults: %s", e)
+
+
 def pre_exec(server):
     server.log.info("Forked child, re-executing.")
 